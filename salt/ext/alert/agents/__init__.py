@@ -10,9 +10,12 @@ def load_agents(config):
     Load the agents specified in /etc/salt/alert from the
     salt.ext.alert.agents package.  Each module must define a
     load_agents() function that accepts the parsed YAML configuration
-    for the agents.
+    for the agents and the alert server options.
     '''
-    ignore_modules = ['alert.time', 'alert.subscriptions', 'alert.verbs']
+    ignore_modules = ['alert.time', 'alert.subscriptions', 'alert.verbs',
+                      'alert.ingest', 'alert.engine', 'alert.workers',
+                      'alert.budget', 'alert.enrich', 'alert.maintenance',
+                      'alert.topology', 'alert.escalation', 'alert.stats']
     agents = {}
     for key, value in config.iteritems():
         if key.startswith('alert.') and key not in ignore_modules:
@@ -24,7 +27,7 @@ def load_agents(config):
                 log.trace('not an agent module: %s', modname, exc_info=ex)
                 continue
             try:
-                new_agents = mod.load_agents(value)
+                new_agents = mod.load_agents(value, config)
             except AttributeError, ex:
                 log.error('not an agent module: %s', modname, exc_info=ex)
                 continue
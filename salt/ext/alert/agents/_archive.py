@@ -0,0 +1,359 @@
+'''
+An agent that archives every routed alert, and queries of the archive.
+
+The archive is a directory of segments.  Each segment covers a period of
+time and is named after the time it was started and the process that
+writes it (every alert server worker writes its own segments):
+
+    <start>-<pid>.log   the alerts, one JSON object per line
+    <start>-<pid>.idx   one fixed-size index record per alert: the time
+                        the alert was archived, the offset and length of
+                        the alert in the log, and the ids of its host,
+                        category and severity
+    <start>-<pid>.keys  the host, category and severity names of the ids
+
+Queries use the segment names and modification times to skip segments
+outside the time range, the keys to skip segments without matching hosts
+or categories, and a binary search of the index to find the time range
+in a segment.  Only matching alerts are read from the logs.
+'''
+import bisect
+import errno
+import glob
+import fnmatch
+import json
+import os
+import re
+import struct
+import threading
+import time
+
+import salt.log
+import salt.ext.alert.engine
+import salt.ext.alert.scheduler
+
+from .agent import Agent
+
+DEFAULT_SEGMENT_SECS = 60 * 60     # 1 hour
+DEFAULT_SEGMENT_SIZE = 64 * 2 ** 20 # 64 MB
+DEFAULT_BUFFER_SIZE  = 64 * 2 ** 10 # 64 KB
+DEFAULT_FLUSH_WAIT   = 5
+
+# time, offset, length, host id, category id, severity id
+INDEX_RECORD = struct.Struct('<dIIIII')
+
+ALL_ALERTS = re.compile('.*')
+
+log = salt.log.getLogger(__name__)
+
+def archive_dir(opts):
+    '''
+    Return the archive directory for the alert server options.
+    '''
+    config = opts.get('alert.archive') or {}
+    return config.get('dir', os.path.join(opts['cachedir'], 'alert', 'archive'))
+
+class Keys(object):
+    '''
+    A table of the distinct names in a segment and their ids.  The ids
+    are unsigned 32-bit integers in the index.
+
+    >>> keys = Keys(['host{}'.format(i) for i in range(70000)])
+    >>> record = INDEX_RECORD.pack(0, 0, 0, keys.id('new'), 0, 0)
+    >>> INDEX_RECORD.unpack(record)[3]
+    70000
+    '''
+    def __init__(self, names=None):
+        self.names = names or []
+        self.ids = dict((name, idx) for idx, name in enumerate(self.names))
+
+    def id(self, name):
+        idx = self.ids.get(name)
+        if idx is None:
+            idx = len(self.names)
+            self.names.append(name)
+            self.ids[name] = idx
+        return idx
+
+    def matching(self, match):
+        '''
+        Return the set of ids of names for which match(name) is True.
+        '''
+        return set(idx for idx, name in enumerate(self.names) if match(name))
+
+class Segment(object):
+    '''
+    A segment that alerts are appended to.
+    '''
+    def __init__(self, directory, start, buffer_size):
+        self.start = start
+        self.pid = os.getpid()
+        self.base = os.path.join(directory,
+                                 '{}-{}'.format(int(start), self.pid))
+        self.log = open(self.base + '.log', 'ab', buffer_size)
+        self.idx = open(self.base + '.idx', 'ab', buffer_size)
+        self.size = self.log.tell()
+        self.keys = {}
+        for kind, names in read_keys(self.base).iteritems():
+            self.keys[kind] = Keys(names)
+        for kind in ['hosts', 'categories', 'severities']:
+            self.keys.setdefault(kind, Keys())
+        self.keys_dirty = False
+
+    def append(self, now, alert):
+        '''
+        Append an alert to the segment.
+        '''
+        record = json.dumps(alert, default=str, sort_keys=True) + '\n'
+        ids = []
+        for kind, key in [('hosts', 'host'),
+                          ('categories', 'category'),
+                          ('severities', 'severity')]:
+            keys = self.keys[kind]
+            count = len(keys.names)
+            ids.append(keys.id(alert.get(key, 'unknown')))
+            if len(keys.names) != count:
+                self.keys_dirty = True
+        index = INDEX_RECORD.pack(now, self.size, len(record), *ids)
+        self.log.write(record)
+        self.idx.write(index)
+        self.size += len(record)
+
+    def flush(self):
+        '''
+        Flush the buffered alerts.  The keys are written first, so
+        every id in the index can be resolved.
+        '''
+        if self.keys_dirty:
+            tmp = self.base + '.keys.tmp'
+            with open(tmp, 'w') as fp:
+                json.dump(dict((kind, keys.names)
+                                for kind, keys in self.keys.iteritems()), fp)
+            os.rename(tmp, self.base + '.keys')
+            self.keys_dirty = False
+        self.log.flush()
+        self.idx.flush()
+
+    def close(self):
+        self.flush()
+        self.log.close()
+        self.idx.close()
+
+def read_keys(base):
+    try:
+        with open(base + '.keys') as fp:
+            return json.load(fp)
+    except IOError, ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        return {}
+
+class ArchiveAgent(Agent):
+    '''
+    An agent that appends every routed alert to the archive.
+    Writes are buffered and flushed every flush_wait seconds.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> agent = ArchiveAgent('archive', {}, directory)
+    >>> for host, category in [('web1', 'disk.full'), ('db1', 'disk.full'),
+    ...                        ('web1', 'load.high')]:
+    ...     d = agent.deliver({'host': host, 'category': category,
+    ...                        'severity': 'critical', 'msg': 'oops'})
+    >>> agent.flush()
+    >>> reader = ArchiveReader(directory)
+    >>> [(a['host'], a['category']) for a in reader.query(
+    ...         since=time.time() - 60, hosts=['web*'], match='disk.*/critical')]
+    [(u'web1', u'disk.full')]
+    >>> len(list(reader.query(until=time.time() - 60)))
+    0
+    >>> shutil.rmtree(directory)
+    '''
+    def __init__(self, protocol, config, directory):
+        '''
+        Configure the agent from YAML data parsed from /etc/salt/alert.
+        '''
+        Agent.__init__(self, protocol)
+        self.directory = directory
+        self.segment_secs = config.get('segment_secs', DEFAULT_SEGMENT_SECS)
+        self.segment_size = config.get('segment_size', DEFAULT_SEGMENT_SIZE)
+        self.buffer_size = config.get('buffer_size', DEFAULT_BUFFER_SIZE)
+        self.flush_wait = config.get('flush_wait', DEFAULT_FLUSH_WAIT)
+        self.segment = None
+        self.flush_timer = None
+        self.lock = threading.Lock()
+        log.trace('archive alerts in %s', directory)
+
+    def has_subscribers(self):
+        '''
+        The archive does not need subscribers: it keeps every alert.
+        '''
+        return True
+
+    def match(self, alert):
+        '''
+        Every alert matches the archive.
+        '''
+        return {ALL_ALERTS: set([self.directory])}
+
+    def _render(self, subscribers, alert):
+        '''
+        Return the archived record, without archiving it.
+        '''
+        return [(self.directory,
+                 json.dumps(alert, default=str, sort_keys=True) + '\n')]
+
+    def _deliver_async(self, subscribers, alert):
+        '''
+        Appends are buffered, so deliver inline.
+        '''
+        self._deliver(subscribers, alert)
+        return salt.ext.alert.engine.succeed()
+
+    def _deliver(self, subscribers, alert):
+        '''
+        Append the alert to the current segment and schedule a flush.
+        '''
+        now = time.time()
+        with self.lock:
+            segment = self.__segment(now)
+            segment.append(now, alert)
+            if self.flush_timer is None:
+                self.flush_timer = salt.ext.alert.scheduler.schedule(
+                                        self.flush_wait, self.flush)
+
+    def flush(self):
+        '''
+        Flush buffered alerts to disk.
+        '''
+        with self.lock:
+            self.flush_timer = None
+            if self.segment is not None and self.segment.pid == os.getpid():
+                self.segment.flush()
+
+    def __segment(self, now):
+        '''
+        Return the segment to append to, starting a new one when the
+        current one is too old or too big.
+        '''
+        segment = self.segment
+        if segment is not None:
+            if segment.pid != os.getpid():
+                # forked: the parent owns the segment
+                segment = None
+            elif now - segment.start < self.segment_secs and \
+                    segment.size < self.segment_size:
+                return segment
+            else:
+                segment.close()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.segment = Segment(self.directory, now, self.buffer_size)
+        log.debug('start archive segment %s', self.segment.base)
+        return self.segment
+
+class ArchiveReader(object):
+    '''
+    Query the alert archive.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self, since=None, until=None):
+        '''
+        Return the paths, without extension, of the segments that may
+        hold alerts archived between since and until, oldest first.
+        '''
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, '*-*.idx')):
+            start, pid = os.path.basename(path)[:-4].split('-', 1)
+            if not start.isdigit() or not pid.isdigit():
+                continue
+            if until is not None and int(start) >= until:
+                continue
+            if since is not None and os.path.getmtime(path) < since:
+                continue
+            segments.append((int(start), int(pid), path[:-4]))
+        return [segment[2] for segment in sorted(segments)]
+
+    def query(self, since=None, until=None, hosts=None, match=None):
+        '''
+        Return an iterator of the archived alerts.  Alerts are returned
+        oldest first per segment; segments written by different workers
+        at the same time are not merged.
+
+        since = only alerts archived at or after this time
+        until = only alerts archived before this time
+        hosts = only alerts from hosts matching one of these globs
+        match = only alerts whose category/severity matches this regex,
+                like subscriptions
+        '''
+        if match is not None:
+            regex = re.compile(match)
+        for base in self.segments(since, until):
+            keys = read_keys(base)
+            host_ids = cat_ids = None
+            if hosts:
+                host_ids = Keys(keys.get('hosts')).matching(
+                    lambda name: any(fnmatch.fnmatch(name, pattern)
+                                        for pattern in hosts))
+                if not host_ids:
+                    continue
+            if match is not None:
+                categories = Keys(keys.get('categories'))
+                severities = Keys(keys.get('severities'))
+                cat_ids = set()
+                for cat_id, category in enumerate(categories.names):
+                    for sev_id, severity in enumerate(severities.names):
+                        if regex.match('/'.join([category, severity])):
+                            cat_ids.add((cat_id, sev_id))
+                if not cat_ids:
+                    continue
+            for alert in self.__scan(base, since, until, host_ids, cat_ids):
+                yield alert
+
+    def __scan(self, base, since, until, host_ids, cat_ids):
+        '''
+        Read the matching alerts in a segment.
+        '''
+        with open(base + '.idx', 'rb') as fp:
+            index = fp.read()
+        count = len(index) // INDEX_RECORD.size
+        times = IndexTimes(index, count)
+        first = bisect.bisect_left(times, since) if since is not None else 0
+        last = bisect.bisect_left(times, until) if until is not None else count
+        with open(base + '.log', 'rb') as logfp:
+            for idx in xrange(first, last):
+                when, offset, length, host_id, cat_id, sev_id = \
+                        INDEX_RECORD.unpack_from(index, idx * INDEX_RECORD.size)
+                if host_ids is not None and host_id not in host_ids:
+                    continue
+                if cat_ids is not None and (cat_id, sev_id) not in cat_ids:
+                    continue
+                logfp.seek(offset)
+                record = logfp.read(length)
+                if len(record) < length:
+                    # indexed before the log was flushed
+                    break
+                yield json.loads(record)
+
+class IndexTimes(object):
+    '''
+    A read-only sequence of the times in an index, for bisect.
+    '''
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        return INDEX_RECORD.unpack_from(self.index,
+                                        idx * INDEX_RECORD.size)[0]
+
+def load_agents(config, opts):
+    '''
+    Load the archive agent.
+    '''
+    return {'archive': ArchiveAgent('archive', config or {}, archive_dir(opts))}
@@ -1,15 +1,37 @@
 import email.mime.text
 import email.utils
+import random
 import smtplib
+import socket
 import string
+import threading
+import time
 
 import salt.log
+import salt.ext.alert.engine
+import salt.ext.alert.latency
+import salt.ext.alert.scheduler
 
 from .agent import Agent
+from .breaker import CircuitBreaker, CLOSED, OPEN
+from .recipient import Recipient
 
 DEFAULT_PORT     = 25
 DEFAULT_USER     = ''
 DEFAULT_PASSWORD = ''
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_IO_TIMEOUT      = 30
+DEFAULT_FAILURES        = 3
+DEFAULT_RESET           = 30
+DEFAULT_WEIGHT          = 1
+DEFAULT_POOL_SIZE       = 2
+DEFAULT_POOL_IDLE       = 60
+DEFAULT_BUSY_WAIT       = 1
+DEFAULT_CHUNK_SIZE      = 0
+DEFAULT_RETRY_MAX_MSGS  = 50
+DEFAULT_RETRY_MAX_AGE   = 60 * 60 # 1 hour
+DEFAULT_BACKOFF         = 5
+DEFAULT_MAX_BACKOFF     = 10 * 60
 DEFAULT_SENDER   = 'Salt Alert'
 DEFAULT_SUBJECT  = '${SEVERITY} ${host} ${msg}'
 DEFAULT_HEADERS  = {'X-Priority': 1}
@@ -22,49 +44,497 @@ time:     ${time}'''
 
 log = salt.log.getLogger(__name__)
 
+class RetryQueue(object):
+    '''
+    Messages waiting to be resent, queued per email address.  Each address
+    is retried with exponential backoff and jitter, independently of the
+    others.  The queues have the same max_msgs and max_age limits as
+    other recipients, so the retry queue is bounded.
+
+    >>> q = RetryQueue(max_msgs=2, max_age=0, backoff=10, max_backoff=60)
+    >>> q.failed(['a@example.com', 'b@example.com'], 'msg 1', now=0)
+    >>> q.failed(['a@example.com'], 'msg 2', now=0)
+    >>> q.due(now=1)
+    []
+    >>> sorted(q.due(now=11))
+    [('msg 1', ['a@example.com', 'b@example.com'], 0)]
+
+    # b's message is sent, a's fails again and backs off twice as long
+    >>> q.succeeded(['b@example.com'])
+    >>> q.failed(['a@example.com'], 'msg 1', now=11, created=0)
+    >>> q.due(now=25)
+    []
+    >>> q.due(now=31)
+    [('msg 1', ['a@example.com'], 0)]
+
+    # a requeued message keeps its age, so it expires after max_age
+    >>> q = RetryQueue(max_age=100, backoff=40, max_backoff=40)
+    >>> q.failed(['a@example.com'], 'msg 1', now=0)
+    >>> q.due(now=40)
+    [('msg 1', ['a@example.com'], 0)]
+    >>> q.failed(['a@example.com'], 'msg 1', now=40, created=0)
+    >>> q.due(now=80)
+    [('msg 1', ['a@example.com'], 0)]
+    >>> q.postpone(['a@example.com'], 'msg 1', until=120, created=0)
+    >>> q.due(now=120), len(q)
+    ([], 0)
+    '''
+    def __init__(self, max_msgs=DEFAULT_RETRY_MAX_MSGS,
+                       max_age=DEFAULT_RETRY_MAX_AGE,
+                       backoff=DEFAULT_BACKOFF,
+                       max_backoff=DEFAULT_MAX_BACKOFF,
+                       jitter=False,
+                       priority=0):
+        '''
+        Create an empty retry queue.
+
+        max_msgs    = maximum number of messages queued per address
+        max_age     = maximum number of seconds a message is retried
+        backoff     = seconds to wait before the first retry.  The wait
+                      doubles after every failed retry.
+        max_backoff = maximum number of seconds between retries
+        jitter      = randomize each wait between half and all of it, so
+                      retries to many addresses are spread out
+        priority    = the priority of the queues in the memory budget
+        '''
+        self.max_msgs = max_msgs
+        self.max_age = max_age
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.priority = priority
+        self.lock = threading.Lock()
+        self.recipients = {}
+        self.attempts = {}
+        self.next_try = {}
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(r.msgs) for r in self.recipients.values())
+
+    def failed(self, addrs, msgstr, now=None, created=None):
+        '''
+        Queue a message that could not be sent to addrs and back off.
+        If created is given, the message was queued at that time, as
+        returned by due(), and is put back at the front of the queue.
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for addr in addrs:
+                recipient = self.recipients.get(addr)
+                if recipient is None:
+                    recipient = Recipient(addr, max_msgs=self.max_msgs,
+                                                max_age=self.max_age,
+                                                priority=self.priority)
+                    self.recipients[addr] = recipient
+                if created is not None:
+                    recipient.readd_msg(msgstr, created)
+                else:
+                    recipient.add_msg(msgstr, now)
+                if self.next_try.get(addr, 0) <= now:
+                    # only failures outside the backoff window back off
+                    attempts = self.attempts.get(addr, 0)
+                    self.attempts[addr] = attempts + 1
+                    self.next_try[addr] = now + self._wait(attempts)
+
+    def postpone(self, addrs, msgstr, until, created=None):
+        '''
+        Queue a message that was not attempted, e.g. because the relay is
+        known to be down.  The addresses' backoff is not increased.
+        If created is given, the message was queued at that time, as
+        returned by due(), and is put back at the front of the queue.
+        '''
+        with self.lock:
+            for addr in addrs:
+                recipient = self.recipients.get(addr)
+                if recipient is None:
+                    recipient = Recipient(addr, max_msgs=self.max_msgs,
+                                                max_age=self.max_age,
+                                                priority=self.priority)
+                    self.recipients[addr] = recipient
+                if created is not None:
+                    recipient.readd_msg(msgstr, created)
+                else:
+                    recipient.add_msg(msgstr, time.time())
+                self.next_try[addr] = max(self.next_try.get(addr, 0), until)
+
+    def succeeded(self, addrs):
+        '''
+        Reset the backoff of addresses that a message was sent to.
+        '''
+        with self.lock:
+            for addr in addrs:
+                self.attempts.pop(addr, None)
+                recipient = self.recipients.get(addr)
+                if recipient is not None and not recipient.msgs:
+                    del self.recipients[addr]
+                    self.next_try.pop(addr, None)
+                else:
+                    self.next_try[addr] = 0
+
+    def due(self, now=None):
+        '''
+        Remove the oldest message of each address that is due for a retry.
+        Return a list of (msgstr, addrs, created) so a message that is due
+        for several addresses is sent once.  created is the time the
+        message was first queued, to requeue it with if it fails again.
+        '''
+        if now is None:
+            now = time.time()
+        batches = {}
+        with self.lock:
+            for addr, recipient in self.recipients.items():
+                if self.next_try.get(addr, 0) > now:
+                    continue
+                entry = recipient.pop_msg(now)
+                if entry is None:
+                    del self.recipients[addr]
+                    self.attempts.pop(addr, None)
+                    self.next_try.pop(addr, None)
+                    continue
+                created, msgstr = entry
+                batch = batches.setdefault(msgstr, [created, []])
+                batch[0] = min(batch[0], created)
+                batch[1].append(addr)
+        return [(msgstr, sorted(addrs), created)
+                    for msgstr, (created, addrs) in batches.items()]
+
+    def next_due(self):
+        '''
+        Return the time of the next retry, or None if nothing is queued.
+        '''
+        with self.lock:
+            times = [self.next_try.get(addr, 0)
+                        for addr, recipient in self.recipients.iteritems()
+                            if recipient.msgs]
+        return min(times) if times else None
+
+    def _wait(self, attempts):
+        wait = min(self.backoff * (2 ** attempts), self.max_backoff)
+        if self.jitter:
+            wait = random.uniform(wait / 2.0, wait)
+        return wait
+
+class Relay(object):
+    '''
+    An SMTP relay with a pool of persistent connections and a circuit
+    breaker.  When the breaker opens, the relay is out of rotation until
+    a health check finds it working again.
+
+    A pooled connection the relay closed while it was idle fails when it
+    is reused; the message is sent again on a new connection before the
+    relay counts a failure.
+
+    >>> class Conn(object):
+    ...     def __init__(self, broken):
+    ...         self.broken = broken
+    ...     def sendmail(self, sender, addrs, msgstr):
+    ...         if self.broken:
+    ...             raise socket.error(104, 'Connection reset by peer')
+    ...         return {}
+    ...     def close(self):
+    ...         pass
+    >>> relay = Relay({'host': 'relay.example.com'})
+    >>> relay._Relay__connect = lambda: Conn(False)
+    >>> relay.pool = [(Conn(True), time.time())]
+    >>> relay.send(['me@example.com'], 'msg'), relay.breaker.consecutive
+    ((True, {}), 0)
+
+    # a new connection that fails is a failure
+    >>> relay._Relay__connect = lambda: Conn(True)
+    >>> relay.pool = []
+    >>> relay.send(['me@example.com'], 'msg'), relay.breaker.consecutive
+    ((False, {}), 1)
+
+    A relay that rejects a message, e.g. because it is too large, works:
+    the message is refused for its recipients, to be dropped on a 5xx
+    code and retried on a 4xx code.  Only 421, the relay closing the
+    connection, counts as a failure.
+
+    >>> class Rejecting(object):
+    ...     def __init__(self, code):
+    ...         self.code = code
+    ...     def sendmail(self, sender, addrs, msgstr):
+    ...         raise smtplib.SMTPDataError(self.code, 'rejected')
+    ...     def close(self):
+    ...         pass
+    >>> relay = Relay({'host': 'relay.example.com'})
+    >>> for code in [552, 451, 421]:
+    ...     relay.pool = [(Rejecting(code), time.time())]
+    ...     ok, refused = relay.send(['me@example.com'], 'msg')
+    ...     print ok, refused, relay.breaker.consecutive
+    True {'me@example.com': (552, 'rejected')} 0
+    True {'me@example.com': (451, 'rejected')} 0
+    False {} 1
+
+    send() runs on a delivery engine worker, so it does not wait for a
+    connection when pool_size messages are already being sent through
+    the relay.
+
+    >>> relay = Relay({'host': 'relay.example.com', 'pool_size': 1})
+    >>> relay.pool_slots.acquire()
+    True
+    >>> print relay.send(['me@example.com'], 'msg')
+    None
+    >>> relay.pool_slots.release()
+    '''
+    def __init__(self, config):
+        '''
+        Configure the relay from one entry of the agent's smtp options.
+        '''
+        self.server   = config.get('host')
+        self.port     = config.get('port',     DEFAULT_PORT)
+        self.user     = config.get('user',     DEFAULT_USER)
+        self.password = config.get('password', DEFAULT_PASSWORD)
+        self.weight   = config.get('weight',   DEFAULT_WEIGHT)
+        self.connect_timeout = config.get('connect_timeout',
+                                          DEFAULT_CONNECT_TIMEOUT)
+        self.io_timeout = config.get('io_timeout', DEFAULT_IO_TIMEOUT)
+        if not self.server:
+            raise ValueError('alert.email.smtp config missing or '
+                             'blank "host" option')
+        self.name = '{}:{}'.format(self.server, self.port)
+        self.breaker = CircuitBreaker(
+                self.name,
+                failures=config.get('failures', DEFAULT_FAILURES),
+                reset=config.get('reset', DEFAULT_RESET))
+        self.pool_idle = config.get('pool_idle', DEFAULT_POOL_IDLE)
+        self.pool_slots = threading.BoundedSemaphore(
+                max(config.get('pool_size', DEFAULT_POOL_SIZE), 1))
+        self.pool = []
+        self.pool_lock = threading.Lock()
+        self.health_timer = None
+        log.trace('''email alert smtp:
+    server:   %s
+    port:     %s
+    user:     %s
+    password: %s
+    weight:   %s
+    timeouts: connect=%s io=%s''',
+                    self.server,
+                    self.port,
+                    self.user,
+                    self.password,
+                    self.weight,
+                    self.connect_timeout,
+                    self.io_timeout)
+
+    def __str__(self):
+        return str(self.breaker)
+
+    def in_rotation(self):
+        '''
+        Return True if messages should be sent through this relay.
+        '''
+        return self.breaker.state == CLOSED
+
+    def send(self, email_addrs, msgstr):
+        '''
+        Send a message.  Return a tuple (ok, refused) where ok is False if
+        the relay failed and refused is the {addr: (code, response)} dict
+        of refused recipients, or None if every connection is busy.
+        '''
+        if not self.pool_slots.acquire(False):
+            log.trace('email: every connection to %s is busy', self.name)
+            return None
+        try:
+            return self.__sendmail(email_addrs, msgstr)
+        finally:
+            self.pool_slots.release()
+
+    def __sendmail(self, email_addrs, msgstr):
+        conn = None
+        try:
+            conn, reused = self.__checkout()
+            try:
+                log.trace('email: send message to %s via %s',
+                          email_addrs, self.name)
+                refused = conn.sendmail(self.user, email_addrs, msgstr)
+            except (smtplib.SMTPServerDisconnected, socket.error), ex:
+                if not reused and \
+                        not isinstance(ex, smtplib.SMTPServerDisconnected):
+                    raise
+                # the relay closed an idle pooled connection
+                log.debug('email: reconnect to %s: %s', self.name, ex)
+                conn.close()
+                conn = self.__connect()
+                refused = conn.sendmail(self.user, email_addrs, msgstr)
+            self.__checkin(conn)
+        except smtplib.SMTPRecipientsRefused, ex:
+            # the relay works, but refused every recipient
+            self.__checkin(conn)
+            self.breaker.success()
+            return (True, ex.recipients)
+        except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError), ex:
+            if ex.smtp_code == 421 or not 400 <= ex.smtp_code < 600:
+                return self.__failure(conn, msgstr, ex)
+            # the relay works, but rejected this message
+            log.warning('email: %s rejected the message: %s %s',
+                        self.name, ex.smtp_code, ex.smtp_error)
+            self.__checkin(conn)
+            self.breaker.success()
+            return (True, dict((addr, (ex.smtp_code, ex.smtp_error))
+                               for addr in email_addrs))
+        except (smtplib.SMTPException, socket.error), ex:
+            return self.__failure(conn, msgstr, ex)
+        self.breaker.success()
+        return (True, refused)
+
+    def __failure(self, conn, msgstr, ex):
+        '''
+        Record a failed send.  Return the result of send().
+        '''
+        log.error('failed to send email alert via %s:\n%s',
+                  self.name, msgstr, exc_info=ex)
+        if conn is not None:
+            conn.close()
+        self.__failed()
+        return (False, {})
+
+    def __connect(self):
+        '''
+        Open a new connection to the relay.
+        '''
+        log.trace('email: connect to %s port %s', self.server, self.port)
+        conn = smtplib.SMTP(timeout=self.connect_timeout)
+        try:
+            conn.connect(self.server, self.port)
+            conn.sock.settimeout(self.io_timeout)
+            conn.ehlo()
+            if conn.has_extn('STARTTLS'):
+                log.trace('email: start tls')
+                conn.starttls()
+            if self.user and self.password:
+                log.trace('email: login as %s', self.user)
+                conn.login(self.user, self.password)
+        except:
+            if getattr(conn, 'sock', None):
+                conn.close()
+            raise
+        return conn
+
+    def __checkout(self):
+        '''
+        Return a pooled connection that has not been idle for too long, or
+        a new connection, and whether the connection is pooled.
+        '''
+        now = time.time()
+        stale = []
+        conn = None
+        with self.pool_lock:
+            while self.pool:
+                conn, idle_since = self.pool.pop()
+                if now - idle_since < self.pool_idle:
+                    break
+                stale.append(conn)
+                conn = None
+        for old in stale:
+            self.__close(old)
+        if conn is not None:
+            return conn, True
+        return self.__connect(), False
+
+    def __checkin(self, conn):
+        with self.pool_lock:
+            self.pool.append((conn, time.time()))
+
+    def __close(self, conn):
+        try:
+            log.trace('email: disconnect from %s', self.name)
+            conn.quit()
+        except (smtplib.SMTPException, socket.error):
+            conn.close()
+
+    def __failed(self):
+        '''
+        Record a relay failure.  Pooled connections are dropped and, if
+        the relay is taken out of rotation, a health check is scheduled.
+        '''
+        with self.pool_lock:
+            pool = self.pool
+            self.pool = []
+        for conn, idle_since in pool:
+            conn.close()
+        self.breaker.failure()
+        self.__schedule_health_check()
+
+    def __schedule_health_check(self):
+        if self.breaker.state == OPEN and self.health_timer is None:
+            self.health_timer = salt.ext.alert.scheduler.schedule(
+                    self.breaker.retry_in(),
+                    salt.ext.alert.engine.submit_nowait, self.__health_check)
+
+    def __health_check(self):
+        '''
+        Probe the relay with a NOOP and put it back in rotation if it
+        answers.  This method runs on a delivery engine worker.
+        '''
+        self.health_timer = None
+        if not self.breaker.allow():
+            self.__schedule_health_check()
+            return
+        log.debug('email: health check %s', self.name)
+        try:
+            conn = self.__connect()
+            code, resp = conn.noop()
+            if code != 250:
+                raise smtplib.SMTPResponseException(code, resp)
+            self.__checkin(conn)
+        except (smtplib.SMTPException, socket.error), ex:
+            log.debug('email: %s is still down: %s', self.name, ex)
+            self.__failed()
+            return
+        log.info('email: %s is back in rotation', self.name)
+        self.breaker.success()
+
 class EmailAgent(Agent):
     '''
     An agent that delivers salt alerts to email users.
+    Messages are spread across one or more relays by weight.
     '''
     def __init__(self, config):
         '''
         Configure the agent from YAML data parsed from /etc/salt/alert.
         '''
         Agent.__init__(self, 'email')
-        self.server   = None
-        self.port     = None
-        self.user     = None
-        self.password = None
+        self.relays   = []
+        self.chunk_size = None
+        self.retry    = None
+        self.busy_wait = None
+        self.retry_lock  = threading.Lock()
+        self.retry_timer = None
+        self.retry_at    = None
         self.sender   = None
         self.subject  = None
         self.headers  = None
         self.body     = None
+        self.parsed   = {}
         self._load_smtp_config(config)
         self._load_msg_config(config)
 
     def _load_smtp_config(self, config):
         '''
         Load the smtp configuration from /etc/salt/alert.
+        The smtp options are either a single relay or a list of relays.
         '''
         smtp_config = config.get('smtp')
         if not smtp_config:
             raise ValueError('alert.email config missing "smtp" options')
-        self.server   = smtp_config.get('host')
-        self.port     = smtp_config.get('port',     DEFAULT_PORT)
-        self.user     = smtp_config.get('user',     DEFAULT_USER)
-        self.password = smtp_config.get('password', DEFAULT_PASSWORD)
-        if not self.server:
-            raise ValueError('alert.email.smtp config missing or '
-                             'blank "host" option')
-        log.trace('''email alert smtp:
-    server:   %s
-    port:     %s
-    user:     %s
-    password: %s''',
-                    self.server,
-                    self.port,
-                    self.user,
-                    self.password)
+        if isinstance(smtp_config, dict):
+            smtp_config = [smtp_config]
+        self.relays = [Relay(relay_config) for relay_config in smtp_config]
+        self.chunk_size = config.get('chunk_size', DEFAULT_CHUNK_SIZE)
+        self.busy_wait = config.get('busy_wait', DEFAULT_BUSY_WAIT)
+        retry_config = config.get('retry', {})
+        self.retry = RetryQueue(
+                max_msgs=retry_config.get('max_msgs', DEFAULT_RETRY_MAX_MSGS),
+                max_age=retry_config.get('max_age', DEFAULT_RETRY_MAX_AGE),
+                backoff=retry_config.get('backoff', DEFAULT_BACKOFF),
+                max_backoff=retry_config.get('max_backoff',
+                                             DEFAULT_MAX_BACKOFF),
+                jitter=True,
+                priority=retry_config.get('priority', 0))
 
     def _load_msg_config(self, config):
         '''
@@ -88,13 +558,25 @@ class EmailAgent(Agent):
     def _parse_subscriber(self, subscriber):
         '''
         Parse the subscriber string into the structure needed by _deliver().
+        An address is parsed once, however many subscriptions it is in.
         '''
-        name, email_addr = email.utils.parseaddr(subscriber)
-        return (subscriber, email_addr)
+        parsed = self.parsed.get(subscriber)
+        if parsed is None:
+            name, email_addr = email.utils.parseaddr(subscriber)
+            parsed = self.parsed[subscriber] = (subscriber, email_addr)
+        return parsed
 
     def _deliver(self, addrs, alert):
         '''
-        Deliver the alert to the specified addresses.
+        Deliver the alert to the specified addresses and wait until it
+        is sent or queued for retry.
+        '''
+        self._deliver_async(addrs, alert).wait()
+
+    def _deliver_async(self, addrs, alert):
+        '''
+        Deliver the alert to the specified addresses on the delivery
+        engine's workers.  Return a Deferred.
         This method should only be called by Agent.deliver().
         addrs = a list of "To:" recipients.  Each recipient can be a
                 plain email address, e.g. "me@example.com", or a real name
@@ -103,7 +585,7 @@ class EmailAgent(Agent):
                 and body
         '''
         if len(addrs) == 0:
-            return
+            return salt.ext.alert.engine.succeed()
         full_addrs  = [addr[0] for addr in addrs]
         email_addrs = [addr[1] for addr in addrs]
         msg = email.mime.text.MIMEText(self.body.safe_substitute(alert))
@@ -111,25 +593,160 @@ class EmailAgent(Agent):
         msg['From'] = self.sender
         msg['To'] = ', '.join(full_addrs)
         msgstr = msg.as_string()
+        trace = alert.get('trace')
         log.trace('send email:\n%s', msgstr)
-        log.trace('email: connect to %s port %s', self.server, self.port)
-        try:
-            s = smtplib.SMTP(self.server, self.port)
-            s.ehlo()
-            if s.has_extn('STARTTLS'):
-                log.trace('email: start tls')
-                s.starttls()
-            if self.user and self.password:
-                log.trace('email: login as %s', self.user)
-                s.login(self.user, self.password)
-            log.trace('email: send message to %s', email_addrs)
-            s.sendmail(self.user, email_addrs, msgstr)
-            log.trace('email: disconnect')
-            s.quit()
-        except smtplib.SMTPException, ex:
-            log.error('failed to send email alert:\n%s', msgstr, exc_info=ex)
-
-def load_agents(config):
+        if self.chunk_size > 0 and len(email_addrs) > self.chunk_size:
+            # send large recipient lists in parallel transactions
+            chunks = [email_addrs[i:i + self.chunk_size]
+                        for i in xrange(0, len(email_addrs), self.chunk_size)]
+        else:
+            chunks = [email_addrs]
+        sent = salt.ext.alert.engine.gather(
+                    salt.ext.alert.engine.submit(self.__send_and_queue,
+                                                 chunk, msgstr, trace=trace)
+                        for chunk in chunks)
+        sent.add_callback(lambda sent: self.__schedule_retry())
+        return sent
+
+    def _render(self, addrs, alert):
+        '''
+        Return the subject and body sent to each address, without
+        sending them.  The MIME encoding is skipped to keep dry runs fast.
+        '''
+        msgstr = '\n\n'.join([self.subject.safe_substitute(alert),
+                               self.body.safe_substitute(alert)])
+        return [(addr[1], msgstr) for addr in addrs]
+
+    def __send_and_queue(self, email_addrs, msgstr, created=None,
+                         trace=None):
+        '''
+        Send a message and queue it for retry to the addresses that
+        failed.  created is the time a retried message was first queued.
+        Return the addresses that failed.
+        '''
+        failed, busy = self.__send(email_addrs, msgstr)
+        if len(failed) < len(email_addrs):
+            salt.ext.alert.latency.sent(trace, 'email')
+        if failed:
+            retry_in = self.__retry_in()
+            if busy:
+                log.debug('email: all relays are busy, queue message '
+                          'for retry')
+                self.retry.postpone(failed, msgstr,
+                                    time.time() + max(retry_in, self.busy_wait),
+                                    created=created)
+            elif retry_in > 0:
+                log.debug('email: all relays are down, queue message '
+                          'for retry')
+                self.retry.postpone(failed, msgstr, time.time() + retry_in,
+                                    created=created)
+            else:
+                self.retry.failed(failed, msgstr, created=created)
+        return failed
+
+    def __send(self, email_addrs, msgstr):
+        '''
+        Send a message through the relays, failing over to the next relay
+        if one fails or has no free connection.  Return a tuple (retry,
+        busy) where retry is the addresses that the message should be
+        resent to: all of them if no relay sent it, or those that the
+        relay temporarily refused.  Permanently refused addresses are
+        logged and dropped.  busy is True if a relay was skipped because
+        all its connections were in use.
+        '''
+        tried = set()
+        busy = False
+        while True:
+            relay = self.__pick_relay(tried)
+            if relay is None:
+                return email_addrs, busy
+            tried.add(relay)
+            result = relay.send(email_addrs, msgstr)
+            if result is None:
+                busy = True
+                continue
+            ok, refused = result
+            if ok:
+                return self.__refused(refused, msgstr), False
+
+    def __pick_relay(self, exclude):
+        '''
+        Pick a relay in rotation at random, by weight.  If no relay is in
+        rotation, pick one whose breaker allows a probe.  Return None if
+        no relay can be used.
+        '''
+        relays = [relay for relay in self.relays
+                    if relay not in exclude and relay.in_rotation()]
+        if not relays:
+            for relay in self.relays:
+                if relay not in exclude and relay.breaker.allow():
+                    return relay
+            return None
+        total = sum(relay.weight for relay in relays)
+        point = random.uniform(0, total)
+        for relay in relays:
+            point -= relay.weight
+            if point <= 0:
+                return relay
+        return relays[-1]
+
+    def __retry_in(self):
+        '''
+        Return the number of seconds until a relay can be used.
+        '''
+        return min(relay.breaker.retry_in() for relay in self.relays)
+
+    def __refused(self, refused, msgstr):
+        '''
+        Return the refused addresses that should be retried.
+        refused is the {addr: (code, response)} dict from sendmail().
+        '''
+        retry = []
+        for addr, (code, resp) in sorted(refused.iteritems()):
+            if 400 <= code < 500:
+                log.warning('email: %s temporarily refused: %s %s',
+                            addr, code, resp)
+                retry.append(addr)
+            else:
+                log.error('email: %s refused: %s %s\n%s',
+                          addr, code, resp, msgstr)
+        return retry
+
+    def __schedule_retry(self):
+        '''
+        Schedule the next retry, if it is earlier than the one already
+        scheduled.
+        '''
+        when = self.retry.next_due()
+        if when is None:
+            return
+        when = max(when, time.time() + self.__retry_in())
+        with self.retry_lock:
+            if self.retry_timer is not None:
+                if self.retry_at <= when:
+                    return
+                self.retry_timer.cancel()
+            self.retry_at = when
+            self.retry_timer = salt.ext.alert.scheduler.schedule(
+                                    when - time.time(),
+                                    salt.ext.alert.engine.submit_nowait,
+                                    self.__flush_retry)
+
+    def __flush_retry(self):
+        '''
+        Resend the messages that are due for a retry.  This method runs on
+        a delivery engine worker, so fresh alerts are never blocked by it.
+        '''
+        with self.retry_lock:
+            self.retry_timer = None
+        now = time.time()
+        for msgstr, addrs, created in self.retry.due(now):
+            failed = self.__send_and_queue(addrs, msgstr, created=created)
+            self.retry.succeeded([addr for addr in addrs
+                                        if addr not in failed])
+        self.__schedule_retry()
+
+def load_agents(config, opts):
     '''
     Load all email agents.
     '''
@@ -1,20 +1,46 @@
 #!/usr/bin/env python2
 
 import collections
+import errno
+import fnmatch
+import os
 import string
 import sys
+import threading
 import time
 
 import sleekxmpp
+import yaml
 
 from salt.ext.alert.agents.agent import Agent
-from salt.ext.alert.agents.recipient import Recipient, READY
+from salt.ext.alert.agents.aimd import AIMDRate, DEFAULT_INCREASE, \
+                                      DEFAULT_DECREASE
+from salt.ext.alert.hashring import HashRing
+from salt.ext.alert.agents.recipient import Recipient, PendingSet, \
+                                          MessageRing, READY, \
+                                          DEFAULT_COLD_BLOCK
+import salt.ext.alert.engine
+import salt.ext.alert.latency
 import salt.log
 
 DEFAULT_MAX_MSGS = 50
 DEFAULT_MAX_AGE = 60 * 60 # 1 hour
+DEFAULT_RESUBSCRIBE_WAIT = 24 * 60 * 60 # 1 day
+ROSTER_SAVE_DELAY = 5
+DEFAULT_COALESCE_MSGS = 1
+DEFAULT_COALESCE_SIZE = 4000
+COALESCE_SEPARATOR = '\n\n'
+MAX_COALESCED_SENT = 1000
+MAX_TRACED = 10000
+DEFAULT_MUC_DOMAINS = ['conference.*']
+DEFAULT_MIN_MSGS_PER_SEC = 0.1
+
+# Error conditions servers use to push back on senders that are too fast
+THROTTLE_CONDITIONS = ['service-unavailable', 'resource-constraint',
+                       'policy-violation']
 
 WAITING_FOR_AUTHZ = 'WAIT-AUTHZ'
+WAITING_FOR_JOIN = 'WAIT-JOIN'
 UNKNOWN = 'UNKNOWN'
 
 DEFAULT_PORT    = 5222
@@ -33,49 +59,369 @@ if sys.version_info < (3, 0):
 
 class JabberError(Exception):
     def __init__(self, msg, exc_info=None):
-        Exception.__init__(msg, exc_info)
+        Exception.__init__(self, msg)
+        self.exc_info = exc_info
 
-class JabberAgent(Agent, sleekxmpp.ClientXMPP):
+def _error_msgs(coalesced, event):
+    '''
+    Return the messages to requeue for a stanza that came back with an
+    error: the parts of a coalesced stanza, else its body.  The error may
+    come back without the body, then there is nothing to requeue.
+
+    >>> _error_msgs({}, {'id': '1', 'body': None})
+    []
+    >>> _error_msgs({}, {'id': '1', 'body': 'disk full'})
+    ['disk full']
+    >>> coalesced = {'2': ['disk full', 'load high']}
+    >>> _error_msgs(coalesced, {'id': '2', 'body': None}), coalesced
+    (['disk full', 'load high'], {})
+    '''
+    msgs = coalesced.pop(event['id'], None)
+    if msgs is not None:
+        return msgs
+    body = event.get('body')
+    return [body] if body else []
+
+class RosterCache(object):
+    '''
+    The authorization state of an account's recipients, persisted under
+    the cachedir so a restart does not have to resubscribe to everyone.
+    Each entry maps a recipient's address to its state and the time a
+    subscription request was last sent to it.
+
+    Every alert server process keeps its own copy of the cache, so a
+    save merges the process's changes into the entries on disk.
+
+    >>> import shutil, tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> path = os.path.join(tmpdir, 'alert.roster')
+    >>> first, second = RosterCache(path), RosterCache(path)
+    >>> first.update('a@example.com', READY)
+    >>> second.update('b@example.com', READY)
+    >>> first.save(); second.save()
+    >>> cache = RosterCache(path)
+    >>> cache.authorized('a@example.com'), cache.authorized('b@example.com')
+    (True, True)
+    >>> os.listdir(tmpdir)
+    ['alert.roster']
+    >>> shutil.rmtree(tmpdir)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        # the addresses updated since the last save
+        self.changed = set()
+        if path:
+            self.entries = self._read()
+            log.debug('loaded %s roster cache entries from %s',
+                      len(self.entries), self.path)
+
+    @property
+    def dirty(self):
+        return bool(self.changed)
+
+    def _read(self):
+        '''
+        Return the entries on disk, or an empty dict if there are none.
+        '''
+        try:
+            with open(self.path) as fp:
+                entries = yaml.safe_load(fp)
+        except IOError, ex:
+            if ex.errno != errno.ENOENT:
+                log.warning('cannot read roster cache %s', self.path,
+                            exc_info=ex)
+            return {}
+        except yaml.YAMLError, ex:
+            log.warning('ignore corrupt roster cache %s', self.path,
+                        exc_info=ex)
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def authorized(self, addr):
+        '''
+        Return True if the recipient authorized us the last time we knew.
+        '''
+        return self.entries.get(addr, {}).get('state') == READY
+
+    def subscribed_since(self, addr):
+        '''
+        Return the time a subscription request was last sent to addr,
+        or None if no request is outstanding.
+        '''
+        entry = self.entries.get(addr, {})
+        if entry.get('state') == WAITING_FOR_AUTHZ:
+            return entry.get('time')
+        return None
+
+    def update(self, addr, state, timestamp=None):
+        '''
+        Record a recipient's authorization state.
+        '''
+        if state not in [READY, WAITING_FOR_AUTHZ]:
+            state = UNKNOWN
+        entry = {'state': state, 'time': timestamp}
+        if self.entries.get(addr) != entry:
+            self.entries[addr] = entry
+            self.changed.add(addr)
+
+    def save(self):
+        '''
+        Write the cache if it changed.  The entries other processes saved
+        are read back and kept, except those this process changed.
+        '''
+        if not self.path or not self.dirty:
+            return
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        entries = self._read()
+        for addr in self.changed:
+            entries[addr] = self.entries[addr]
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(tmp, 'w') as fp:
+                yaml.safe_dump(entries, fp, default_flow_style=False)
+            os.rename(tmp, self.path)
+            self.entries = entries
+            self.changed = set()
+            log.trace('saved roster cache %s', self.path)
+        except (IOError, OSError), ex:
+            log.warning('cannot write roster cache %s', self.path,
+                        exc_info=ex)
+
+class JabberAgent(Agent):
     '''
     An agent that delivers salt alerts to Jabber (XMPP) users.
+    The agent may send through several accounts to raise its throughput.
+    Recipients are assigned to the accounts' connections by consistent
+    hashing and fail over to another connection when theirs drops.
     '''
-    def __init__(self, protocol, config):
+    def __init__(self, protocol, config, cachedir=None):
         '''
         Configure the agent from YAML data parsed from /etc/salt/alert.
+        The recipients' authorization state is cached under cachedir.
         '''
         Agent.__init__(self, protocol)
+        self.message = string.Template(config.get('message', DEFAULT_MESSAGE))
+        accounts = config.get('accounts')
+        if not accounts:
+            accounts = [config]
+        self.connections = {}
+        for account in accounts:
+            connection = JabberConnection(protocol, account, config, cachedir)
+            if connection.name in self.connections:
+                raise ValueError('alert.jabber.{}: duplicate account {}'
+                                    .format(protocol, connection.name))
+            connection.failover = self.__failover
+            self.connections[connection.name] = connection
+        self.ring = HashRing(self.connections.keys())
+        self.connected = False
+
+    def _parse_subscriber(self, subscriber):
+        '''
+        Parse the subscriber string into the structure needed by _deliver().
+        The recipient is created on the connection it hashes to.
+        A subscriber may be a multi-user chat room with an optional nick,
+        e.g. room@conference.example.com/alertbot.
+        '''
+        addr, slash, nick = subscriber.partition('/')
+        connection = self.connections[self.ring.get(addr)]
+        if not connection.is_room(addr):
+            addr, nick = subscriber, None
+        connection.add_recipient(addr, nick or None)
+        return addr
+
+    def _render(self, subscribers, alert):
+        '''
+        Return the message sent to each subscriber, without sending it.
+        '''
+        msg = self.message.safe_substitute(alert)
+        return [(addr, msg) for addr in subscribers]
 
-        user = config.get('user')
-        password = config.get('password')
+    def _send_interval(self, addr):
+        '''
+        Messages through a connection are throttled by its msgs_per_sec.
+        '''
+        connection = self.connections[self.ring.get(addr)]
+        return (connection.name, connection.send_interval)
+
+    def _deliver_async(self, subscribers, alert):
+        '''
+        Queueing for the connections never blocks, so deliver inline.
+        '''
+        self._deliver(subscribers, alert)
+        return salt.ext.alert.engine.succeed()
+
+    def _deliver(self, subscribers, alert):
+        '''
+        '''
+        log.trace('_deliver: %s', alert)
+        if not self.connected:
+            self.__connect()
+            self.connected = True
+        timestamp = time.time()
+        msg = self.message.safe_substitute(alert)
+        shards = collections.defaultdict(list)
+        for addr in subscribers:
+            shards[self.__connection(addr)].append(addr)
+        for connection, addrs in shards.iteritems():
+            connection.queue(addrs, [(timestamp, msg)], alert.get('trace'))
+
+    def __connection(self, addr):
+        '''
+        Return the connection that delivers to addr: the first connection
+        on the hash ring that is up.  If no connection is up, use the
+        recipient's own connection so messages wait for it to connect.
+        '''
+        name = self.ring.get(addr, lambda n: self.connections[n].up)
+        if name is None:
+            name = self.ring.get(addr)
+        return self.connections[name]
+
+    def __connect(self):
+        '''
+        Connect all accounts to their Jabber servers.
+        '''
+        failed = []
+        for connection in self.connections.values():
+            try:
+                connection.start()
+            except JabberError, ex:
+                log.error('%s', ex)
+                failed.append(connection.name)
+        if len(failed) == len(self.connections):
+            raise JabberError('connect failed: {}'.format(', '.join(failed)))
+
+    def __failover(self, connection, backlog):
+        '''
+        Move the messages queued on a dropped connection to the
+        recipients' next connection.  This method runs on the dropped
+        connection's thread.
+        '''
+        moved = collections.defaultdict(int)
+        for addr, msgs in backlog:
+            # if no other connection is up, the messages are requeued
+            # on the dropped connection until it reconnects
+            target = self.__connection(addr)
+            target.queue([addr], msgs)
+            if target is not connection:
+                moved[target.name] += len(msgs)
+        for name, count in moved.iteritems():
+            log.info('%s: moved %s message(s) from %s to %s',
+                     self.protocol, count, connection.name, name)
+
+class JabberConnection(sleekxmpp.ClientXMPP):
+    '''
+    A connection to a Jabber server for one of an agent's accounts.
+    Each connection has its own recipients, roster and throttle.
+    '''
+    def __init__(self, protocol, account, config, cachedir=None):
+        '''
+        Configure the connection from an account in the agent's YAML data.
+        Options that are missing from the account are taken from the
+        agent's config.
+        '''
+        def option(key, default=None):
+            return account.get(key, config.get(key, default))
+
+        user = account.get('user')
+        password = account.get('password')
         sleekxmpp.ClientXMPP.__init__(self, user, password)
         self.auto_subscribe = False
         self.auto_authorize = None
+        self.protocol = protocol
+        self.name = self.boundjid.bare
 
-        server = config.get('host')
+        server = account.get('host')
         if server:
-            self.server_addr = (server, config.get('port', DEFAULT_PORT))
+            self.server_addr = (server, account.get('port', DEFAULT_PORT))
         else:
             self.server_addr = (self.boundjid.host, DEFAULT_PORT)
-        self.max_msgs = config.get('max_msgs', DEFAULT_MAX_MSGS)
-        self.max_age = config.get('max_age', DEFAULT_MAX_AGE)
+        self.max_msgs = option('max_msgs', DEFAULT_MAX_MSGS)
+        self.max_age = option('max_age', DEFAULT_MAX_AGE)
+        self.priority = option('priority', 0)
+        self.cold_after = option('cold_after', 0)
+        self.cold_block = option('cold_block', DEFAULT_COLD_BLOCK)
+        self.resubscribe_wait = option('resubscribe_wait',
+                                       DEFAULT_RESUBSCRIBE_WAIT)
+
+        if cachedir and option('roster_cache', True):
+            path = os.path.join(cachedir, 'alert', 'jabber',
+                                self.name + '.roster')
+        else:
+            path = None
+        self.roster_cache = RosterCache(path)
+        self.roster_save_scheduled = False
 
         log.trace('connect to %s as %s/%s', self.server_addr, user, password)
 
-        self.connected  = False
-        self.message    = string.Template(config.get('message', DEFAULT_MESSAGE))
-        self.pending    = set()
+        self.up         = False
+        self.failover   = None
+        self.pending    = PendingSet()
         self.recipients = {}
 
+        # With shared_queue, a message queued to many recipients is
+        # stored once in a ring shared by the connection's recipients.
+        if option('shared_queue', False):
+            self.ring = MessageRing()
+        else:
+            self.ring = None
+
+        # Multi-user chat rooms receive one groupchat message for all
+        # of their occupants.  Rooms are joined at every session start.
+        self.rooms        = {}
+        self.room_nicks   = {}
+        self.muc_domains  = option('muc_domains', DEFAULT_MUC_DOMAINS)
+        self.muc_nick     = option('muc_nick', self.boundjid.user)
+        self.rejoin_scheduled = False
+
+        # Messages are handed off from the ingest thread to the XMPP
+        # thread, which is the only thread that touches the recipients'
+        # queues.
+        self.handoff = []
+        self.handoff_lock = threading.Lock()
+        self.handoff_scheduled = False
+
         self.service_down = False
         self.retry_service_wait = 60
 
+        # Consecutive queued messages to a recipient may be merged into
+        # one stanza.  The parts of recently sent merged stanzas are kept
+        # so they can be requeued individually if the send fails.
+        self.coalesce_msgs = max(option('coalesce_msgs',
+                                        DEFAULT_COALESCE_MSGS), 1)
+        self.coalesce_size = option('coalesce_size', DEFAULT_COALESCE_SIZE)
+        self.coalesced = collections.OrderedDict()
+
+        # The trace ids of queued messages, and the send time and trace
+        # ids of sent stanzas that requested a delivery receipt
+        # (XEP-0184), to track the alerts' delivery latency.  A
+        # recipient's identical messages are sent in the order they were
+        # queued, so each queued copy keeps its own trace in a FIFO.
+        self.traces = collections.OrderedDict()
+        self.traced = 0
+        self.receipts_enabled = option('receipts', False)
+        self.receipts = collections.OrderedDict()
+
+        # The send rate adapts between min_msgs_per_sec and
+        # max_msgs_per_sec to the pushback from the server.
         self.last_send_time = 0
         self.throttle_wait = False
-        msgs_per_sec = config.get('msgs_per_sec', 0)
-        if msgs_per_sec <= 0:
-            self.send_interval = 0
+        msgs_per_sec = option('msgs_per_sec', 0)
+        max_rate = option('max_msgs_per_sec', msgs_per_sec)
+        if max_rate <= 0:
+            self.rate = None
         else:
-            self.send_interval = 1.0 / msgs_per_sec
+            min_rate = option('min_msgs_per_sec',
+                              min(msgs_per_sec or max_rate,
+                                  DEFAULT_MIN_MSGS_PER_SEC))
+            self.rate = AIMDRate(self.name, msgs_per_sec or min_rate,
+                                 min_rate, max_rate,
+                                 option('rate_increase', DEFAULT_INCREASE),
+                                 option('rate_decrease', DEFAULT_DECREASE))
 
         self.add_event_handler('presence_subscribe', self.__presence)
         self.add_event_handler('presence_subscribed', self.__presence)
@@ -89,39 +435,236 @@ class JabberAgent(Agent, sleekxmpp.ClientXMPP):
         self.add_event_handler('message', self.__message)
         self.add_event_handler('roster_update', self.__roster)
         self.add_event_handler('session_start', self.__start)
+        self.add_event_handler('disconnected', self.__disconnected)
+        self.add_event_handler('groupchat_presence', self.__room_presence)
+        self.add_event_handler('receipt_received', self.__receipt)
 
         self.register_plugin('xep_0030') # Service Discovery
         self.register_plugin('xep_0199') # XMPP Ping
         self.register_plugin('xep_0086') # Legacy Errors
+        self.register_plugin('xep_0045') # Multi-User Chat
+        if self.receipts_enabled:
+            self.register_plugin('xep_0184') # Message Delivery Receipts
 
-    def _parse_subscriber(self, subscriber):
+    @property
+    def send_interval(self):
         '''
-        Parse the subscriber string into the structure needed by _deliver().
+        The current minimum number of seconds between sends.
+        '''
+        if self.rate is None:
+            return 0
+        return self.rate.interval
+
+    def is_room(self, addr):
+        '''
+        Return True if addr is a multi-user chat room, i.e. its domain
+        matches one of the muc_domains globs.
+        '''
+        domain = addr.partition('@')[2]
+        for pattern in self.muc_domains:
+            if fnmatch.fnmatch(domain, pattern):
+                return True
+        return False
+
+    def add_recipient(self, addr, nick=None):
         '''
-        log.debug('add recipient: %s', subscriber)
-        recipient = Recipient(subscriber,
+        Return the recipient for addr, creating it if necessary.
+        If addr is a room, nick is our nickname in the room.
+        After the connection has started, this method must only be
+        called on the XMPP thread.
+        '''
+        if self.is_room(addr):
+            return self.__add_room(addr, nick)
+        recipient = self.recipients.get(addr)
+        if recipient:
+            return recipient
+        log.debug('%s: add recipient: %s', self.name, addr)
+        recipient = Recipient(addr,
                               max_msgs=self.max_msgs,
                               max_age=self.max_age,
                               state=UNKNOWN,
-                              pending=self.pending)
+                              pending=self.pending,
+                              ring=self.ring,
+                              priority=self.priority,
+                              cold_after=self.cold_after,
+                              cold_block=self.cold_block)
         self.recipients[recipient.addr] = recipient
+        if self.up:
+            # a recipient that failed over from another connection
+            if self.roster_cache.authorized(addr):
+                recipient.state = READY
+            elif addr in self.client_roster:
+                self.__set_state(recipient, self.client_roster[addr])
+            else:
+                self.__set_state(recipient)
         return recipient
 
-    def _deliver(self, subscribers, alert):
+    def __add_room(self, room, nick=None):
         '''
+        Return the recipient for a room, creating it if necessary.
         '''
-        log.trace('_deliver: %s', alert)
-        if not self.connected:
-            self.__connect()
-            self.connected = True
-        timestamp = time.time()
-        msg = self.message.safe_substitute(alert)
-        for recipient in subscribers:
-            log.trace('queue message to %s: %s message(s) pending',
-                        recipient.addr, len(recipient.msgs))
-            recipient.add_msg(msg, timestamp)
+        if nick:
+            self.room_nicks[room] = nick
+        recipient = self.rooms.get(room)
+        if recipient:
+            return recipient
+        log.debug('%s: add room: %s', self.name, room)
+        recipient = Recipient(room,
+                              max_msgs=self.max_msgs,
+                              max_age=self.max_age,
+                              state=UNKNOWN,
+                              pending=self.pending,
+                              ring=self.ring,
+                              priority=self.priority,
+                              cold_after=self.cold_after,
+                              cold_block=self.cold_block)
+        self.rooms[room] = recipient
+        if self.up:
+            self.__join(recipient)
+        return recipient
+
+    def __join(self, recipient):
+        '''
+        Join a room.  The room is ready when it echoes our presence.
+        '''
+        nick = self.room_nicks.get(recipient.addr, self.muc_nick)
+        log.debug('%s: join %s as %s', self.name, recipient.addr, nick)
+        recipient.state = WAITING_FOR_JOIN
+        self.plugin['xep_0045'].joinMUC(recipient.addr, nick, maxhistory='0')
+
+    def __schedule_rejoin(self):
+        '''
+        Schedule a rejoin of the rooms we left, unless one is scheduled.
+        '''
+        if not self.rejoin_scheduled:
+            self.rejoin_scheduled = True
+            self.schedule('rejoin', self.retry_service_wait, self.__rejoin)
+
+    def __rejoin(self):
+        '''
+        Rejoin rooms that we were kicked from or failed to join.
+        '''
+        self.rejoin_scheduled = False
+        for recipient in self.rooms.values():
+            if recipient.state == UNKNOWN and self.up:
+                self.__join(recipient)
+
+    def __room_presence(self, event):
+        '''
+        Track whether we are in a room from the room's echo of our own
+        presence.
+        '''
+        room = event['from'].bare
+        recipient = self.rooms.get(room)
+        if not recipient:
+            return
+        nick = self.room_nicks.get(room, self.muc_nick)
+        if event['from'].resource != nick:
+            return
+        etype = event.get_type()
+        log.trace('_room_presence: room=%s type=%s', room, etype)
+        if etype in ['unavailable', 'error']:
+            log.warning('%s: left %s (%s)', self.name, room, etype)
+            recipient.state = UNKNOWN
+            self.__schedule_rejoin()
+        elif recipient.state != READY:
+            recipient.state = READY
+            self.__pending()
+
+    def queue(self, addrs, msgs, trace=None):
+        '''
+        Queue messages, a list of (timestamp, msg) tuples, to each address
+        in addrs.  This method may be called from any thread.
+        trace = the trace id of the alert the messages are for
+        '''
+        with self.handoff_lock:
+            self.handoff.append((addrs, msgs, trace))
+            if self.handoff_scheduled:
+                return
+            self.handoff_scheduled = True
+        self.schedule('handoff', 0, self.__handoff)
+
+    def start(self):
+        '''
+        Connect to the Jabber server.
+        '''
+        log.debug('connecting to {}:{}'.format(*self.server_addr))
+        if not self.connect(self.server_addr):
+            raise JabberError('connect failed: {}:{}'
+                                .format(*self.server_addr))
+
+        # Process Jabber messages forever in a background thread
+        self.process(block=False)
+
+    def __handoff(self):
+        '''
+        Queue the messages handed off by queue() and send them.
+        This method runs on the XMPP thread.
+        '''
+        with self.handoff_lock:
+            handoff = self.handoff
+            self.handoff = []
+            self.handoff_scheduled = False
+        for addrs, msgs, trace in handoff:
+            recipients = [self.add_recipient(addr) for addr in addrs]
+            # queue each message to all recipients in a row, so a shared
+            # ring stores it once
+            for timestamp, msg in msgs:
+                for recipient in recipients:
+                    log.trace('queue message to %s: %s message(s) pending',
+                                recipient.addr, len(recipient.msgs))
+                    recipient.add_msg(msg, timestamp)
+                    if trace is not None:
+                        self.__trace(recipient.addr, msg, trace)
         self.__pending()
 
+    def __trace(self, addr, msg, trace):
+        '''
+        Remember the trace id of a message queued to addr.
+        '''
+        key = (addr, msg)
+        traces = self.traces.get(key)
+        if traces is None:
+            traces = self.traces[key] = collections.deque()
+        traces.append(trace)
+        self.traced += 1
+        while self.traced > MAX_TRACED:
+            key, traces = self.traces.popitem(last=False)
+            self.traced -= len(traces)
+
+    def __untrace(self, addr, msg):
+        '''
+        Return the trace id of the oldest copy of a message queued to
+        addr, or None.
+        '''
+        key = (addr, msg)
+        traces = self.traces.get(key)
+        if not traces:
+            return None
+        trace = traces.popleft()
+        self.traced -= 1
+        if not traces:
+            del self.traces[key]
+        return trace
+
+    def __disconnected(self, event):
+        '''
+        Hand the queued messages to the agent so they can be sent over
+        another connection while this one reconnects.
+        '''
+        log.warning('%s: disconnected from %s:%s', self.name,
+                    *self.server_addr)
+        self.up = False
+        backlog = []
+        for recipient in self.rooms.values():
+            recipient.state = UNKNOWN
+        for recipient in self.recipients.values() + self.rooms.values():
+            msgs = recipient.drain()
+            if msgs:
+                backlog.append((recipient.addr, msgs))
+        if backlog and self.failover:
+            self.failover(self, backlog)
+
     def __wait(self):
         '''
         '''
@@ -142,14 +685,64 @@ class JabberAgent(Agent, sleekxmpp.ClientXMPP):
         log.trace('_pending: %s recipients have msgs to send',
                     len(self.pending))
         while self.pending:
-            for recipient in self.recipients.values():
+            for recipient in self.pending:
                 if self.__throttled():
                     return
-                if len(recipient.msgs) > 0:
-                    addr = recipient.addr
-                    msg = recipient.get_msg()
-                    log.trace('send to %s: %s', addr, msg)
-                    self.send_message(mto=addr, mbody=msg, mtype='chat')
+                addr = recipient.addr
+                msgs = recipient.get_msgs(self.coalesce_msgs,
+                                          self.coalesce_size,
+                                          len(COALESCE_SEPARATOR))
+                if msgs:
+                    self.__send(addr, msgs)
+
+    def __send(self, addr, msgs):
+        '''
+        Send one or more messages to addr in a single stanza.
+        '''
+        body = COALESCE_SEPARATOR.join(msgs)
+        log.trace('send to %s: %s', addr, body)
+        if addr in self.rooms:
+            mtype = 'groupchat'
+        else:
+            mtype = 'chat'
+        stanza = self.make_message(mto=addr, mbody=body, mtype=mtype)
+        receipt = self.receipts_enabled and mtype == 'chat'
+        if len(msgs) > 1 or receipt:
+            stanza['id'] = self.new_id()
+        if len(msgs) > 1:
+            self.coalesced[stanza['id']] = msgs
+            while len(self.coalesced) > MAX_COALESCED_SENT:
+                self.coalesced.popitem(last=False)
+        if receipt:
+            stanza['request_receipt'] = True
+        stanza.send()
+        if self.rate is not None:
+            self.rate.success()
+        now = time.time()
+        traces = [self.__untrace(addr, msg) for msg in msgs]
+        for trace in traces:
+            # with a receipt, the total latency is sampled on receipt
+            salt.ext.alert.latency.sent(trace, self.protocol, now,
+                                        total=not receipt)
+        if receipt:
+            self.receipts[stanza['id']] = (now, traces)
+            while len(self.receipts) > MAX_TRACED:
+                self.receipts.popitem(last=False)
+
+    def __receipt(self, event):
+        '''
+        Sample the receipt latency of the alerts in an acknowledged
+        stanza.
+        '''
+        sent = self.receipts.pop(event['receipt'], None)
+        if sent is None:
+            return
+        log.trace('receipt from %s for %s', event['from'], event['receipt'])
+        now = time.time()
+        sent_time, traces = sent
+        for trace in traces:
+            salt.ext.alert.latency.receipt(trace, self.protocol, sent_time,
+                                           now)
 
     def __throttled(self):
         '''
@@ -172,41 +765,46 @@ class JabberAgent(Agent, sleekxmpp.ClientXMPP):
             self.last_send_time = now
         return False
 
-    def __connect(self):
-        '''
-        Connect to the Jabber server.
-        '''
-        log.debug('connecting to {}:{}'.format(*self.server_addr))
-        if not self.connect(self.server_addr):
-            raise JabberError('connect failed: {}:{}'
-                                .format(*self.server_addr))
-
-        # Process Jabber messages forever in a background thread
-        self.process(block=False)
-
     def __start(self, event):
         '''
         When we connect to the Jabber server announce our presence and
         request our (buddies) roster.
         '''
+        self.up = True
         self.send_presence()
+        for recipient in self.rooms.values():
+            self.__join(recipient)
+        # recipients that authorized us before are ready without waiting
+        # for the roster
+        for recipient in self.recipients.values():
+            if recipient.state == UNKNOWN and \
+                    self.roster_cache.authorized(recipient.addr):
+                log.trace('%s authorized (cached)', recipient.addr)
+                recipient.state = READY
+        self.__pending()
         self.get_roster()
 
     def __roster(self, event):
         '''
-        At startup, set the recipient's state based on the roster.
+        Reconcile the recipients' states with the roster.  Only recipients
+        whose state is unknown or whose cached authorization was revoked
+        are updated.
         '''
         if log.isEnabledFor(salt.log.TRACE):
             roster = [addr for addr in self.client_roster]
             log.trace('roster changed: %s', roster)
         for recipient in self.recipients.values():
-            if recipient.state == UNKNOWN:
-                if recipient.addr in self.client_roster:
-                    roster_item = self.client_roster[recipient.addr]
-                else:
-                    roster_item = None
+            if recipient.addr in self.client_roster:
+                roster_item = self.client_roster[recipient.addr]
+            else:
+                roster_item = None
+            if recipient.state == READY:
+                if roster_item is None or not roster_item['to']:
+                    log.debug('%s revoked authorization', recipient.addr)
+                    recipient.state = UNKNOWN
+                    self.__set_state(recipient, roster_item)
+            elif recipient.state == UNKNOWN:
                 self.__set_state(recipient, roster_item)
-#        self.del_event_handler('roster_update', self.__roster)
         self.__pending()
 
     def __presence(self, event):
@@ -225,6 +823,7 @@ class JabberAgent(Agent, sleekxmpp.ClientXMPP):
                 self.send_presence(pto=addr, ptype='subscribed')
             elif etype in ['subscribed', 'available']:
                 recipient.state = READY
+                self.__cache_state(recipient)
                 self.__pending()
 
     def __subscription(self, event):
@@ -242,23 +841,39 @@ class JabberAgent(Agent, sleekxmpp.ClientXMPP):
 
     def __message(self, event):
         '''
-        Handle 'service-unavailable' error by requeueing message and
-        temporarily suspending message sending.
+        Handle 'service-unavailable' and other throttling errors by
+        requeueing the message, slowing down and temporarily suspending
+        message sending.
         '''
         if event['type'] == 'error':
             addr = event['from'].bare
             condition = event['error'].get_condition()
             log.error('%s: %s', addr, condition)
-            if condition == 'service-unavailable':
-                recipient = self.recipients.get(addr)
+            room = self.rooms.get(addr)
+            if room and condition in ['forbidden', 'not-acceptable',
+                                      'item-not-found']:
+                # we are not (or no longer) in the room
+                for msg in _error_msgs(self.coalesced, event):
+                    room.readd_msg(msg)
+                room.state = UNKNOWN
+                self.__schedule_rejoin()
+            elif condition in THROTTLE_CONDITIONS:
+                recipient = self.recipients.get(addr) or room
                 if recipient:
-                    msg = event.get('body')
-                    log.debug('resend to %s: %s', addr, msg)
-                    recipient.readd_msg(msg)
-                    self.service_down = True
-                    self.schedule('service-down',
-                                  self.retry_service_wait,
-                                  self.__retry_service)
+                    for msg in _error_msgs(self.coalesced, event):
+                        log.debug('resend to %s: %s', addr, msg)
+                        recipient.readd_msg(msg)
+                    if self.rate is None:
+                        wait = self.retry_service_wait
+                    else:
+                        self.rate.failure()
+                        wait = self.rate.retry_in(self.retry_service_wait)
+                    if not self.service_down:
+                        log.debug('%s: pause sending for %.1f seconds, %s',
+                                  self.name, wait, self.rate)
+                        self.service_down = True
+                        self.schedule('service-down', wait,
+                                      self.__retry_service)
 
     def __set_state(self, recipient, roster_item=None):
         '''
@@ -273,18 +888,49 @@ class JabberAgent(Agent, sleekxmpp.ClientXMPP):
                     recipient.addr, recipient.state, can_send, pending_out)
         if can_send:
             recipient.state = READY
+            self.__cache_state(recipient)
             self.__pending()
         elif recipient.state == UNKNOWN:
-            # always send a subscription request at restart
-            log.trace('send presence to %s (startup)', recipient.addr)
+            subscribed = self.roster_cache.subscribed_since(recipient.addr)
             recipient.state = WAITING_FOR_AUTHZ
-            self.send_presence(pto=recipient.addr, ptype='subscribe')
+            if subscribed and time.time() - subscribed < self.resubscribe_wait:
+                # a request is still outstanding from a previous run
+                log.trace('subscription to %s pending since %s',
+                            recipient.addr, subscribed)
+            else:
+                log.trace('send presence to %s (startup)', recipient.addr)
+                self.__subscribe(recipient)
         elif not pending_out and recipient.state != WAITING_FOR_AUTHZ:
             log.trace('send presence to %s', recipient.addr)
             recipient.state = WAITING_FOR_AUTHZ
-            self.send_presence(pto=recipient.addr, ptype='subscribe')
+            self.__subscribe(recipient)
+
+    def __subscribe(self, recipient):
+        '''
+        Send a subscription request to the recipient.
+        '''
+        self.send_presence(pto=recipient.addr, ptype='subscribe')
+        self.__cache_state(recipient, time.time())
+
+    def __cache_state(self, recipient, timestamp=None):
+        '''
+        Record the recipient's state in the roster cache and schedule
+        a save.  Saves are batched so a roster full of changes is
+        written once.
+        '''
+        self.roster_cache.update(recipient.addr, recipient.state, timestamp)
+        if self.roster_cache.dirty and not self.roster_save_scheduled:
+            self.roster_save_scheduled = True
+            self.schedule('save-roster', ROSTER_SAVE_DELAY,
+                          self.__save_roster)
+
+    def __save_roster(self):
+        '''
+        '''
+        self.roster_save_scheduled = False
+        self.roster_cache.save()
 
-def load_agents(config):
+def load_agents(config, opts):
     '''
     Load all jabber agents.
     '''
@@ -296,5 +942,5 @@ def load_agents(config):
         if message and 'message' not in value:
             value = value.copy()
             value['message'] = message
-        agents[key] = JabberAgent(key, value)
+        agents[key] = JabberAgent(key, value, opts.get('cachedir'))
     return agents
@@ -0,0 +1,338 @@
+import collections
+import httplib
+import json
+import socket
+import threading
+import time
+import urlparse
+
+import salt.log
+import salt.ext.alert.engine
+import salt.ext.alert.latency
+import salt.ext.alert.scheduler
+
+from .agent import Agent
+
+DEFAULT_BATCH_WAIT      = 1.0
+DEFAULT_MAX_BATCH       = 100
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_MAX_QUEUED      = 1000
+DEFAULT_RETRIES         = 3
+DEFAULT_RETRY_WAIT      = 1.0
+DEFAULT_TIMEOUT         = 10
+DEFAULT_HEADERS         = {}
+
+log = salt.log.getLogger(__name__)
+
+class Endpoint(object):
+    '''
+    A URL that alerts are POSTed to.  Alerts are collected into a batch
+    until the batch is full or batch_wait seconds pass.
+    '''
+    def __init__(self, url):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme not in ['http', 'https'] or not parsed.hostname:
+            raise ValueError('invalid webhook url: {}'.format(url))
+        self.url = url
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        self.batch = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return self.url
+
+    def __cmp__(self, other):
+        return cmp(self.url, other.url)
+
+    def __hash__(self):
+        return hash(self.url)
+
+    @property
+    def server(self):
+        '''
+        The key of the connection pool used for this endpoint.
+        '''
+        return (self.scheme, self.host, self.port)
+
+class WebhookAgent(Agent):
+    '''
+    An agent that POSTs batches of salt alerts as JSON to HTTP endpoints.
+    At most max_connections batches are POSTed at once, on the delivery
+    engine's workers, over persistent (keep-alive) connections to the
+    endpoints' servers.
+
+    >>> import BaseHTTPServer, SocketServer, re
+    >>> posted = []
+    >>> class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ...     protocol_version = 'HTTP/1.1'
+    ...     def do_POST(self):
+    ...         length = int(self.headers['Content-Length'])
+    ...         posted.append((self.path, json.loads(self.rfile.read(length))))
+    ...         self.send_response(204)
+    ...         self.send_header('Content-Length', '0')
+    ...         self.end_headers()
+    ...     def log_message(self, *args):
+    ...         pass
+    >>> class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ...     daemon_threads = True
+    >>> server = Server(('127.0.0.1', 0), Handler)
+    >>> serving = threading.Thread(target=server.serve_forever)
+    >>> serving.daemon = True
+    >>> serving.start()
+    >>> url = 'http://127.0.0.1:{}/api'.format(server.server_port)
+    >>> agent = WebhookAgent('incidents', {'url': url, 'batch_wait': 60})
+    >>> agent.add_subscriber(re.compile('.*'), '/alerts')
+    >>> for i in range(3):
+    ...     d = agent.deliver({'category': 'disk', 'severity': 'error', 'msg': i})
+    >>> agent.flush()
+    >>> [(path, [alert['msg'] for alert in alerts]) for path, alerts in posted]
+    [('/api/alerts', [0, 1, 2])]
+
+    # a keep-alive connection the server closed is replaced at once,
+    # without waiting for a retry
+    >>> class Closed(object):
+    ...     def request(self, *args):
+    ...         raise httplib.BadStatusLine("''")
+    ...     def close(self):
+    ...         pass
+    >>> agent.idle[('http', '127.0.0.1', server.server_port)] = [Closed()]
+    >>> agent.retries = 0
+    >>> d = agent.deliver({'category': 'disk', 'severity': 'error', 'msg': 3})
+    >>> agent.flush()
+    >>> [alert['msg'] for alert in posted[-1][1]]
+    [3]
+    >>> server.shutdown()
+    '''
+    def __init__(self, protocol, config):
+        '''
+        Configure the agent from YAML data parsed from /etc/salt/alert.
+        '''
+        Agent.__init__(self, protocol)
+        self.url = config.get('url', '')
+        self.headers = dict(DEFAULT_HEADERS)
+        self.headers.update(config.get('headers', {}))
+        self.headers['Content-Type'] = 'application/json'
+        self.batch_wait = config.get('batch_wait', DEFAULT_BATCH_WAIT)
+        self.max_batch = max(config.get('max_batch', DEFAULT_MAX_BATCH), 1)
+        self.max_connections = max(config.get('max_connections',
+                                              DEFAULT_MAX_CONNECTIONS), 1)
+        self.retries = config.get('retries', DEFAULT_RETRIES)
+        self.retry_wait = config.get('retry_wait', DEFAULT_RETRY_WAIT)
+        self.timeout = config.get('timeout', DEFAULT_TIMEOUT)
+        self.endpoints = {}
+        self.max_queued = config.get('max_queued', DEFAULT_MAX_QUEUED)
+        self.sendq = collections.deque()
+        self.sending = 0
+        self.send_lock = threading.Lock()
+        self.sent = threading.Condition(self.send_lock)
+        # idle keep-alive connections per server
+        self.idle = collections.defaultdict(list)
+        log.trace('webhook %s: url=%s batch_wait=%s max_batch=%s '
+                  'max_connections=%s', protocol, self.url, self.batch_wait,
+                  self.max_batch, self.max_connections)
+
+    def _parse_subscriber(self, subscriber):
+        '''
+        Parse the subscriber string into the structure needed by _deliver().
+        A subscriber is a URL, or a path relative to the agent's url.
+        '''
+        if '://' in subscriber:
+            url = subscriber
+        else:
+            url = self.url.rstrip('/') + '/' + subscriber.lstrip('/')
+        endpoint = self.endpoints.get(url)
+        if endpoint is None:
+            endpoint = Endpoint(url)
+            self.endpoints[url] = endpoint
+        return endpoint
+
+    def _deliver_async(self, endpoints, alert):
+        '''
+        Batching never blocks, so deliver inline.
+        '''
+        self._deliver(endpoints, alert)
+        return salt.ext.alert.engine.succeed()
+
+    def _deliver(self, endpoints, alert):
+        '''
+        Add the alert to each endpoint's batch.  A batch is sent when it
+        is full or batch_wait seconds after its first alert.
+        '''
+        alert = dict(alert)
+        for endpoint in endpoints:
+            with endpoint.lock:
+                endpoint.batch.append(alert)
+                if len(endpoint.batch) >= self.max_batch:
+                    self.__submit(endpoint)
+                elif endpoint.timer is None:
+                    endpoint.timer = salt.ext.alert.scheduler.schedule(
+                            self.batch_wait, self.__timeout, endpoint)
+
+    def _render(self, endpoints, alert):
+        '''
+        Return the alert POSTed to each endpoint, without sending it.
+        '''
+        body = json.dumps(alert, default=str)
+        return [(endpoint.url, body) for endpoint in endpoints]
+
+    def flush(self):
+        '''
+        Send all batched alerts and wait until they are sent.
+        '''
+        for endpoint in self.endpoints.values():
+            with endpoint.lock:
+                self.__submit(endpoint)
+        with self.send_lock:
+            while self.sending or self.sendq:
+                self.sent.wait()
+
+    def __timeout(self, endpoint):
+        with endpoint.lock:
+            endpoint.timer = None
+            self.__submit(endpoint)
+
+    def __submit(self, endpoint):
+        '''
+        Queue the endpoint's batch for sending.  Must hold the endpoint's
+        lock.  This method never blocks: if max_queued batches are
+        waiting, the batch is dropped.
+        '''
+        if endpoint.timer is not None:
+            endpoint.timer.cancel()
+            endpoint.timer = None
+        if not endpoint.batch:
+            return
+        batch = endpoint.batch
+        endpoint.batch = []
+        with self.send_lock:
+            if len(self.sendq) >= self.max_queued:
+                log.error('webhook %s: send queue full, drop %s alert(s) '
+                          'to %s', self.protocol, len(batch), endpoint)
+                return
+            self.sendq.append((endpoint, batch))
+            self.__start_sends()
+
+    def __start_sends(self):
+        '''
+        Start sending queued batches, up to max_connections at once.
+        Must hold the send lock.
+        '''
+        while self.sendq and self.sending < self.max_connections:
+            endpoint, batch = self.sendq.popleft()
+            self.sending += 1
+            salt.ext.alert.engine.submit_nowait(self.__send, endpoint, batch)
+
+    def __send(self, endpoint, batch, attempt=0):
+        '''
+        Send a batch, then start the next queued one.  Retries wait on
+        the scheduler, not on the worker.  This method runs on a delivery
+        engine worker.
+        '''
+        try:
+            retry = self.__post(endpoint, batch)
+        except Exception, ex:
+            log.error('webhook %s: failed to send to %s', self.protocol,
+                      endpoint, exc_info=ex)
+            retry = False
+        if retry:
+            if attempt < self.retries:
+                salt.ext.alert.scheduler.schedule(
+                        self.retry_wait * (2 ** attempt),
+                        salt.ext.alert.engine.submit_nowait,
+                        self.__send, endpoint, batch, attempt + 1)
+                return
+            log.error('webhook %s: drop %s alert(s) to %s after %s '
+                      'attempt(s)', self.protocol, len(batch), endpoint,
+                      attempt + 1)
+        with self.send_lock:
+            self.sending -= 1
+            self.__start_sends()
+            self.sent.notify_all()
+
+    def __checkout(self, endpoint):
+        '''
+        Return an idle connection to the endpoint's server, or a new one,
+        and whether the connection is idle.
+        '''
+        with self.send_lock:
+            idle = self.idle[endpoint.server]
+            if idle:
+                return idle.pop(), True
+        return self.__connect(endpoint), False
+
+    def __connect(self, endpoint):
+        '''
+        Return a new connection to the endpoint's server.
+        '''
+        if endpoint.scheme == 'https':
+            return httplib.HTTPSConnection(endpoint.host, endpoint.port,
+                                           timeout=self.timeout)
+        return httplib.HTTPConnection(endpoint.host, endpoint.port,
+                                      timeout=self.timeout)
+
+    def __checkin(self, endpoint, conn):
+        with self.send_lock:
+            self.idle[endpoint.server].append(conn)
+
+    def __post(self, endpoint, batch):
+        '''
+        POST a batch of alerts.  Return True if it should be retried:
+        after a connection error, a server error or a throttling (429)
+        response.
+        '''
+        body = json.dumps(batch, default=str)
+        conn, reused = self.__checkout(endpoint)
+        try:
+            try:
+                conn.request('POST', endpoint.path, body, self.headers)
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error), ex:
+                if not reused or isinstance(ex, socket.timeout):
+                    raise
+                # the server closed the idle connection before answering
+                log.debug('webhook %s: reconnect to %s: %s', self.protocol,
+                          endpoint, ex)
+                conn.close()
+                conn = self.__connect(endpoint)
+                conn.request('POST', endpoint.path, body, self.headers)
+                resp = conn.getresponse()
+            resp.read()
+        except (httplib.HTTPException, socket.error), ex:
+            log.warning('webhook %s: POST %s failed: %s',
+                        self.protocol, endpoint, ex)
+            conn.close()
+            return True
+        if resp.getheader('connection', '').lower() == 'close':
+            conn.close()
+        else:
+            self.__checkin(endpoint, conn)
+        if 200 <= resp.status < 300:
+            log.trace('webhook %s: sent %s alert(s) to %s',
+                      self.protocol, len(batch), endpoint)
+            now = time.time()
+            for alert in batch:
+                salt.ext.alert.latency.sent(alert.get('trace'),
+                                            self.protocol, now)
+            return False
+        if resp.status == 429 or resp.status >= 500:
+            log.warning('webhook %s: POST %s: %s %s', self.protocol,
+                        endpoint, resp.status, resp.reason)
+            return True
+        log.error('webhook %s: POST %s rejected: %s %s', self.protocol,
+                  endpoint, resp.status, resp.reason)
+        return False
+
+def load_agents(config, opts):
+    '''
+    Load all webhook agents.
+    '''
+    agents = {}
+    for key, value in config.iteritems():
+        agents[key] = WebhookAgent(key, value)
+    return agents
@@ -1,5 +1,8 @@
+import salt.ext.alert.engine
 import salt.log
 
+from salt.ext.alert.router import Router
+
 log = salt.log.getLogger(__name__)
 
 class Agent(object):
@@ -10,31 +13,33 @@ class Agent(object):
         Create an agent with an empty distribution list.
         '''
         self.protocol = protocol
-        self.distrib_lists = {}
+        self.router = Router()
 
     def __str__(self):
         '''
         A string suitable for debugging.
         '''
         lines = []
-        for regex, addrs in self.distrib_lists.iteritems():
-            fulladdrs = [':'.join([self.protocol, addr]) for addr in addrs]
-            lines.append(': '.join([regex.pattern, ', '.join(fulladdrs)]))
+        for rule in self.router:
+            fulladdrs = [':'.join([self.protocol, str(addr)])
+                            for addr in rule.addrs]
+            lines.append(': '.join([rule.pattern, ', '.join(fulladdrs)]))
         return '\n'.join(lines)
 
     def has_subscribers(self):
         '''
         '''
-        return len(self.distrib_lists) > 0
+        return len(self.router) > 0
 
-    def add_subscriber(self, regex, addr):
+    def add_subscriber(self, regex, addr, filters=None):
         '''
+        Subscribe addr to the alerts whose category/severity matches
+        regex and whose fields match the filters, a dict of field names
+        and lists of values or globs.
         '''
-        log.trace('add %s subscriber: pattern="%s" address="%s"',
-                  self.protocol, regex.pattern, addr)
-        if regex not in self.distrib_lists:
-            self.distrib_lists[regex] = set()
-        self.distrib_lists[regex].add(self._parse_subscriber(addr))
+        log.trace('add %s subscriber: pattern="%s" filters=%s address="%s"',
+                  self.protocol, regex.pattern, filters, addr)
+        self.router.add(regex, self._parse_subscriber(addr), filters)
 
     def _parse_subscriber(self, subscriber):
         '''
@@ -42,17 +47,31 @@ class Agent(object):
         '''
         return subscriber
 
-    def deliver(self, alert):
+    def match(self, alert):
+        '''
+        Return a dict of the subscription rules that match the alert
+        and their subscribers.
+        '''
+        return self.router.match(alert)
+
+    def subscribers(self, alert):
         '''
+        Return the sorted list of the alert's subscribers.
         '''
-        condition = '/'.join([alert.get('category', 'unknown'),
-                              alert.get('severity', 'unknown')])
         subscribers = set()
-        for regex, addrs in self.distrib_lists.iteritems():
-            if regex.match(condition):
-                subscribers.update(addrs)
+        for addrs in self.match(alert).itervalues():
+            subscribers.update(addrs)
+        return sorted(subscribers)
+
+    def deliver(self, alert):
+        '''
+        Deliver the alert to its subscribers.  Return a Deferred that
+        completes when the alert is delivered.
+        '''
+        subscribers = self.subscribers(alert)
         if len(subscribers) > 0:
-            self._deliver(sorted(subscribers), alert)
+            return self._deliver_async(subscribers, alert)
+        return salt.ext.alert.engine.succeed()
 
     def _deliver(self, subscribers, alert):
         '''
@@ -61,3 +80,28 @@ class Agent(object):
         raise NotImplementedError( '.'.join([self.__module__,
                                              self.__class__.__name__,
                                              '_deliver()']))
+
+    def _deliver_async(self, subscribers, alert):
+        '''
+        Deliver the alert without blocking the caller, and return a
+        Deferred.  By default the blocking _deliver() runs on the
+        delivery engine's workers.  Agents whose _deliver() never blocks
+        override this to call it inline.
+        '''
+        return salt.ext.alert.engine.submit(self._deliver, subscribers, alert)
+
+    def _render(self, subscribers, alert):
+        '''
+        Return the messages _deliver() would send, a list of
+        (recipient, message) tuples, without sending them.  Used by
+        dry runs.
+        '''
+        return [(str(subscriber), '') for subscriber in subscribers]
+
+    def _send_interval(self, recipient):
+        '''
+        Return the throttle that delays messages to the recipient: a
+        (channel, seconds) tuple, where messages on the same channel are
+        sent at least seconds apart.  Used by dry runs.
+        '''
+        return (None, 0)
@@ -0,0 +1,143 @@
+import threading
+import time
+
+import salt.log
+
+DEFAULT_INCREASE = 0.2
+DEFAULT_DECREASE = 0.5
+MIN_RATE = 0.01         # the lowest rate allowed, one message per 100 s
+
+log = salt.log.getLogger(__name__)
+
+class AIMDRate(object):
+    '''
+    A send rate, in messages per second, that adapts to what the server
+    tolerates: additive increase while sends succeed, multiplicative
+    decrease when the server pushes back.  The rate stays between
+    min_rate and max_rate; if they are equal the rate is fixed.  A
+    min_rate that is not positive is raised to MIN_RATE, so the rate
+    never drops to zero.
+
+    >>> r = AIMDRate('jabber', 1.0, 0.5, 4.0, increase=1.0)
+    >>> r.interval
+    1.0
+
+    # each successful send adds increase / rate, so the rate grows by
+    # about increase msgs/sec per second of successful sends
+    >>> for now in range(3):
+    ...     r.success(now)
+    >>> round(r.rate, 2)
+    2.9
+
+    # one decrease per holdoff, however many errors arrive for messages
+    # already sent
+    >>> r.failure(now=10), r.failure(now=10.1)
+    (True, False)
+    >>> round(r.rate, 2), round(r.retry_in(30), 2)
+    (1.45, 0.69)
+
+    # consecutive pushback doubles the pause, up to the limit
+    >>> r.failure(now=20), round(r.retry_in(30), 2), round(r.rate, 2)
+    (True, 2.76, 0.72)
+    >>> r.failure(now=30), r.retry_in(3), r.rate
+    (True, 3, 0.5)
+
+    # a rate of zero would never send
+    >>> r = AIMDRate('jabber', 0, 0, 10)
+    >>> r.rate == MIN_RATE, r.interval
+    (True, 100.0)
+    >>> r.failure(now=0), r.rate == MIN_RATE
+    (True, True)
+    '''
+    def __init__(self, name, rate, min_rate, max_rate,
+                 increase=DEFAULT_INCREASE, decrease=DEFAULT_DECREASE):
+        '''
+        name     = the name of the connection, used for logging
+        rate     = the starting rate
+        min_rate = the lowest rate
+        max_rate = the highest rate
+        increase = messages per second added for every second of
+                   successful sends
+        decrease = the factor applied to the rate when the server
+                   pushes back
+        '''
+        self.name = name
+        if min_rate <= 0:
+            log.warning('%s: minimum rate %s is not positive, use %s '
+                        'msgs/sec', name, min_rate, MIN_RATE)
+            min_rate = MIN_RATE
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.rate = min(max(rate, self.min_rate), self.max_rate)
+        self.increase = increase
+        self.decrease = min(max(decrease, 0.01), 1.0)
+        self.consecutive = 0
+        self.decreased = None
+        self.holdoff = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return '{} [{:.2f} msgs/sec]'.format(self.name, self.rate)
+
+    @property
+    def adaptive(self):
+        return self.min_rate < self.max_rate
+
+    @property
+    def interval(self):
+        '''
+        The seconds between sends.
+        '''
+        return 1.0 / self.rate
+
+    def success(self, now=None):
+        '''
+        Record a successful send.
+        '''
+        with self.lock:
+            if now is None:
+                now = time.time()
+            if self.decreased is not None and \
+                    now - self.decreased < self.holdoff:
+                return
+            self.consecutive = 0
+            if self.rate < self.max_rate:
+                self.rate = min(self.rate + self.increase / self.rate,
+                                self.max_rate)
+
+    def failure(self, now=None):
+        '''
+        Record server pushback.  Errors about messages sent before the
+        last decrease arrive within the holdoff and are ignored.  Return
+        True if the rate was decreased.
+        '''
+        with self.lock:
+            if now is None:
+                now = time.time()
+            if self.decreased is not None and \
+                    now - self.decreased < self.holdoff:
+                return False
+            # wait until the messages in flight at the old rate are
+            # answered before decreasing again
+            self.holdoff = max(2 * self.interval, 1.0)
+            self.decreased = now
+            self.consecutive += 1
+            old = self.rate
+            self.rate = max(self.rate * self.decrease, self.min_rate)
+            if self.rate != old:
+                log.debug('%s: decrease rate from %.2f to %.2f msgs/sec',
+                          self.name, old, self.rate)
+            return True
+
+    def retry_in(self, limit):
+        '''
+        Return the seconds to pause sending after pushback: the send
+        interval, doubled for each consecutive pushback, up to limit.
+        '''
+        with self.lock:
+            return min(self.interval * 2 ** max(self.consecutive - 1, 0),
+                       limit)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
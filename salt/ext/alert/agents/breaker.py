@@ -0,0 +1,112 @@
+import threading
+import time
+
+import salt.log
+
+CLOSED    = 'CLOSED'    # calls are allowed
+OPEN      = 'OPEN'      # calls fail fast
+HALF_OPEN = 'HALF-OPEN' # one probe call is allowed
+
+DEFAULT_FAILURES = 3
+DEFAULT_RESET    = 30
+
+log = salt.log.getLogger(__name__)
+
+class CircuitBreaker(object):
+    '''
+    A circuit breaker that stops calls to a failing service.
+    After a number of consecutive failures the breaker opens and calls
+    fail fast.  After reset seconds, the breaker is half-open and allows
+    a single probe call.  If the probe succeeds the breaker closes,
+    otherwise it opens again.
+
+    >>> b = CircuitBreaker('smtp.example.com', failures=2, reset=10)
+    >>> b.allow(now=0)
+    True
+    >>> b.failure(now=0)
+    >>> b.failure(now=1)
+    >>> b.state, b.allow(now=5)
+    ('OPEN', False)
+
+    # after reset seconds, only one probe is allowed
+    >>> b.allow(now=11), b.allow(now=11)
+    (True, False)
+    >>> b.success()
+    >>> b.state, b.allow(now=12)
+    ('CLOSED', True)
+    '''
+    def __init__(self, name, failures=DEFAULT_FAILURES, reset=DEFAULT_RESET):
+        '''
+        Create a closed breaker.
+
+        name     = the name of the service, used for logging
+        failures = the number of consecutive failures that open the breaker
+        reset    = the number of seconds the breaker stays open before a
+                   probe call is allowed
+        '''
+        self.name = name
+        self.failures = max(failures, 1)
+        self.reset = reset
+        self.state = CLOSED
+        self.consecutive = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return '{} [{}]'.format(self.name, self.state)
+
+    def allow(self, now=None):
+        '''
+        Return True if a call may be made now.
+        '''
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN:
+                # a probe is already in progress
+                return False
+            if now is None:
+                now = time.time()
+            if now - self.opened >= self.reset:
+                log.debug('%s: half-open, probing', self.name)
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def retry_in(self, now=None):
+        '''
+        Return the number of seconds until a call will be allowed.
+        '''
+        with self.lock:
+            if self.state != OPEN:
+                return 0
+            if now is None:
+                now = time.time()
+            return max(self.opened + self.reset - now, 0)
+
+    def success(self):
+        '''
+        Record a successful call.
+        '''
+        with self.lock:
+            if self.state != CLOSED:
+                log.info('%s: closed', self.name)
+            self.state = CLOSED
+            self.consecutive = 0
+
+    def failure(self, now=None):
+        '''
+        Record a failed call.
+        '''
+        with self.lock:
+            self.consecutive += 1
+            if self.state == HALF_OPEN or self.consecutive >= self.failures:
+                if self.state != OPEN:
+                    log.warning('%s: open after %s failure(s)',
+                                self.name, self.consecutive)
+                self.state = OPEN
+                self.opened = now if now is not None else time.time()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,14 +1,547 @@
 #!/usr/bin/env python2
 
+import array
 import collections
+import marshal
+import threading
 import time
+import zlib
 
 import salt.log
+import salt.ext.alert.budget
+from salt.ext.alert.budget import msg_size, MSG_OVERHEAD
 
 READY = 'READY'         # recipient ready to receive messages
 
+DEFAULT_RING_CAPACITY = 1024
+DEFAULT_COLD_BLOCK = 64
+NO_TIME = float('nan')  # the array slot of a message without a timestamp
+
 log = salt.log.getLogger(__name__)
 
+class PendingSet(object):
+    '''
+    A thread-safe set of recipients that have messages to send.
+    Iterating over the set iterates over a snapshot, so recipients can
+    add and remove themselves from other threads while the set is being
+    iterated.
+
+    >>> pending = PendingSet()
+    >>> r = Recipient('recipient@example.com', pending=pending)
+    >>> r.add_msg('msg 1')
+    >>> pending
+    PendingSet([recipient@example.com])
+    >>> for recipient in pending:
+    ...     print recipient.get_msg()
+    msg 1
+    >>> len(pending)
+    0
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = set()
+
+    def __repr__(self):
+        with self.lock:
+            return 'PendingSet({})'.format(sorted(self.members))
+
+    def __len__(self):
+        return len(self.members)
+
+    def __nonzero__(self):
+        return len(self.members) > 0
+
+    def __contains__(self, recipient):
+        return recipient in self.members
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.members))
+
+    def add(self, recipient):
+        with self.lock:
+            self.members.add(recipient)
+
+    def discard(self, recipient):
+        with self.lock:
+            self.members.discard(recipient)
+
+class MessageQueue(collections.deque):
+    '''
+    A recipient's queue of (timestamp, msg) tuples.  Like the other
+    queues, it counts the bytes of its messages in nbytes.
+
+    >>> q = MessageQueue(maxlen=2)
+    >>> for msg in ['a', 'bb', 'ccc']:
+    ...     q.append((0, msg))
+    >>> q.nbytes == msg_size('bb') + msg_size('ccc')
+    True
+    >>> q.popleft(), q.nbytes == msg_size('ccc')
+    ((0, 'bb'), True)
+    '''
+    def __init__(self, iterable=(), maxlen=None):
+        collections.deque.__init__(self, iterable, maxlen)
+        self.nbytes = sum(msg_size(msg) for timestamp, msg in self)
+
+    def append(self, item):
+        if self.maxlen and len(self) == self.maxlen:
+            # appending drops the oldest message
+            self.nbytes -= msg_size(self[0][1])
+        collections.deque.append(self, item)
+        self.nbytes += msg_size(item[1])
+
+    def popleft(self):
+        item = collections.deque.popleft(self)
+        self.nbytes -= msg_size(item[1])
+        return item
+
+    def __delitem__(self, index):
+        self.nbytes -= msg_size(self[index][1])
+        collections.deque.__delitem__(self, index)
+
+    def clear(self):
+        collections.deque.clear(self)
+        self.nbytes = 0
+
+    def readd(self, index, item):
+        '''
+        Insert a requeued item before the item at index.
+        '''
+        self.rotate(-index)
+        self.appendleft(item)
+        self.rotate(index)
+        self.nbytes += msg_size(item[1])
+
+class MessageRing(object):
+    '''
+    Queued messages shared by many recipients.  Each message is stored
+    once, in arrays indexed by a sequence number, however many recipients
+    it is queued to.  A message is freed when the last recipient removes
+    it.  A message added for several recipients in a row, e.g. a
+    broadcast, gets one sequence number.  The ring charges the memory
+    budget for the text of each message once; the recipients' queues
+    only charge the overhead of their entries.
+
+    >>> ring = MessageRing(capacity=2)
+    >>> msg = 'broadcast'
+    >>> ring.add(1, msg), ring.add(1, msg), ring.add(2, 'other')
+    (0, 0, 1)
+    >>> ring.get(0), len(ring)
+    ((1.0, 'broadcast'), 2)
+    >>> ring.release(0)
+    >>> len(ring)
+    2
+    >>> ring.release(0)
+    >>> len(ring), sorted(ring.stats().items())
+    (1, [('capacity', 2), ('messages', 1)])
+
+    # a broadcast to many recipients is counted once
+    >>> budget = salt.ext.alert.budget.Budget()
+    >>> ring = MessageRing(budget=budget)
+    >>> recipients = [Recipient('r{}'.format(i), ring=ring, budget=budget)
+    ...                 for i in range(500)]
+    >>> msg = 'x' * 1000
+    >>> for recipient in recipients:
+    ...     recipient.add_msg(msg, timestamp=0)
+    >>> budget.bytes == len(msg) + 500 * MSG_OVERHEAD
+    True
+    >>> for recipient in recipients:
+    ...     recipient.drain() and None
+    >>> budget.bytes, len(ring)
+    (0, 0)
+    '''
+    def __init__(self, capacity=DEFAULT_RING_CAPACITY, budget=None):
+        self.lock = threading.Lock()
+        self.budget = budget or salt.ext.alert.budget.default()
+        self.capacity = max(capacity, 1)
+        self.msgs = [None] * self.capacity
+        self.times = array.array('d', [NO_TIME]) * self.capacity
+        self.refs = array.array('l', [0]) * self.capacity
+        # the sequence numbers of the oldest live and the next message
+        self.head = 0
+        self.tail = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def add(self, timestamp, msg):
+        '''
+        Add a reference to a message.  Return its sequence number.
+        '''
+        with self.lock:
+            if self.tail > self.head:
+                slot = (self.tail - 1) % self.capacity
+                if self.msgs[slot] is msg:
+                    last = self.times[slot]
+                    if last == timestamp or \
+                            (timestamp is None and last != last):
+                        self.refs[slot] += 1
+                        return self.tail - 1
+            if self.tail - self.head == self.capacity:
+                self.__grow()
+            slot = self.tail % self.capacity
+            self.msgs[slot] = msg
+            self.times[slot] = NO_TIME if timestamp is None else timestamp
+            self.refs[slot] = 1
+            self.tail += 1
+            self.budget.charge(None, len(msg))
+            return self.tail - 1
+
+    def get(self, seq):
+        '''
+        Return the (timestamp, msg) tuple of a message.
+        '''
+        with self.lock:
+            slot = seq % self.capacity
+            return (self.__time(slot), self.msgs[slot])
+
+    def release(self, seq):
+        '''
+        Remove a reference to a message.
+        '''
+        with self.lock:
+            slot = seq % self.capacity
+            self.refs[slot] -= 1
+            if self.refs[slot] > 0:
+                return
+            self.budget.charge(None, -len(self.msgs[slot]))
+            self.msgs[slot] = None
+            while self.head < self.tail and \
+                    self.refs[self.head % self.capacity] == 0:
+                self.head += 1
+
+    def stats(self):
+        '''
+        Return the number of messages held and the ring's capacity.
+        Released messages behind an older live one are held until it
+        is released.
+        '''
+        with self.lock:
+            return {'messages': self.tail - self.head,
+                    'capacity': self.capacity}
+
+    def __time(self, slot):
+        timestamp = self.times[slot]
+        if timestamp != timestamp:
+            return None
+        return timestamp
+
+    def __grow(self):
+        '''
+        Double the capacity.  Must hold the lock.
+        '''
+        capacity = self.capacity * 2
+        msgs = [None] * capacity
+        times = array.array('d', [NO_TIME]) * capacity
+        refs = array.array('l', [0]) * capacity
+        for seq in xrange(self.head, self.tail):
+            old, new = seq % self.capacity, seq % capacity
+            msgs[new] = self.msgs[old]
+            times[new] = self.times[old]
+            refs[new] = self.refs[old]
+        log.trace('grow message ring to %s messages', capacity)
+        self.capacity = capacity
+        self.msgs = msgs
+        self.times = times
+        self.refs = refs
+
+class RingQueue(object):
+    '''
+    A recipient's queue of messages held in a shared MessageRing.
+    The queue keeps runs of consecutive sequence numbers, so a recipient
+    that receives every message costs a couple of integers, and a short
+    list of requeued messages, which are sent first.  It behaves like
+    the deque of (timestamp, msg) tuples Recipient otherwise uses.
+
+    >>> ring = MessageRing()
+    >>> a, b = RingQueue(ring), RingQueue(ring, maxlen=2)
+    >>> for i in range(3):
+    ...     msg = 'msg {}'.format(i)
+    ...     a.append((i, msg))
+    ...     b.append((i, msg))
+    >>> len(ring), len(a), len(b), a.runs()
+    (3, 3, 2, 1)
+    >>> list(b)
+    [(1.0, 'msg 1'), (2.0, 'msg 2')]
+    >>> b.readd(0, (0, 'retry'))
+    >>> b[0], b[1], b[-1]
+    ((0, 'retry'), (1.0, 'msg 1'), (2.0, 'msg 2'))
+    >>> a.popleft(), len(ring)
+    ((0.0, 'msg 0'), 2)
+    >>> a.clear(); b.clear()
+    >>> len(ring)
+    0
+    '''
+    def __init__(self, ring, maxlen=None):
+        self.ring = ring
+        self.maxlen = maxlen
+        self.retries = collections.deque()
+        # runs of sequence numbers [starts[i], ends[i]) from first on
+        self.starts = array.array('l')
+        self.ends = array.array('l')
+        self.first = 0
+        self.count = 0
+        # the ring counts the messages; an entry costs its overhead
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.retries) + self.count
+
+    def __iter__(self):
+        for item in list(self.retries):
+            yield item
+        for run in xrange(self.first, len(self.starts)):
+            for seq in xrange(self.starts[run], self.ends[run]):
+                yield self.ring.get(seq)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('queue index out of range')
+        if index < len(self.retries):
+            return self.retries[index]
+        index -= len(self.retries)
+        if index == 0:
+            return self.ring.get(self.starts[self.first])
+        if index == self.count - 1:
+            return self.ring.get(self.ends[-1] - 1)
+        for run in xrange(self.first, len(self.starts)):
+            size = self.ends[run] - self.starts[run]
+            if index < size:
+                return self.ring.get(self.starts[run] + index)
+            index -= size
+
+    def __delitem__(self, index):
+        if index != 0:
+            raise IndexError('only the first message can be deleted')
+        self.popleft()
+
+    def runs(self):
+        '''
+        Return the number of runs of sequence numbers.
+        '''
+        return len(self.starts) - self.first
+
+    def append(self, item):
+        timestamp, msg = item
+        seq = self.ring.add(timestamp, msg)
+        if self.count and self.ends[-1] == seq:
+            self.ends[-1] += 1
+        else:
+            self.starts.append(seq)
+            self.ends.append(seq + 1)
+        self.count += 1
+        self.nbytes += MSG_OVERHEAD
+        if self.maxlen and len(self.retries) + self.count > self.maxlen:
+            self.popleft()
+
+    def readd(self, index, item):
+        '''
+        Requeue an item.  Requeued items are always the first in the
+        queue, so index is the number of requeued items.
+        '''
+        self.retries.append(item)
+        self.nbytes += msg_size(item[1])
+
+    def popleft(self):
+        if self.retries:
+            item = self.retries.popleft()
+            self.nbytes -= msg_size(item[1])
+            return item
+        if not self.count:
+            raise IndexError('pop from an empty queue')
+        seq = self.starts[self.first]
+        item = self.ring.get(seq)
+        self.starts[self.first] += 1
+        if self.starts[self.first] == self.ends[self.first]:
+            self.first += 1
+            if self.first == len(self.starts):
+                del self.starts[:]
+                del self.ends[:]
+                self.first = 0
+            elif self.first >= 32 and self.first * 2 >= len(self.starts):
+                del self.starts[:self.first]
+                del self.ends[:self.first]
+                self.first = 0
+        self.count -= 1
+        self.nbytes -= MSG_OVERHEAD
+        self.ring.release(seq)
+        return item
+
+    def clear(self):
+        self.retries.clear()
+        for run in xrange(self.first, len(self.starts)):
+            for seq in xrange(self.starts[run], self.ends[run]):
+                self.ring.release(seq)
+        del self.starts[:]
+        del self.ends[:]
+        self.first = 0
+        self.count = 0
+        self.nbytes = 0
+
+class ColdQueue(object):
+    '''
+    A recipient's queue that packs old messages into compressed blocks.
+    When block messages at the front of the queue are older than
+    cold_after seconds, measured from the newest message, they are
+    compressed together, so the redundancy between similar alerts is
+    compressed away.  A block is unpacked when the front of the queue
+    reaches it.  It behaves like the deque of (timestamp, msg) tuples
+    Recipient otherwise uses, and keeps the order of the messages.
+
+    Messages without a timestamp are never packed.  A packed block
+    counts its compressed size in nbytes.
+
+    >>> q = ColdQueue(cold_after=60, block=4)
+    >>> for i in range(10):
+    ...     q.append((i * 10, 'disk.full alert on web{}'.format(i)))
+    >>> len(q), q.cold, len(q.blocks)
+    (10, 0, 0)
+    >>> q.append((200, 'load.high alert on web10'))
+    >>> len(q), q.cold, len(q.blocks)
+    (11, 8, 2)
+
+    # the blocks are counted by their compressed size
+    >>> hot = sum(msg_size(msg) for t, msg in list(q)[8:])
+    >>> q.nbytes == hot + sum(msg_size(data) for t, n, data in q.blocks)
+    True
+    >>> q[0], q[5], q[-1]
+    ((0, 'disk.full alert on web0'), (50, 'disk.full alert on web5'), (200, 'load.high alert on web10'))
+    >>> [q.popleft()[0] for i in range(5)]
+    [0, 10, 20, 30, 40]
+    >>> len(q), q.cold, len(q.head)
+    (6, 0, 3)
+    >>> [t for t, msg in q]
+    [50, 60, 70, 80, 90, 200]
+    >>> q.nbytes == sum(msg_size(msg) for t, msg in q)
+    True
+    >>> q.clear(); q.nbytes
+    0
+    '''
+    def __init__(self, cold_after, block=DEFAULT_COLD_BLOCK, maxlen=None,
+                       level=6):
+        '''
+        cold_after = the age in seconds of messages that are packed
+        block      = the number of messages packed together
+        maxlen     = the maximum number of messages, like a deque's
+        level      = the zlib compression level
+        '''
+        self.cold_after = cold_after
+        self.block = max(block, 1)
+        self.maxlen = maxlen
+        self.level = level
+        self.retries = collections.deque()  # requeued, first in the queue
+        self.head = collections.deque()     # the unpacked front block
+        self.blocks = collections.deque()   # (first timestamp, count, data)
+        self.hot = collections.deque()      # messages not packed yet
+        self.cold = 0                       # messages in blocks
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.retries) + len(self.head) + self.cold + len(self.hot)
+
+    def __iter__(self):
+        for item in list(self.retries) + list(self.head):
+            yield item
+        for timestamp, count, data in list(self.blocks):
+            for item in self.__unpack(data):
+                yield item
+        for item in list(self.hot):
+            yield item
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('queue index out of range')
+        if index < len(self.retries):
+            return self.retries[index]
+        index -= len(self.retries)
+        self.__thaw()
+        if index < len(self.head):
+            return self.head[index]
+        index -= len(self.head)
+        for timestamp, count, data in self.blocks:
+            if index < count:
+                return self.__unpack(data)[index]
+            index -= count
+        return self.hot[index]
+
+    def __delitem__(self, index):
+        if index != 0:
+            raise IndexError('only the first message can be deleted')
+        self.popleft()
+
+    def append(self, item):
+        self.hot.append(item)
+        self.nbytes += msg_size(item[1])
+        if self.maxlen and len(self) > self.maxlen:
+            self.popleft()
+        self.__freeze(item[0])
+
+    def readd(self, index, item):
+        '''
+        Requeue an item.  Requeued items are always the first in the
+        queue, so index is the number of requeued items.
+        '''
+        self.retries.append(item)
+        self.nbytes += msg_size(item[1])
+
+    def popleft(self):
+        if self.retries:
+            item = self.retries.popleft()
+        else:
+            self.__thaw()
+            if self.head:
+                item = self.head.popleft()
+            elif self.hot:
+                item = self.hot.popleft()
+            else:
+                raise IndexError('pop from an empty queue')
+        self.nbytes -= msg_size(item[1])
+        return item
+
+    def clear(self):
+        self.retries.clear()
+        self.head.clear()
+        self.blocks.clear()
+        self.hot.clear()
+        self.cold = 0
+        self.nbytes = 0
+
+    def __freeze(self, now):
+        '''
+        Pack the oldest hot messages into blocks while a block of them is
+        older than cold_after.
+        '''
+        if now is None:
+            return
+        while len(self.hot) >= self.block:
+            last = self.hot[self.block - 1][0]
+            if last is None or now - last <= self.cold_after:
+                return
+            items = [self.hot.popleft() for i in xrange(self.block)]
+            data = zlib.compress(marshal.dumps(items), self.level)
+            self.blocks.append((items[0][0], len(items), data))
+            self.cold += len(items)
+            self.nbytes += msg_size(data) - sum(msg_size(msg)
+                                                for t, msg in items)
+
+    def __thaw(self):
+        '''
+        Unpack the first block if the front of the queue reached it.
+        '''
+        if not self.head and self.blocks:
+            timestamp, count, data = self.blocks.popleft()
+            self.cold -= count
+            self.head.extend(self.__unpack(data))
+            self.nbytes += sum(msg_size(msg) for t, msg in self.head) - \
+                    msg_size(data)
+
+    def __unpack(self, data):
+        return [tuple(item) for item in marshal.loads(zlib.decompress(data))]
+
 class Recipient(object):
     '''
     A facade object that queues messages for a recipient.
@@ -19,12 +552,20 @@ class Recipient(object):
                    |
                    v
     get_msg() <- A B C D E F <- add_msg()
+
+    All methods are thread-safe.  Each recipient has its own lock, so
+    threads delivering to different recipients do not contend.
     '''
     def __init__(self, addr,
                        max_msgs=None,
                        max_age=None,
                        state=READY,
-                       pending=None):
+                       pending=None,
+                       ring=None,
+                       priority=0,
+                       budget=None,
+                       cold_after=None,
+                       cold_block=DEFAULT_COLD_BLOCK):
         '''
         Create a recipient.
 
@@ -43,6 +584,21 @@ class Recipient(object):
                    messages to send.  Likewise, it will remove itself
                    when the communications mechanism breaks or when there
                    are no messages to send.
+        ring     = a MessageRing to store the queued messages in,
+                   shared with other recipients.  By default the
+                   recipient has its own queue.
+        priority = the priority of the recipient's queue in the memory
+                   budget.  When the budget is exceeded, messages are
+                   evicted from the queues with the lowest priority first.
+        budget   = the Budget that counts the bytes of queued messages.
+                   By default, the process-wide budget.  With a ring,
+                   the recipient counts the overhead of its entries and
+                   the ring, which should share the budget, counts the
+                   messages.
+        cold_after = the age in seconds after which queued messages are
+                   compressed, cold_block messages at a time, until they
+                   are sent.  If cold_after is None or less than or equal
+                   to zero, or a ring is used, messages are not compressed.
 
         # a recipient with an unbounded number of messages
         >>> r = Recipient('recipient@example.com')
@@ -78,11 +634,20 @@ class Recipient(object):
         if max_age <= 0:
             max_age = None
         self.addr = addr
-        self.msgs = collections.deque(maxlen=max_msgs)
+        self.lock = threading.RLock()
+        if ring is not None:
+            self.msgs = RingQueue(ring, maxlen=max_msgs)
+        elif cold_after > 0:
+            self.msgs = ColdQueue(cold_after, cold_block, maxlen=max_msgs)
+        else:
+            self.msgs = MessageQueue(maxlen=max_msgs)
         self.readd_idx = 0
         self._state = state
         self.max_age = max_age
         self.pending = pending
+        self.priority = priority
+        self.budget = budget or salt.ext.alert.budget.default()
+        self.bytes = 0
 
     def __repr__(self):
         '''
@@ -110,11 +675,12 @@ class Recipient(object):
             0: msg 1
             1: msg 2
         '''
-        if len(self.msgs) == 0:
-            msgs = ['<no-messages>']
-        else:
-            msgs = ['{time}: {msg}'.format(time=t, msg=m)
-                        for t, m in self.msgs]
+        with self.lock:
+            if len(self.msgs) == 0:
+                msgs = ['<no-messages>']
+            else:
+                msgs = ['{time}: {msg}'.format(time=t, msg=m)
+                            for t, m in self.msgs]
         if len(msgs) > 1:
             msgs.insert(0, '')
         return '{addr} [{state}]: {msgs}'.format(
@@ -160,16 +726,17 @@ class Recipient(object):
         the pending set.  If the recipient becomes unavailable,
         remove it from the pending set.
         '''
-        log.trace('%s state: %s -> %s', self.addr, self._state, value)
-        self._state = value
-        if self.pending is not None:
-            if value == READY:
-                if self.msgs:
-                    log.trace('add %s to pending', self.addr)
-                    self.pending.add(self)
-            else:
-                log.trace('remove %s from pending', self.addr)
-                self.pending.discard(self)
+        with self.lock:
+            log.trace('%s state: %s -> %s', self.addr, self._state, value)
+            self._state = value
+            if self.pending is not None:
+                if value == READY:
+                    if self.msgs:
+                        log.trace('add %s to pending', self.addr)
+                        self.pending.add(self)
+                else:
+                    log.trace('remove %s from pending', self.addr)
+                    self.pending.discard(self)
 
     def add_msg(self, msg, timestamp=None):
         '''
@@ -184,15 +751,19 @@ class Recipient(object):
         assert isinstance(msg, basestring)
         if timestamp is None and self.max_age:
             timestamp = time.time()
-        oldlen = len(self.msgs)
-        self.msgs.append((timestamp, msg))
-        self.expire_msgs(timestamp)
-        if self.pending is not None and \
-                self._state == READY and \
-                oldlen == 0 and \
-                len(self.msgs) > 0:
-            log.trace('add %s to pending', self.addr)
-            self.pending.add(self)
+        with self.lock:
+            oldlen = len(self.msgs)
+            self.msgs.append((timestamp, msg))
+            self.expire_msgs(timestamp)
+            over = self.__charge()
+            if self.pending is not None and \
+                    self._state == READY and \
+                    oldlen == 0 and \
+                    len(self.msgs) > 0:
+                log.trace('add %s to pending', self.addr)
+                self.pending.add(self)
+        if over:
+            self.budget.enforce()
 
     def readd_msg(self, msg, timestamp=None):
         '''
@@ -206,10 +777,16 @@ class Recipient(object):
 
         If timestamp isn't specified, the oldest unrequeued message is
         used.  If there are only requeued messages, then the youngest
-        requeued timestamp is used.
+        requeued timestamp is used.  A message of None, e.g. the body of
+        an error that came back without it, is ignored.
 
         >>> r = Recipient('recipient@example.com')
 
+        # nothing to requeue
+        >>> r.readd_msg(None)
+        >>> len(r.msgs), r.bytes
+        (0, 0)
+
         # readd to an empty queue
         >>> r.readd_msg('msg 1', timestamp=1)
         >>> print r
@@ -262,32 +839,36 @@ class Recipient(object):
         'msg 3'
         'msg 4'
         '''
-        if self.msgs.maxlen and len(self.msgs) == self.msgs.maxlen:
-            # drop message ... the queue is full of younger messages
+        if msg is None:
             return
-        if timestamp is None:
-            if len(self.msgs) == 0:
-                # arbitrarily set the message timestamp to now
-                if self.max_age:
-                    timestamp = time.time()
-            elif self.readd_idx >= len(self.msgs):
-                # use the time of the youngest *readded* message
-                timestamp = self.msgs[-1][0]
-            else:
-                # use the time of the oldest unreadded message
-                timestamp = self.msgs[self.readd_idx][0]
-        oldlen = len(self.msgs)
-        self.msgs.rotate(-self.readd_idx)
-        self.msgs.appendleft((timestamp, msg))
-        self.msgs.rotate(self.readd_idx)
-        self.readd_idx += 1
-        self.expire_msgs(timestamp)
-        if self.pending is not None and \
-                self._state == READY and \
-                oldlen == 0 and \
-                len(self.msgs) > 0:
-            log.trace('add %s to pending', self.addr)
-            self.pending.add(self)
+        with self.lock:
+            if self.msgs.maxlen and len(self.msgs) == self.msgs.maxlen:
+                # drop message ... the queue is full of younger messages
+                return
+            if timestamp is None:
+                if len(self.msgs) == 0:
+                    # arbitrarily set the message timestamp to now
+                    if self.max_age:
+                        timestamp = time.time()
+                elif self.readd_idx >= len(self.msgs):
+                    # use the time of the youngest *readded* message
+                    timestamp = self.msgs[-1][0]
+                else:
+                    # use the time of the oldest unreadded message
+                    timestamp = self.msgs[self.readd_idx][0]
+            oldlen = len(self.msgs)
+            self.msgs.readd(self.readd_idx, (timestamp, msg))
+            self.readd_idx += 1
+            self.expire_msgs(timestamp)
+            over = self.__charge()
+            if self.pending is not None and \
+                    self._state == READY and \
+                    oldlen == 0 and \
+                    len(self.msgs) > 0:
+                log.trace('add %s to pending', self.addr)
+                self.pending.add(self)
+        if over:
+            self.budget.enforce()
 
     def get_msg(self, timestamp=None):
         '''
@@ -311,16 +892,118 @@ class Recipient(object):
         msg 2
         set([])
         '''
-        msg = None
-        self.expire_msgs(timestamp)
-        if self.msgs:
-            created, msg = self.msgs.popleft()
+        entry = self.pop_msg(timestamp)
+        return entry[1] if entry is not None else None
+
+    def pop_msg(self, timestamp=None):
+        '''
+        Like get_msg(), but return the (timestamp, msg) tuple of the
+        message, so it can be readded with its original timestamp.
+
+        >>> r = Recipient('recipient@example.com')
+        >>> r.add_msg('msg 1', timestamp=5)
+        >>> r.pop_msg(), r.pop_msg()
+        ((5, 'msg 1'), None)
+        '''
+        entry = None
+        with self.lock:
+            self.expire_msgs(timestamp)
+            if self.msgs:
+                entry = self.msgs.popleft()
+                if self.readd_idx > 0:
+                    self.readd_idx -= 1
+                self.__charge()
+            if self.pending is not None and len(self.msgs) == 0:
+                log.trace('remove %s from pending', self.addr)
+                self.pending.discard(self)
+        return entry
+
+    def get_msgs(self, max_msgs, max_size=None, overhead=0, timestamp=None):
+        '''
+        Remove and return a list of the oldest messages in the recipient's
+        queue, so they can be sent together.  The first message is always
+        returned, even if it is bigger than max_size.  Following messages
+        are returned while there are at most max_msgs messages and their
+        total size is at most max_size.  overhead is added to the size of
+        every message after the first, e.g. for a separator.  If there are
+        no messages in the queue, return an empty list.
+
+        >>> r = Recipient('recipient@example.com')
+        >>> for msg in ['msg 1', 'msg 2', 'msg 3', 'a long msg 4', 'msg 5']:
+        ...     r.add_msg(msg)
+        >>> r.get_msgs(2)
+        ['msg 1', 'msg 2']
+        >>> r.get_msgs(5, max_size=20, overhead=2)
+        ['msg 3', 'a long msg 4']
+        >>> r.get_msgs(5)
+        ['msg 5']
+        >>> r.get_msgs(5)
+        []
+        '''
+        msgs = []
+        with self.lock:
+            self.expire_msgs(timestamp)
+            size = 0
+            while self.msgs and len(msgs) < max_msgs:
+                msg = self.msgs[0][1]
+                if msgs:
+                    size += overhead + len(msg)
+                    if max_size and size > max_size:
+                        break
+                else:
+                    size = len(msg)
+                msgs.append(self.get_msg(timestamp))
+        return msgs
+
+    def drain(self):
+        '''
+        Remove and return all queued messages as (timestamp, msg) tuples,
+        oldest first, e.g. to move them to another recipient.
+
+        >>> r = Recipient('recipient@example.com')
+        >>> r.add_msg('msg 1', timestamp=1)
+        >>> r.add_msg('msg 2', timestamp=2)
+        >>> r.drain()
+        [(1, 'msg 1'), (2, 'msg 2')]
+        >>> print r
+        recipient@example.com [READY]: <no-messages>
+        '''
+        with self.lock:
+            msgs = list(self.msgs)
+            self.msgs.clear()
+            self.readd_idx = 0
+            self.__charge()
+            if self.pending is not None:
+                self.pending.discard(self)
+        return msgs
+
+    def evict(self):
+        '''
+        Remove the oldest message to stay within the memory budget.
+        Return the bytes freed.
+
+        >>> r = Recipient('recipient@example.com')
+        >>> r.add_msg('msg 1')
+        >>> r.add_msg('msg 2')
+        >>> r.bytes
+        138
+        >>> r.evict(), r.get_msg(), r.evict()
+        (69, 'msg 2', 0)
+        '''
+        with self.lock:
+            if not self.msgs:
+                return 0
+            nbytes = self.bytes
+            self.msgs.popleft()
             if self.readd_idx > 0:
                 self.readd_idx -= 1
-        if self.pending is not None and len(self.msgs) == 0:
-            log.trace('remove %s from pending', self.addr)
-            self.pending.discard(self)
-        return msg
+            self.__charge()
+            # a compressed block that is unpacked may grow
+            nbytes = max(nbytes - self.bytes, 0)
+            if self.pending is not None and len(self.msgs) == 0:
+                self.pending.discard(self)
+        log.trace('%s: evicted %s bytes', self.addr, nbytes)
+        return nbytes
 
     def expire_msgs(self, timestamp=None):
         '''
@@ -355,12 +1038,136 @@ class Recipient(object):
             return
         if timestamp is None:
             timestamp = time.time()
-        while self.max_age and \
-                len(self.msgs) > 0 and \
-                timestamp - self.msgs[0][0] > self.max_age:
-            del self.msgs[0]
-            if self.readd_idx > 0:
-                self.readd_idx -= 1
+        with self.lock:
+            while self.max_age and \
+                    len(self.msgs) > 0 and \
+                    timestamp - self.msgs[0][0] > self.max_age:
+                del self.msgs[0]
+                if self.readd_idx > 0:
+                    self.readd_idx -= 1
+            self.__charge()
+
+    def __charge(self):
+        '''
+        Charge the budget for the change in the queue's bytes since the
+        last charge.  Return True if the budget is exceeded.  Must hold
+        the lock.
+        '''
+        nbytes = self.msgs.nbytes - self.bytes
+        self.bytes = self.msgs.nbytes
+        return self.budget.charge(self, nbytes)
+
+def _stress(producers=4, msgs_per_producer=2000, recipients=1,
+            handoff=False, **kwargs):
+    '''
+    Hammer recipients that share a PendingSet from producer threads (like
+    the ingest thread calling add_msg) while a consumer thread (like the
+    XMPP thread) gets, requeues and changes the recipients' state.  Each
+    producer spreads its messages over the recipients and sends every
+    fifth one to all of them.  With handoff, the producers hand their
+    messages off to the consumer thread, which queues them, like the
+    Jabber agent does.  Return the problems found.
+
+    >>> _stress()
+    []
+    >>> _stress(ring=MessageRing())
+    []
+    >>> _stress(max_age=3600, cold_after=0.001, cold_block=8)
+    []
+    >>> _stress(recipients=5)
+    []
+    >>> _stress(recipients=5, ring=MessageRing())
+    []
+    >>> _stress(recipients=5, handoff=True, ring=MessageRing())
+    []
+    '''
+    pending = PendingSet()
+    queues = [Recipient('recipient{}@example.com'.format(n), pending=pending,
+                        **kwargs)
+                for n in xrange(recipients)]
+    handoffs = []
+    handoff_lock = threading.Lock()
+    sent = collections.defaultdict(list)
+    problems = []
+    done = threading.Event()
+
+    def targets(producer, i):
+        if i % 5 == 0:
+            return queues
+        return [queues[(producer + i) % recipients]]
+
+    def produce(producer):
+        for i in xrange(msgs_per_producer):
+            msg = '{}:{}'.format(producer, i)
+            if handoff:
+                with handoff_lock:
+                    handoffs.append((targets(producer, i), msg))
+            else:
+                for r in targets(producer, i):
+                    r.add_msg(msg)
+
+    def consume():
+        n = 0
+        while True:
+            finished = done.is_set()
+            if handoff:
+                with handoff_lock:
+                    batch = handoffs[:]
+                    del handoffs[:]
+                # queue each message to all its recipients in a row
+                for rs, msg in batch:
+                    for r in rs:
+                        r.add_msg(msg)
+            for recipient in pending:
+                msg = recipient.get_msg()
+                if msg is None:
+                    continue
+                n += 1
+                if n % 7 == 0:
+                    # a failed send is requeued and later resent
+                    recipient.readd_msg(msg)
+                    recipient.state = 'not-ready'
+                    recipient.state = READY
+                else:
+                    sent[recipient.addr].append(msg)
+                if not 0 <= recipient.readd_idx <= len(recipient.msgs):
+                    problems.append('readd_idx out of range')
+            if finished and not any(r.msgs for r in queues):
+                break
+            for r in queues:
+                with r.lock:
+                    if r.msgs and r not in pending:
+                        problems.append('recipient with messages is not '
+                                        'pending')
+                        r.state = READY
+
+    threads = [threading.Thread(target=produce, args=(p,))
+                    for p in range(producers)]
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    consumer.join()
+    expected = sum(len(targets(producer, i))
+                    for producer in xrange(producers)
+                    for i in xrange(msgs_per_producer))
+    total = sum(len(msgs) for msgs in sent.itervalues())
+    if total != expected:
+        problems.append('sent {} of {} messages'.format(total, expected))
+    for addr, msgs in sorted(sent.iteritems()):
+        if len(msgs) != len(set(msgs)):
+            problems.append('duplicate messages sent to {}'.format(addr))
+        for producer in range(producers):
+            # each producer's messages are sent in order
+            seq = [int(m.split(':')[1]) for m in msgs
+                        if m.startswith('{}:'.format(producer))]
+            if seq != sorted(seq):
+                problems.append('producer {} out of order to {}'.format(
+                                producer, addr))
+    return problems
 
 if __name__ == '__main__':
     import doctest
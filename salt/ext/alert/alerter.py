@@ -1,11 +1,24 @@
 #!/usr/bin/env python2
 import os
 import re
+import threading
 import time
 
 import yaml
 
 import salt.ext.alert.agents
+import salt.ext.alert.budget
+import salt.ext.alert.configcache
+import salt.ext.alert.control
+import salt.ext.alert.engine
+import salt.ext.alert.enrich
+import salt.ext.alert.escalation
+import salt.ext.alert.ingest
+import salt.ext.alert.latency
+import salt.ext.alert.maintenance
+import salt.ext.alert.snapshots
+import salt.ext.alert.topology
+import salt.ext.alert.workers
 import salt.log
 
 DEFAULT_PROTOCOL = 'email'
@@ -14,6 +27,7 @@ DEFAULT_VERB = 'raised'
 VERBS_DEFAULT    = {'raised': 'occurred', 'cleared': 'resolved'}
 TIMEZONE_DEFAULT = 'UTC'
 STRFTIME_DEFAULT = '%c %Z'
+STATS_SOCKET     = 'alert_stats.sock'
 
 log = salt.log.getLogger(__name__)
 
@@ -28,22 +42,43 @@ class Alerter(object):
         self.agents = {}
         self.timeformat = TIMEZONE_DEFAULT
         self.verbs = VERBS_DEFAULT
+        self.queue = salt.ext.alert.ingest.IngestQueue()
+        self.workers = None
+        self.enricher = None
+        self.maintenance = None
+        self.topology = None
+        self.escalator = None
+        self.snapshots = None
+        self.stats_path = None
+        self.dispatcher = None
+        self.dispatcher_pid = None
+        self.dispatcher_lock = threading.Lock()
 
-    def load(self, config):
+    def load(self, config, client=None, save_cache=True):
         '''
         Load the alert agents, subscriptions, and miscellaneous data
         from structures generated from YAML in /etc/salt/alert.
+        client is the salt LocalClient, or a function that creates one,
+        used to look up host metadata.  The compiled config is saved to
+        the config cache unless save_cache is False, e.g. for a replay.
         '''
         if not isinstance(config, dict):
             raise ValueError('expected config dict, not %s', type(config))
+        salt.ext.alert.engine.configure(config.get('alert.engine'))
+        salt.ext.alert.budget.configure(config.get('alert.budget'))
         self.agents = salt.ext.alert.agents.load_agents(config)
         self.timeformat, timezone = self._load_time(config)
         self.verbs = self._load_verbs(config)
+        self.queue = salt.ext.alert.ingest.load_queue(config)
         self._load_subscriptions(config, self.agents)
+        self.escalator = self._load_escalation(config, self.agents)
 
         log.debug('set timezone to %s', timezone)
         os.environ['TZ'] = timezone
         time.tzset()
+        # maintenance windows are given in local time
+        self.maintenance = salt.ext.alert.maintenance.load_maintenance(config)
+        self.topology = salt.ext.alert.topology.load_topology(config)
 
         # remove agents that have no subscribers
         for protocol in list(self.agents.keys()):
@@ -51,21 +86,212 @@ class Alerter(object):
                 log.trace('remove %s agent: no subscribers defined', protocol)
                 del self.agents[protocol]
 
+        self.workers = salt.ext.alert.workers.load_workers(config, self)
+        # a slot for the statistics of each ReqServer worker process
+        self.snapshots = salt.ext.alert.snapshots.Snapshots(
+                int(config.get('worker_threads', 1)))
+        self.stats_path = self._load_stats_path(config)
+        if client is not None:
+            self.enricher = salt.ext.alert.enrich.load_enricher(config, client)
+        if save_cache and 'cachedir' in config:
+            salt.ext.alert.configcache.current(config).save(config['cachedir'])
+
+    def start_workers(self):
+        '''
+        Start the delivery worker processes and the escalation process,
+        if configured.  Must be called before the alert server forks its
+        request workers.
+        '''
+        if self.workers is not None:
+            self.workers.start()
+        if self.escalator is not None:
+            self.escalator.start()
+
+    def start_sockets(self):
+        '''
+        Serve the statistics and maintenance sockets, if configured.
+        Must be called in the alert server's main process.
+        '''
+        if self.stats_path:
+            salt.ext.alert.control.serve(self.stats_path, self.command,
+                                         'stats')
+        if self.maintenance is not None:
+            self.maintenance.serve()
+
+    def command(self, request):
+        '''
+        Run a command of the statistics socket.  Return its reply.
+
+        >>> alerter = Alerter()
+        >>> reply = alerter.command({'cmd': 'stats'})
+        >>> reply['ok'], sorted(reply['stats'])
+        (True, ['ingest', 'processes'])
+        >>> alerter.command({'cmd': 'bogus'})
+        {'ok': False, 'error': 'unknown command: bogus'}
+        '''
+        cmd = request.get('cmd') if isinstance(request, dict) else None
+        if cmd == 'stats':
+            return {'ok': True, 'stats': self.stats()}
+        return {'ok': False, 'error': 'unknown command: {}'.format(cmd)}
+
+    def ingest(self, alert):
+        '''
+        Queue an alert sent from a minion for delivery.
+        This method never blocks on the alert agents.  If the ingest
+        queue is overloaded, the alert may be shed.
+        '''
+        self._start_dispatcher()
+        alert['received'] = time.time()
+        if self.enricher is not None:
+            self.enricher.request(alert.get('host'))
+        if not self.queue.put(alert):
+            log.debug('shed: %s', alert)
+
+    def stats(self):
+        '''
+        Return the delivery statistics of all alert server processes.
+        'ingest' counts the alerts of every process.  'processes' holds
+        the statistics each ReqServer worker process published last,
+        within a few seconds, or those of this process before the server
+        forks.  With delivery workers, their 'latency' only has the
+        ingest and queue latencies: the send, receipt and total
+        latencies are sampled in the delivery workers, and reported per
+        worker in 'workers'.
+        '''
+        stats = {'ingest': self.queue.stats()}
+        if self.snapshots is not None:
+            stats['processes'] = [snapshot for snapshot
+                                    in self.snapshots.read() if snapshot]
+        else:
+            stats['processes'] = [self._process_stats()]
+        if self.workers is not None:
+            stats['workers'] = self.workers.stats()
+        if self.topology is not None:
+            stats['topology'] = self.topology.stats()
+        if self.escalator is not None:
+            stats['escalation'] = self.escalator.stats()
+        return stats
+
+    def _process_stats(self):
+        '''
+        Return the statistics kept in this process.
+        '''
+        stats = {'pid': os.getpid(),
+                 'engine': salt.ext.alert.engine.stats(),
+                 'budget': salt.ext.alert.budget.stats(),
+                 'latency': salt.ext.alert.latency.stats()}
+        if self.enricher is not None:
+            stats['enrich'] = self.enricher.stats()
+        if self.maintenance is not None:
+            stats['maintenance'] = self.maintenance.stats()
+        return stats
+
+    def _start_dispatcher(self):
+        '''
+        Start the thread that delivers queued alerts.
+        The ReqServer forks its workers after the Alerter is created,
+        so the thread is started lazily in the process that uses it.
+        '''
+        with self.dispatcher_lock:
+            if self.dispatcher_pid == os.getpid() and \
+                    self.dispatcher.is_alive():
+                return
+            self.dispatcher = threading.Thread(target=self._dispatch,
+                                               name='alert-dispatcher')
+            self.dispatcher.daemon = True
+            self.dispatcher_pid = os.getpid()
+            self.dispatcher.start()
+            if self.snapshots is not None:
+                index = self.snapshots.claim()
+                if index is not None:
+                    self.snapshots.start(index, self._process_stats)
+
+    def _dispatch(self):
+        '''
+        Deliver queued alerts forever.
+        '''
+        while True:
+            alert = self.queue.get()
+            try:
+                self.deliver(alert)
+            except Exception, ex:
+                log.error('failed to deliver alert: %s', alert, exc_info=ex)
+
     def deliver(self, alert):
         '''
         Deliver an alert sent from a minion.
+        Alerts of hosts whose parents are down and alerts covered by a
+        maintenance window are dropped.  The others are assigned a trace
+        id to track their delivery latency.  A clear ends the escalation
+        of its alert even if the clear itself is dropped.
+
+        >>> import re, time
+        >>> import salt.ext.alert.escalation as escalation
+        >>> import salt.ext.alert.maintenance as maintenance
+        >>> alerter = Alerter()
+        >>> alerter.escalator = escalation.Escalator([escalation.Policy(
+        ...         re.compile('.*'), None, 3600, 0, [])])
+        >>> alerter.maintenance = maintenance.Maintenance([maintenance.Window(
+        ...         'db', 1000, time.time() + 3600, hosts=['db1'])])
+        >>> alerter.deliver({'host': 'db1', 'category': 'disk.full',
+        ...                  'severity': 'critical', 'time': 500})
+        >>> alerter.escalator.stats()['open']
+        1
+        >>> alerter.deliver({'host': 'db1', 'category': 'disk.full',
+        ...                  'severity': 'ok', 'verb': 'cleared',
+        ...                  'time': 1500})
+        >>> alerter.escalator.stats()['open']
+        0
+        >>> alerter.maintenance.stats()['suppressed']
+        {'db': 1}
+        '''
+        verb = alert.get('verb', DEFAULT_VERB)
+        if self.escalator is not None and verb == 'cleared':
+            self.escalator.track(verb, alert)
+        if not self.route(alert):
+            return
+        log.debug('deliver: %s', alert)
+        if self.escalator is not None and verb != 'cleared':
+            self.escalator.track(verb, alert)
+        if self.workers is not None:
+            self.workers.deliver(alert)
+            return
+        for agent in self.agents.values():
+            agent.deliver(alert)
+
+    def route(self, alert, now=None, trace=True):
+        '''
+        Suppress, enrich and prepare an alert sent from a minion for the
+        agents.  Return False if the alert is suppressed by the topology
+        or a maintenance window at time now, by default the current
+        time.  Unless trace is False, the alert is assigned a trace id.
+        '''
+        received = alert.pop('received', None)
+        if self.topology is not None and self.topology.check(alert, now):
+            return False
+        if self.maintenance is not None and \
+                self.maintenance.suppress(alert, now):
+            return False
+        if trace:
+            salt.ext.alert.latency.start(alert, received)
+        if self.enricher is not None:
+            self.enricher.enrich(alert)
+        self.prepare(alert)
+        return True
+
+    def prepare(self, alert):
+        '''
+        Add the template variables to an alert sent from a minion.
         '''
         severity = alert.get('severity')
         if severity is not None:
             alert['severity'] = severity.lower()
             alert['SEVERITY'] = severity.upper()
         epoch_time = alert.get('time', time.time())
+        alert['epoch'] = epoch_time
         alert['time'] = time.strftime(self.timeformat,
                                       time.localtime(epoch_time))
         alert['verb'] = self.verbs.get(alert.get('verb', DEFAULT_VERB))
-        log.debug('deliver: %s', alert)
-        for agent in self.agents.values():
-            agent.deliver(alert)
 
     def _load_time(self, config):
         '''
@@ -77,6 +303,18 @@ class Alerter(object):
         log.trace('alert time: format="%s" timezone="%s"', *timedefs)
         return timedefs
 
+    def _load_stats_path(self, config):
+        '''
+        Return the path of the statistics socket in alert.stats, by
+        default in the sock_dir, or None.
+        '''
+        spec = config.get('alert.stats') or {}
+        path = spec.get('socket')
+        if path is None and config.get('sock_dir'):
+            path = os.path.join(config['sock_dir'], STATS_SOCKET)
+        log.trace('statistics socket: %s', path)
+        return path or None
+
     def _load_verbs(self, config):
         '''
         Load the preferred raised and cleared verbs from /etc/salt/alert.
@@ -90,16 +328,96 @@ class Alerter(object):
 
     def _load_subscriptions(self, config, agents):
         '''
-        Load the alert subscriptions from /etc/salt/alert.
+        Load the alert subscriptions from /etc/salt/alert, or from the
+        config cache if the config did not change.  The cache holds the
+        subscriptions of every protocol, so the subscribers of an agent
+        that failed to load are skipped here.
+
+        >>> import salt.ext.alert.configcache as configcache
+        >>> class Agent(object):
+        ...     def __init__(self):
+        ...         self.subscribers = []
+        ...     def add_subscriber(self, regex, addr, filters):
+        ...         self.subscribers.append(addr)
+        >>> configcache._current = configcache.CompiledConfig('key', {}, [
+        ...         ('jabber', '.*', 'ops@example.com', None),
+        ...         ('email', '.*', 'ops@example.com', None)])
+        >>> agents = {'email': Agent()}
+        >>> Alerter()._load_subscriptions({'config_hash': 'key'}, agents)
+        >>> agents['email'].subscribers
+        ['ops@example.com']
+        >>> configcache._current = configcache.CompiledConfig()
+        '''
+        compiled = salt.ext.alert.configcache.current(config)
+        subscriptions = compiled.subscriptions
+        if subscriptions is None:
+            subscriptions = self._parse_subscriptions(config)
+            compiled.set_subscriptions(subscriptions)
+        for protocol, pattern, addr, filters in subscriptions:
+            agent = agents.get(protocol)
+            if not agent:
+                log.error('ignore subscriber "%s:%s": unknown protocol "%s"',
+                            protocol, addr, protocol)
+                continue
+            agent.add_subscriber(compiled.compile(pattern), addr, filters)
+
+    def _parse_subscriptions(self, config):
+        '''
+        Return the validated alert subscriptions in /etc/salt/alert as a
+        list of (protocol, pattern, address, filters) tuples.
+        A subscription maps a category/severity regex to subscribers, or
+        to a dict of subscribers and filters.  The subscriptions may also
+        be a list of dicts, each with its regex in 'condition'.
         '''
+        parsed = []
         subscriptions = config.get('alert.subscriptions')
         if not subscriptions:
             log.error('alert.subscriptions missing or empty in config')
-            return
-        for pattern, subscribers in config.get('alert.subscriptions', {}).iteritems():
-            regex = re.compile(pattern)
+            return parsed
+        if isinstance(subscriptions, dict):
+            subscriptions = subscriptions.items()
+        else:
+            subscriptions = [(spec.get('condition', '.*'), spec)
+                                for spec in subscriptions]
+        for pattern, subscribers in subscriptions:
+            filters = None
+            if isinstance(subscribers, dict):
+                filters = self._load_filters(subscribers)
+                subscribers = subscribers.get('subscribers', [])
             if isinstance(subscribers, basestring):
                 subscribers = [subscribers]
+            for subscriber in subscribers:
+                if ':' in subscriber:
+                    protocol, addr = subscriber.split(':', 1)
+                else:
+                    protocol = DEFAULT_PROTOCOL
+                    addr = subscriber
+                parsed.append((protocol, pattern, addr, filters))
+        return parsed
+
+    def _load_escalation(self, config, agents):
+        '''
+        Load the escalation policies from /etc/salt/alert, a list of
+        dicts with a category/severity regex in 'condition', filters
+        like a subscription, 'after' (seconds or a duration like 30m),
+        'repeat', and the 'subscribers' alerts are escalated to.
+        Return the Escalator, or None if there are no policies.
+        '''
+        escalation = salt.ext.alert.escalation
+        compiled = salt.ext.alert.configcache.current(config)
+        policies = []
+        for spec in config.get('alert.escalation') or []:
+            try:
+                regex = compiled.compile(spec.get('condition', '.*'))
+                after = salt.ext.alert.maintenance.parse_duration(
+                        spec.get('after', escalation.DEFAULT_AFTER))
+            except (AttributeError, re.error, ValueError), ex:
+                log.error('ignore escalation policy %s: %s', spec, ex)
+                continue
+            subscribers = spec.get('subscribers', [])
+            if isinstance(subscribers, basestring):
+                subscribers = [subscribers]
+            targets = {}
             for subscriber in subscribers:
                 if ':' in subscriber:
                     protocol, addr = subscriber.split(':', 1)
@@ -108,7 +426,38 @@ class Alerter(object):
                     addr = subscriber
                 agent = agents.get(protocol)
                 if not agent:
-                    log.error('ignore subscriber "%s": unknown protocol "%s"',
-                                subscriber, protocol )
+                    log.error('ignore escalation subscriber "%s": unknown '
+                              'protocol "%s"', subscriber, protocol)
                     continue
-                agent.add_subscriber(regex, addr)
+                targets.setdefault(protocol, (agent, []))[1].append(
+                        agent._parse_subscriber(addr))
+            if not targets or after <= 0:
+                log.error('ignore escalation policy %s: no subscribers or '
+                          'no interval', spec)
+                continue
+            log.trace('escalation policy: %s after %s seconds to %s',
+                      regex.pattern, after, subscribers)
+            policies.append(escalation.Policy(
+                    regex, self._load_filters(spec), after,
+                    spec.get('repeat', escalation.DEFAULT_REPEAT),
+                    [targets[protocol] for protocol in sorted(targets)]))
+        if not policies:
+            return None
+        return escalation.Escalator(policies)
+
+    def _load_filters(self, spec):
+        '''
+        Load the filters of a subscription: 'hosts', a host or list of
+        hosts, and 'fields', a dict of alert field names and values.
+        Hosts and values may be globs, e.g. web*.
+        '''
+        filters = {}
+        fields = dict(spec.get('fields') or {})
+        if spec.get('hosts'):
+            fields['host'] = spec['hosts']
+        for field, values in fields.iteritems():
+            if not isinstance(values, list):
+                values = [values]
+            filters[field] = [value if isinstance(value, basestring)
+                                    else str(value) for value in values]
+        return filters
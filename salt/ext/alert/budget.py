@@ -0,0 +1,186 @@
+'''
+A process-wide memory budget for queued messages.
+
+Every agent limits the messages queued per recipient with max_msgs and
+max_age, but not their total: when a service is down, thousands of
+recipients may each fill their queue.  The budget counts the bytes of
+all queued messages in the process.  When they exceed max_bytes,
+messages are evicted, oldest first, from the queues of the lowest
+priority, largest first, until the total is below the low water mark.
+Taking one message at a time from the largest queue evens out the
+largest queues before smaller ones lose anything.
+
+A queue taking part in the budget has a priority and a bytes attribute,
+and an evict() method that drops its oldest message and returns the
+bytes it freed.  It reports every change of its bytes with charge().
+Bytes that no single queue can evict, like the messages of a shared
+MessageRing, are charged without a queue; they are freed when the
+queues referring to them evict their entries.
+'''
+import heapq
+import threading
+
+import salt.log
+
+DEFAULT_MAX_BYTES = 0       # unlimited
+DEFAULT_LOW_WATER = 0.9
+MSG_OVERHEAD      = 64      # bytes counted per message besides its text
+
+log = salt.log.getLogger(__name__)
+
+def msg_size(msg):
+    '''
+    Return the bytes counted for a queued message.
+    '''
+    return len(msg) + MSG_OVERHEAD
+
+class Budget(object):
+    '''
+    Count the bytes of queued messages and evict messages when there
+    are too many.
+
+    >>> class Queue(object):
+    ...     def __init__(self, budget, sizes, priority=0):
+    ...         self.budget, self.sizes, self.priority = budget, sizes, priority
+    ...         self.bytes = sum(sizes)
+    ...         budget.charge(self, self.bytes)
+    ...     def evict(self):
+    ...         size = self.sizes.pop(0)
+    ...         self.bytes -= size
+    ...         self.budget.charge(self, -size)
+    ...         return size
+    >>> b = Budget(max_bytes=1000, low_water=0.6)
+    >>> big = Queue(b, [100] * 6)
+    >>> small = Queue(b, [100] * 3)
+    >>> vip = Queue(b, [100] * 4, priority=1)
+    >>> b.bytes, b.over()
+    (1300, True)
+
+    # the low priority queues lose messages, the largest first
+    >>> b.enforce()
+    >>> len(big.sizes), len(small.sizes), len(vip.sizes)
+    (1, 1, 4)
+    >>> sorted(b.stats().items())
+    [('bytes', 600), ('evicted', 7), ('evicted_bytes', 700), ('max_bytes', 1000), ('queues', 3)]
+    '''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES,
+                       low_water=DEFAULT_LOW_WATER):
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.queues = set()
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self.evicting = False
+
+    def configure(self, config):
+        '''
+        Configure the budget from the alert.budget data in
+        /etc/salt/alert.
+        '''
+        config = config or {}
+        with self.lock:
+            self.max_bytes = max(config.get('max_bytes', self.max_bytes), 0)
+            self.low_water = min(max(config.get('low_water',
+                                                self.low_water), 0.0), 1.0)
+        log.trace('budget: max_bytes=%s low_water=%s',
+                  self.max_bytes, self.low_water)
+
+    def charge(self, queue, nbytes):
+        '''
+        Count nbytes more (or fewer, if negative) bytes queued in queue,
+        or, if queue is None, held for several queues.  Return True if
+        the budget is exceeded.
+        '''
+        with self.lock:
+            self.bytes += nbytes
+            if queue is None:
+                pass
+            elif queue.bytes > 0:
+                self.queues.add(queue)
+            else:
+                self.queues.discard(queue)
+            return bool(self.max_bytes) and self.bytes > self.max_bytes
+
+    def over(self):
+        '''
+        Return True if the budget is exceeded.
+        '''
+        return bool(self.max_bytes) and self.bytes > self.max_bytes
+
+    def enforce(self):
+        '''
+        If the budget is exceeded, evict messages until it is below the
+        low water mark.  Queues must not be locked by the caller.  Only
+        one thread evicts at a time; others return at once.
+        '''
+        with self.lock:
+            if self.evicting or not self.over():
+                return
+            self.evicting = True
+            target = int(self.max_bytes * self.low_water)
+            queues = list(self.queues)
+        evicted = freed = 0
+        try:
+            heap = [(queue.priority, -queue.bytes, id(queue), queue)
+                        for queue in queues]
+            heapq.heapify(heap)
+            while heap and self.bytes > target:
+                priority, size, ident, queue = heapq.heappop(heap)
+                if -size != queue.bytes:
+                    # the queue changed since it was pushed
+                    if queue.bytes > 0:
+                        heapq.heappush(heap, (queue.priority, -queue.bytes,
+                                              ident, queue))
+                    continue
+                nbytes = queue.evict()
+                if nbytes:
+                    evicted += 1
+                    freed += nbytes
+                if queue.bytes > 0:
+                    heapq.heappush(heap, (queue.priority, -queue.bytes,
+                                          ident, queue))
+        finally:
+            with self.lock:
+                self.evicted += evicted
+                self.evicted_bytes += freed
+                self.evicting = False
+        if evicted:
+            log.warning('queued messages exceed %s bytes: evicted %s '
+                        'message(s), %s bytes', self.max_bytes, evicted, freed)
+
+    def stats(self):
+        '''
+        Return the budget's usage and evictions.
+        '''
+        with self.lock:
+            return {'max_bytes': self.max_bytes,
+                    'bytes': self.bytes,
+                    'queues': len(self.queues),
+                    'evicted': self.evicted,
+                    'evicted_bytes': self.evicted_bytes}
+
+_default = Budget()
+
+def default():
+    '''
+    Return the process-wide budget.
+    '''
+    return _default
+
+def configure(config):
+    '''
+    Configure the process-wide budget.
+    '''
+    _default.configure(config)
+
+def stats():
+    '''
+    Return the usage and evictions of the process-wide budget.
+    '''
+    return _default.stats()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
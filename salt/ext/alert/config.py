@@ -7,6 +7,7 @@ import sys
 # Import salt libs
 import salt.config
 import salt.crypt
+import salt.ext.alert.configcache
 
 def alert_config(path):
     '''
@@ -37,7 +38,7 @@ def alert_config(path):
             'cluster_mode': 'paranoid',
             }
 
-    salt.config.load_config(opts, path, 'SALT_ALERT_CONFIG')
+    salt.ext.alert.configcache.load_config(opts, path, 'SALT_ALERT_CONFIG')
 
     opts['aes'] = salt.crypt.Crypticle.generate_key_string()
 
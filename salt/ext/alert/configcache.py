@@ -0,0 +1,212 @@
+'''
+A precompiled cache of the alert server configuration.
+
+Parsing a large /etc/salt/alert and compiling its subscription regexes
+takes seconds.  After a successful load, the parsed options, the
+validated subscriptions and the compiled code of their regexes are
+pickled to <cachedir>/alert/config.cache, keyed by a hash of the config
+file's contents.  The next start with an unchanged file loads them from
+the cache instead, and rebuilds the cache when the file changes.
+
+The compiled regex code is specific to the Python version, which is part
+of the key.
+'''
+import cPickle as pickle
+import hashlib
+import os
+import re
+import sys
+
+import sre_compile
+import sre_parse
+import _sre
+
+import salt.config
+import salt.log
+
+CACHE_VERSION = 2
+CACHE_FILE = 'config.cache'
+
+# top level options that locate the cachedir, read before the YAML
+# is parsed
+PATH_OPTION = re.compile(r'''^(cachedir|root_dir):[ \t]*['"]?([^'"#\s]+)''',
+                         re.M)
+
+log = salt.log.getLogger(__name__)
+
+def config_hash(text):
+    '''
+    Return the cache key of a config file's contents.
+    '''
+    key = hashlib.sha1()
+    key.update('{}:{}:{}\n'.format(CACHE_VERSION, sys.version,
+                                   sre_compile.MAGIC))
+    key.update(text)
+    return key.hexdigest()
+
+def regex_code(pattern):
+    '''
+    Return the arguments of _sre.compile() for a regex, i.e. its
+    compiled code, as re.compile() computes them.
+
+    >>> regex = _sre.compile(*regex_code('disk\\.(full|slow)/.*'))
+    >>> regex.match('disk.full/critical').group(1), regex.pattern
+    ('full', 'disk\\\\.(full|slow)/.*')
+    '''
+    parsed = sre_parse.parse(pattern, 0)
+    code = sre_compile._code(parsed, 0)
+    groupindex = parsed.pattern.groupdict
+    indexgroup = [None] * parsed.pattern.groups
+    for name, index in groupindex.iteritems():
+        indexgroup[index] = name
+    return (pattern, parsed.pattern.flags, code, parsed.pattern.groups - 1,
+            groupindex, indexgroup)
+
+class CompiledConfig(object):
+    '''
+    The cached parts of a configuration: the options as parsed from the
+    config file, the validated subscriptions and their compiled regexes.
+
+    >>> compiled = CompiledConfig()
+    >>> compiled.compile('.*/critical').match('disk.full/critical') is not None
+    True
+    >>> compiled.dirty, compiled.compile('.*/critical').pattern
+    (True, '.*/critical')
+    '''
+    def __init__(self, key=None, opts=None, subscriptions=None, regexes=None):
+        '''
+        key           = the hash of the config file, None if not cached
+        opts          = the options parsed from the config file
+        subscriptions = the validated subscriptions, a list of
+                        (protocol, pattern, addr, filters) tuples
+        regexes       = pattern => arguments of _sre.compile()
+        '''
+        self.key = key
+        self.opts = opts
+        self.subscriptions = subscriptions
+        self.regexes = regexes or {}
+        self.dirty = False
+
+    def compile(self, pattern):
+        '''
+        Return the compiled regex of a subscription pattern.
+        '''
+        args = self.regexes.get(pattern)
+        if args is not None:
+            try:
+                return _sre.compile(*args)
+            except Exception, ex:
+                log.trace('cached regex "%s" is invalid', pattern, exc_info=ex)
+        try:
+            args = regex_code(pattern)
+            regex = _sre.compile(*args)
+        except Exception, ex:
+            # not a regex _code() can compile: let re raise its error
+            log.trace('cannot precompile "%s"', pattern, exc_info=ex)
+            return re.compile(pattern)
+        self.regexes[pattern] = args
+        self.dirty = True
+        return regex
+
+    def set_subscriptions(self, subscriptions):
+        self.subscriptions = subscriptions
+        self.dirty = True
+
+    def save(self, cachedir):
+        '''
+        Write the cache under cachedir if it changed.
+        '''
+        if self.key is None or not self.dirty or self.opts is None:
+            return
+        path = os.path.join(cachedir, 'alert', CACHE_FILE)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        data = {'key': self.key,
+                'opts': self.opts,
+                'subscriptions': self.subscriptions,
+                'regexes': self.regexes}
+        try:
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            # the options include the agents' passwords
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+            self.dirty = False
+            log.debug('saved config cache %s', path)
+        except (IOError, OSError, pickle.PicklingError), ex:
+            log.warning('cannot write config cache %s', path, exc_info=ex)
+
+def _cachedir(text, defaults):
+    '''
+    Return the cachedir set in a config file's text, without parsing it.
+    '''
+    opts = {'cachedir': defaults['cachedir'], 'root_dir': defaults['root_dir']}
+    for match in PATH_OPTION.finditer(text):
+        opts[match.group(1)] = match.group(2)
+    return os.path.normpath(os.sep.join([os.path.abspath(opts['root_dir']),
+                                         opts['cachedir']]))
+
+def _read(path, key):
+    '''
+    Return the CompiledConfig cached in path for key, or None.
+    '''
+    try:
+        with open(path, 'rb') as fp:
+            data = pickle.load(fp)
+    except (IOError, OSError), ex:
+        log.trace('no config cache %s: %s', path, ex)
+        return None
+    except Exception, ex:
+        log.warning('ignore invalid config cache %s', path, exc_info=ex)
+        return None
+    if not isinstance(data, dict) or data.get('key') != key:
+        log.debug('config changed: rebuild config cache %s', path)
+        return None
+    return CompiledConfig(key, data['opts'], data['subscriptions'],
+                          data['regexes'])
+
+_current = CompiledConfig()
+
+def load_config(opts, path, env_var):
+    '''
+    Update opts from the config file like salt.config.load_config(),
+    from the cache if the file did not change.  The options that were
+    not changed by the file must be the defaults.
+    '''
+    global _current
+    if not path or not os.path.isfile(path):
+        path = os.environ.get(env_var, path)
+    try:
+        with open(path, 'rb') as fp:
+            text = fp.read()
+    except (IOError, OSError, TypeError):
+        salt.config.load_config(opts, path, env_var)
+        _current = CompiledConfig()
+        return
+    key = config_hash(text)
+    cache = os.path.join(_cachedir(text, opts), 'alert', CACHE_FILE)
+    compiled = _read(cache, key)
+    if compiled is not None:
+        log.debug('loaded config from cache %s', cache)
+        opts.update(compiled.opts)
+    else:
+        salt.config.load_config(opts, path, env_var)
+        compiled = CompiledConfig(key, dict(opts))
+        compiled.dirty = True
+    opts['config_hash'] = key
+    _current = compiled
+
+def current(config):
+    '''
+    Return the CompiledConfig of a config loaded by load_config(), or an
+    empty one that is never saved for any other config.
+    '''
+    if _current.key is not None and config.get('config_hash') == _current.key:
+        return _current
+    return CompiledConfig()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
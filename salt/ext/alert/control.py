@@ -0,0 +1,85 @@
+'''
+Local control sockets of the alert server.
+
+The requests that are not for minions, like adding a maintenance window
+or reading the delivery statistics, are served on unix sockets in the
+alert server's main process, which only the server's user can open.  A
+client sends one JSON object per line and reads a JSON line in reply to
+each, e.g.
+
+    $ echo '{"cmd": "stats"}' | nc -U /tmp/.salt-unix/alert_stats.sock
+'''
+import json
+import os
+import socket
+import threading
+
+import salt.log
+
+CLIENT_TIMEOUT = 5.0
+
+log = salt.log.getLogger(__name__)
+
+def serve(path, handler, name):
+    '''
+    Serve a control socket at path on a thread.  handler is called with
+    each request, a parsed JSON object, and returns the reply.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> serve(path, lambda request: {'ok': True, 'echo': request}, 'test')
+    >>> client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    >>> client.connect(path)
+    >>> stream = client.makefile('r+b')
+    >>> stream.write('{"cmd": "ping"}\\nbogus\\n')
+    >>> stream.flush()
+    >>> json.loads(stream.readline())['echo']
+    {u'cmd': u'ping'}
+    >>> json.loads(stream.readline())['ok']
+    False
+    >>> client.close(); os.unlink(path)
+    '''
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(5)
+    thread = threading.Thread(target=_serve, args=(listener, handler, name),
+                              name='alert-' + name)
+    thread.daemon = True
+    thread.start()
+    log.debug('%s socket %s', name, path)
+
+def _serve(listener, handler, name):
+    '''
+    Answer the clients of a control socket, one at a time, forever.
+    '''
+    while True:
+        conn, addr = listener.accept()
+        try:
+            conn.settimeout(CLIENT_TIMEOUT)
+            stream = conn.makefile('r+b')
+            for line in stream:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError, ex:
+                    reply = {'ok': False, 'error': str(ex)}
+                else:
+                    reply = handler(request)
+                stream.write(json.dumps(reply) + '\n')
+                stream.flush()
+            stream.close()
+        except (IOError, socket.error), ex:
+            log.debug('%s socket client failed', name, exc_info=ex)
+        finally:
+            conn.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,275 @@
+'''
+The delivery engine shared by the alert agents.
+
+Agents deliver alerts through Agent._deliver_async(), which returns a
+Deferred.  Agents whose delivery never blocks (e.g. one that only queues
+messages for its own connection) complete it inline.  Blocking work,
+like an SMTP transaction or an HTTP POST, runs as a job on the engine's
+fixed pool of worker threads, so the number of threads does not grow
+with the number of connections or messages in flight.  Timers run on
+the shared scheduler thread.
+
+The engine bounds the number of jobs in flight.  When the bound is
+reached, submit() blocks the alert dispatcher until a job finishes, so
+the ingest queue fills up and sheds low severity alerts instead of the
+engine queueing without limit.
+'''
+import collections
+import os
+import threading
+
+import salt.log
+import salt.ext.alert.scheduler
+
+DEFAULT_WORKERS      = 4
+DEFAULT_MAX_INFLIGHT = 1000
+
+log = salt.log.getLogger(__name__)
+
+class Deferred(object):
+    '''
+    The result of a delivery that completes later.
+
+    >>> results = []
+    >>> d = Deferred()
+    >>> d.add_callback(lambda d: results.append(d.result))
+    >>> d.finish('sent')
+    >>> results, d.done()
+    (['sent'], True)
+
+    # callbacks added after completion run immediately
+    >>> d.add_callback(lambda d: results.append('late'))
+    >>> results
+    ['sent', 'late']
+    '''
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.callbacks = []
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        '''
+        Wait until the delivery completes.  Return True if it did.
+        '''
+        return self.event.wait(timeout)
+
+    def add_callback(self, callback):
+        '''
+        Call callback(deferred) when the delivery completes.
+        '''
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        self.__call(callback)
+
+    def finish(self, result=None, error=None):
+        '''
+        Complete the delivery with a result or an exception.
+        '''
+        with self.lock:
+            self.result = result
+            self.error = error
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.event.set()
+        for callback in callbacks:
+            self.__call(callback)
+
+    def __call(self, callback):
+        try:
+            callback(self)
+        except Exception, ex:
+            log.error('deferred callback %s failed', callback, exc_info=ex)
+
+def succeed(result=None):
+    '''
+    Return a completed Deferred.
+    '''
+    deferred = Deferred()
+    deferred.finish(result)
+    return deferred
+
+def gather(deferreds):
+    '''
+    Return a Deferred that completes when all deferreds complete.  Its
+    result is the list of their results.
+
+    >>> a, b = Deferred(), Deferred()
+    >>> both = gather([a, b])
+    >>> a.finish(1)
+    >>> both.done()
+    False
+    >>> b.finish(2)
+    >>> both.result
+    [1, 2]
+    '''
+    deferreds = list(deferreds)
+    gathered = Deferred()
+    if not deferreds:
+        gathered.finish([])
+        return gathered
+    remaining = [len(deferreds)]
+    lock = threading.Lock()
+    def one_done(deferred):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        gathered.finish([d.result for d in deferreds])
+    for deferred in deferreds:
+        deferred.add_callback(one_done)
+    return gathered
+
+class Engine(object):
+    '''
+    Run delivery jobs on a fixed pool of worker threads.
+
+    >>> engine = Engine(workers=2, max_inflight=10)
+    >>> jobs = [engine.submit(pow, 2, n) for n in range(5)]
+    >>> gather(jobs).wait(5)
+    True
+    >>> [job.result for job in jobs]
+    [1, 2, 4, 8, 16]
+    >>> failed = engine.submit(int, 'x')
+    >>> failed.wait(5), type(failed.error)
+    (True, <type 'exceptions.ValueError'>)
+    '''
+    def __init__(self, workers=DEFAULT_WORKERS,
+                       max_inflight=DEFAULT_MAX_INFLIGHT,
+                       name='alert-engine'):
+        self.name = name
+        self.workers = max(workers, 1)
+        self.max_inflight = max(max_inflight, 1)
+        self.jobs = collections.deque()
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.room = threading.Condition(self.lock)
+        self.threads = []
+        self.pid = None
+
+    def configure(self, config):
+        '''
+        Configure the engine from the alert.engine data in
+        /etc/salt/alert.  Takes effect when the workers are started.
+        '''
+        config = config or {}
+        with self.lock:
+            self.workers = max(config.get('workers', self.workers), 1)
+            self.max_inflight = max(config.get('max_inflight',
+                                               self.max_inflight), 1)
+        log.trace('engine: workers=%s max_inflight=%s',
+                  self.workers, self.max_inflight)
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Run func(*args, **kwargs) on a worker thread.  Return a Deferred
+        of its result.  Blocks while max_inflight jobs are in flight.
+        '''
+        return self.__submit(True, func, args, kwargs)
+
+    def submit_nowait(self, func, *args, **kwargs):
+        '''
+        Like submit(), but never blocks.  For jobs submitted by other
+        jobs and callbacks, which must not wait for themselves.
+        '''
+        return self.__submit(False, func, args, kwargs)
+
+    def call_later(self, delay, callback, *args):
+        '''
+        Call callback(*args) in delay seconds on the shared scheduler
+        thread.  Return a Timer that can be cancelled.
+        '''
+        return salt.ext.alert.scheduler.schedule(delay, callback, *args)
+
+    def stats(self):
+        '''
+        Return the engine statistics.
+        '''
+        with self.lock:
+            return {'workers': self.workers,
+                    'inflight': self.inflight,
+                    'queued': len(self.jobs),
+                    'max_inflight': self.max_inflight}
+
+    def __submit(self, block, func, args, kwargs):
+        deferred = Deferred()
+        with self.lock:
+            self.__start()
+            while block and self.inflight >= self.max_inflight:
+                self.room.wait()
+            self.inflight += 1
+            self.jobs.append((deferred, func, args, kwargs))
+            self.ready.notify()
+        return deferred
+
+    def __start(self):
+        '''
+        Start the worker threads in this process if necessary.  Must
+        hold the lock.
+        '''
+        if self.pid == os.getpid():
+            return
+        # forked: the parent's jobs are its own
+        self.jobs.clear()
+        self.inflight = 0
+        self.threads = []
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self.__run,
+                                      name='{}-{}'.format(self.name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.pid = os.getpid()
+
+    def __run(self):
+        while True:
+            with self.lock:
+                while not self.jobs:
+                    self.ready.wait()
+                deferred, func, args, kwargs = self.jobs.popleft()
+            try:
+                result, error = func(*args, **kwargs), None
+            except Exception, ex:
+                log.error('engine job %s failed', func, exc_info=ex)
+                result, error = None, ex
+            with self.lock:
+                self.inflight -= 1
+                self.room.notify()
+            deferred.finish(result, error)
+
+_default = Engine()
+
+def configure(config):
+    '''
+    Configure the shared engine.
+    '''
+    _default.configure(config)
+
+def submit(func, *args, **kwargs):
+    '''
+    Run func(*args, **kwargs) on the shared engine.
+    '''
+    return _default.submit(func, *args, **kwargs)
+
+def submit_nowait(func, *args, **kwargs):
+    '''
+    Run func(*args, **kwargs) on the shared engine without blocking.
+    '''
+    return _default.submit_nowait(func, *args, **kwargs)
+
+def stats():
+    '''
+    Return the statistics of the shared engine.
+    '''
+    return _default.stats()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
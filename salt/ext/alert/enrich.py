@@ -0,0 +1,276 @@
+'''
+Enrichment of alerts with host metadata.
+
+With alert.enrich, selected grains of the host an alert came from, e.g.
+team, datacenter and role, are added to the alert as fields of the same
+name, so they can be used in templates (${team}) and subscription
+filters (fields: {datacenter: dc1}).  A field the alert already has is
+not overwritten.
+
+The grains are looked up with the salt LocalClient, which can take
+seconds, so alerts never wait for a lookup.  The lookup for a host
+starts when its alert is ingested, and the alert is enriched when it is
+delivered with whatever is in the cache by then (optionally waiting up
+to 'wait' seconds).  The hosts requested within batch_wait seconds are
+looked up with a single grains.items call.  The cache holds up to size
+hosts for ttl seconds; expired entries are still used while they are
+refreshed.
+'''
+import collections
+import threading
+import time
+
+import salt.log
+import salt.ext.alert.engine
+import salt.ext.alert.scheduler
+
+DEFAULT_GRAINS     = ['team', 'datacenter', 'role']
+DEFAULT_TTL        = 300
+DEFAULT_MISS_TTL   = 60
+DEFAULT_SIZE       = 10000
+DEFAULT_BATCH_WAIT = 0.1
+DEFAULT_TIMEOUT    = 10
+DEFAULT_WAIT       = 0
+
+log = salt.log.getLogger(__name__)
+
+class Enricher(object):
+    '''
+    Add host grains to alerts from a TTL cache fed by batched lookups.
+
+    >>> class StubClient(object):
+    ...     calls = []
+    ...     def cmd(self, tgt, fun, arg=(), timeout=None, expr_form='glob'):
+    ...         self.calls.append((sorted(tgt), fun, expr_form))
+    ...         return dict((host, {'team': 'ops', 'role': 'web', 'os': 'x'})
+    ...                     for host in tgt if host != 'gone')
+    >>> client = StubClient()
+    >>> e = Enricher(client, grains=['team', 'role'], batch_wait=60)
+    >>> for host in ['web1', 'web2', 'gone', 'web1']:
+    ...     e.request(host)
+    >>> alert = {'host': 'web1', 'role': 'db'}
+    >>> e.enrich(alert)
+    >>> alert
+    {'host': 'web1', 'role': 'db'}
+
+    # the requested hosts are looked up in one call
+    >>> e.flush().wait(5)
+    True
+    >>> client.calls
+    [(['gone', 'web1', 'web2'], 'grains.items', 'list')]
+    >>> e.enrich(alert)
+    >>> sorted(alert.items())
+    [('host', 'web1'), ('role', 'db'), ('team', 'ops')]
+    >>> alert = {'host': 'gone'}
+    >>> e.enrich(alert)
+    >>> alert
+    {'host': 'gone'}
+    >>> sorted(e.stats().items())
+    [('batches', 1), ('errors', 0), ('hits', 2), ('hosts', 3), ('lookups', 3), ('misses', 1)]
+    '''
+    def __init__(self, client,
+                       grains=DEFAULT_GRAINS,
+                       ttl=DEFAULT_TTL,
+                       miss_ttl=DEFAULT_MISS_TTL,
+                       size=DEFAULT_SIZE,
+                       batch_wait=DEFAULT_BATCH_WAIT,
+                       timeout=DEFAULT_TIMEOUT,
+                       wait=DEFAULT_WAIT):
+        '''
+        client     = a salt LocalClient, or a function that creates one.
+                     The function is called in the process that looks
+                     up hosts.
+        grains     = the grains added to alerts
+        ttl        = seconds a host's grains are cached
+        miss_ttl   = seconds a host that did not answer is cached
+        size       = maximum number of hosts cached
+        batch_wait = seconds to collect requested hosts into one lookup
+        timeout    = seconds a lookup waits for the hosts to answer
+        wait       = seconds enrich() waits for a pending lookup
+        '''
+        self.client = client
+        self.grains = list(grains)
+        self.ttl = ttl
+        self.miss_ttl = min(miss_ttl, ttl)
+        self.size = size
+        self.batch_wait = batch_wait
+        self.timeout = timeout
+        self.wait = wait
+        self.lock = threading.Lock()
+        # host => (expires, grains), least recently used first
+        self.cache = collections.OrderedDict()
+        # the hosts to look up next, and the Deferred of their lookup
+        self.batch = set()
+        self.batch_done = salt.ext.alert.engine.Deferred()
+        self.batch_timer = None
+        # host => Deferred of the lookup in flight
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+        self.batches = 0
+        self.errors = 0
+
+    def request(self, host, now=None):
+        '''
+        Look up a host in the background unless its grains are cached
+        and fresh.  Never blocks.
+        '''
+        if not host:
+            return
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.__request(host, now)
+
+    def enrich(self, alert, now=None):
+        '''
+        Add the cached grains of the alert's host to the alert.
+        '''
+        host = alert.get('host')
+        if not host:
+            return
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.cache.get(host)
+            pending = None
+            if entry is None:
+                pending = self.__request(host, now)
+        if entry is None and pending is not None and self.wait > 0:
+            pending.wait(self.wait)
+            with self.lock:
+                entry = self.cache.get(host)
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            return
+        with self.lock:
+            self.hits += 1
+            if host in self.cache:
+                # most recently used
+                self.cache[host] = self.cache.pop(host)
+            if entry[0] <= now:
+                self.__request(host, now)
+        for grain, value in entry[1].iteritems():
+            if grain not in alert:
+                alert[grain] = value
+
+    def flush(self):
+        '''
+        Look up the requested hosts now.  Return a Deferred that
+        completes when they are cached.
+        '''
+        with self.lock:
+            hosts = self.batch
+            done = self.batch_done
+            self.batch = set()
+            self.batch_done = salt.ext.alert.engine.Deferred()
+            if self.batch_timer is not None:
+                self.batch_timer.cancel()
+                self.batch_timer = None
+            for host in hosts:
+                self.inflight[host] = done
+        if not hosts:
+            done.finish()
+            return done
+        salt.ext.alert.engine.submit_nowait(self.__lookup, hosts, done)
+        return done
+
+    def stats(self):
+        '''
+        Return the cache statistics.
+        '''
+        with self.lock:
+            return {'hosts': len(self.cache),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'lookups': self.lookups,
+                    'batches': self.batches,
+                    'errors': self.errors}
+
+    def __request(self, host, now):
+        '''
+        Add a host to the next batch unless it is fresh or being looked
+        up.  Return the Deferred of its lookup, or None.  Must hold the
+        lock.
+        '''
+        entry = self.cache.get(host)
+        if entry is not None and entry[0] > now:
+            return None
+        if host in self.inflight:
+            return self.inflight[host]
+        self.batch.add(host)
+        if self.batch_timer is None:
+            self.batch_timer = salt.ext.alert.scheduler.schedule(
+                    self.batch_wait, self.flush)
+        return self.batch_done
+
+    def __client(self):
+        if isinstance(self.client, type) or not hasattr(self.client, 'cmd'):
+            self.client = self.client()
+        return self.client
+
+    def __lookup(self, hosts, done):
+        '''
+        Look up the grains of hosts with one call.  Runs on the engine.
+        '''
+        hosts = sorted(hosts)
+        log.debug('look up grains of %s host(s)', len(hosts))
+        try:
+            returns = self.__client().cmd(hosts, 'grains.items',
+                                          timeout=self.timeout,
+                                          expr_form='list')
+            error = None
+        except Exception, ex:
+            log.warning('grains lookup of %s host(s) failed', len(hosts),
+                        exc_info=ex)
+            returns, error = {}, ex
+        now = time.time()
+        with self.lock:
+            self.batches += 1
+            self.lookups += len(hosts)
+            if error is not None:
+                self.errors += 1
+            for host in hosts:
+                self.inflight.pop(host, None)
+                grains = returns.get(host)
+                if isinstance(grains, dict):
+                    grains = dict((grain, grains[grain])
+                                    for grain in self.grains
+                                    if grain in grains)
+                    self.cache[host] = (now + self.ttl, grains)
+                elif host not in self.cache:
+                    self.cache[host] = (now + self.miss_ttl, {})
+                else:
+                    # keep the last known grains of a host that did not
+                    # answer
+                    self.cache[host] = (now + self.miss_ttl,
+                                        self.cache[host][1])
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        done.finish()
+
+def load_enricher(config, client):
+    '''
+    Create the enricher configured in alert.enrich, or return None if
+    alerts are not enriched.
+    '''
+    config = config.get('alert.enrich')
+    if not config:
+        return None
+    if not isinstance(config, dict):
+        config = {}
+    log.trace('enrich alerts: %s', config)
+    return Enricher(client,
+                    grains=config.get('grains', DEFAULT_GRAINS),
+                    ttl=config.get('ttl', DEFAULT_TTL),
+                    miss_ttl=config.get('miss_ttl', DEFAULT_MISS_TTL),
+                    size=config.get('size', DEFAULT_SIZE),
+                    batch_wait=config.get('batch_wait', DEFAULT_BATCH_WAIT),
+                    timeout=config.get('timeout', DEFAULT_TIMEOUT),
+                    wait=config.get('wait', DEFAULT_WAIT))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
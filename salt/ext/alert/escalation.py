@@ -0,0 +1,239 @@
+'''
+Escalation of alerts that are not cleared.
+
+An escalation policy matches alerts like a subscription, by a
+category/severity regex and optional hosts and fields.  When a raised
+alert it matches is not followed by its clear, the alert of the same
+host and category, within 'after' seconds, the alert is delivered again
+to the policy's subscribers, e.g. the team lead.  The escalation repeats
+every 'after' seconds until the alert is cleared, or up to 'repeat'
+times.
+
+The alert server receives alerts in several processes, and an alert and
+its clear may arrive in different ones.  The open alerts are tracked by
+a single escalation process, started before the alert server forks, to
+which the other processes hand the raised alerts that a policy matches
+and every clear.  Each open alert has a timer on the shared scheduler
+and is indexed by host and category, so a clear cancels its escalation
+at once.
+'''
+import multiprocessing
+import os
+import Queue
+import threading
+
+import salt.log
+import salt.ext.alert.scheduler
+
+from salt.ext.alert.router import Router
+
+DEFAULT_AFTER      = 30 * 60
+DEFAULT_REPEAT     = 0          # unlimited
+DEFAULT_QUEUE_SIZE = 10000
+
+log = salt.log.getLogger(__name__)
+
+def format_duration(seconds):
+    '''
+    Format a duration for a message.
+
+    >>> format_duration(45), format_duration(1800), format_duration(5400)
+    ('45 seconds', '30 minutes', '90 minutes')
+    '''
+    if seconds < 60:
+        return '{:.0f} seconds'.format(seconds)
+    return '{:.0f} minutes'.format(seconds / 60.0)
+
+class Policy(object):
+    '''
+    An escalation policy: the alerts it matches, how long they may stay
+    open, and who they are escalated to.
+    '''
+    def __init__(self, regex, filters, after, repeat, targets):
+        '''
+        regex   = the compiled category/severity regex
+        filters = field name => list of values or globs, or None
+        after   = seconds until an open alert is escalated, and between
+                  escalations
+        repeat  = the maximum number of escalations, 0 for no limit
+        targets = list of (agent, subscribers) to escalate to, where the
+                  subscribers are parsed by the agent
+        '''
+        self.regex = regex
+        self.filters = filters
+        self.after = after
+        self.repeat = repeat
+        self.targets = targets
+
+class Escalator(object):
+    '''
+    Track the open alerts matched by escalation policies, and escalate
+    those that are not cleared in time.
+
+    >>> import re, threading
+    >>> class Agent(object):
+    ...     sent = threading.Event()
+    ...     def _deliver_async(self, subscribers, alert):
+    ...         print subscribers, alert['escalation'], alert['msg']
+    ...         self.sent.set()
+    >>> agent = Agent()
+    >>> policy = Policy(re.compile('.*/critical'), None, 0.05, 1,
+    ...                 [(agent, ['lead'])])
+    >>> e = Escalator([policy])
+    >>> e.track('raised', {'host': 'db1', 'category': 'disk.full',
+    ...                    'severity': 'critical', 'msg': 'disk full'})
+    >>> e.track('raised', {'host': 'db2', 'category': 'disk.full',
+    ...                    'severity': 'critical', 'msg': 'disk full'})
+    >>> e.track('cleared', {'host': 'db2', 'category': 'disk.full',
+    ...                     'severity': 'ok', 'msg': 'disk ok'})
+    >>> agent.sent.wait(5)
+    ['lead'] 1 disk full (not cleared for 0 seconds)
+    True
+    '''
+    def __init__(self, policies, queue_size=DEFAULT_QUEUE_SIZE):
+        self.policies = policies
+        self.router = Router()
+        for index, policy in enumerate(policies):
+            self.router.add(policy.regex, index, policy.filters)
+        self.queue = multiprocessing.Queue(queue_size)
+        self.process = None
+        self.lock = threading.Lock()
+        # (host, category) => {policy index: (generation, timer)}
+        self.open = {}
+        self.generation = 0
+        # shared by the processes
+        self.open_count = multiprocessing.Value('l', 0)
+        self.escalated = multiprocessing.Value('l', 0)
+        self.dropped = multiprocessing.Value('l', 0)
+
+    def start(self):
+        '''
+        Start the escalation process.  Must be called before the alert
+        server forks its request workers, so they share its queue.
+        Until it is started, alerts are tracked in the calling process.
+        '''
+        self.process = multiprocessing.Process(target=self._run,
+                                               name='alert-escalation')
+        self.process.daemon = True
+        self.process.start()
+        log.debug('started escalation process: %s policies',
+                  len(self.policies))
+
+    def track(self, verb, alert):
+        '''
+        Track an alert: open an escalation for a raised alert that a
+        policy matches, and cancel the escalation of a cleared one.  A
+        raised alert must be prepared; a clear only needs its host and
+        category, and must be tracked even if it is not delivered.  verb
+        is the alert's verb before it was prepared.
+        '''
+        key = (alert.get('host'), alert.get('category'))
+        if verb == 'cleared':
+            event = (verb, key, None, None)
+        else:
+            matched = set()
+            for indexes in self.router.match(alert).itervalues():
+                matched.update(indexes)
+            if not matched:
+                return
+            event = (verb, key, sorted(matched), alert)
+        if self.process is None:
+            self.__handle(event)
+            return
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            with self.dropped.get_lock():
+                self.dropped.value += 1
+            log.warning('escalation queue full: drop %s of %s', verb, key)
+
+    def stats(self):
+        '''
+        Return the number of open alerts and of escalations.
+        '''
+        return {'open': self.open_count.value,
+                'escalated': self.escalated.value,
+                'dropped': self.dropped.value}
+
+    def _run(self):
+        '''
+        Track the alerts handed to the escalation process, forever.
+        This method runs in the escalation process.
+        '''
+        log.debug('escalation process: pid %s', os.getpid())
+        while True:
+            event = self.queue.get()
+            try:
+                self.__handle(event)
+            except Exception, ex:
+                log.error('failed to track alert for escalation: %s',
+                          event, exc_info=ex)
+
+    def __handle(self, event):
+        verb, key, indexes, alert = event
+        with self.lock:
+            if verb == 'cleared':
+                timers = self.open.pop(key, None)
+                if timers is None:
+                    return
+                for generation, timer in timers.itervalues():
+                    timer.cancel()
+                log.trace('escalation: %s cleared', key)
+            elif key in self.open:
+                # already open: a repeated raise does not restart it
+                return
+            else:
+                self.open[key] = dict(
+                        (index, self.__schedule(key, index, alert, 1))
+                        for index in indexes)
+            count = len(self.open)
+        self.open_count.value = count
+
+    def __schedule(self, key, index, alert, escalation):
+        '''
+        Schedule an escalation of an open alert.  Must hold the lock.
+        '''
+        self.generation += 1
+        timer = salt.ext.alert.scheduler.schedule(
+                self.policies[index].after, self.__escalate, key, index,
+                alert, escalation, self.generation)
+        return (self.generation, timer)
+
+    def __escalate(self, key, index, alert, escalation, generation):
+        '''
+        Escalate an open alert.  Runs on the scheduler thread.
+        '''
+        policy = self.policies[index]
+        with self.lock:
+            timers = self.open.get(key)
+            if not timers or timers.get(index, (None,))[0] != generation:
+                # cleared while it was being escalated
+                return
+            if policy.repeat and escalation >= policy.repeat:
+                del timers[index]
+                if not timers:
+                    del self.open[key]
+            else:
+                timers[index] = self.__schedule(key, index, alert,
+                                                escalation + 1)
+            count = len(self.open)
+        self.open_count.value = count
+        with self.escalated.get_lock():
+            self.escalated.value += 1
+        escalated = dict(alert)
+        escalated.pop('trace', None)
+        escalated['escalation'] = escalation
+        escalated['msg'] = '{} (not cleared for {})'.format(
+                alert.get('msg', ''),
+                format_duration(policy.after * escalation))
+        log.debug('escalate %s: %s', escalation, key)
+        for agent, subscribers in policy.targets:
+            try:
+                agent._deliver_async(subscribers, escalated)
+            except Exception, ex:
+                log.error('failed to escalate alert: %s', escalated,
+                          exc_info=ex)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
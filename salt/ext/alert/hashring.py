@@ -0,0 +1,83 @@
+'''
+Consistent hashing of keys (e.g. recipient addresses) onto named nodes
+(e.g. connections or worker processes).  Adding or removing a node only
+moves the keys assigned to that node.
+'''
+import bisect
+import hashlib
+
+DEFAULT_REPLICAS = 100
+
+def stable_hash(key):
+    '''
+    Return a hash of key that is the same in every process and every run,
+    unlike hash().
+
+    >>> stable_hash('recipient@example.com') == stable_hash('recipient@example.com')
+    True
+    '''
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+class HashRing(object):
+    '''
+    A consistent hash ring.  Each node is placed on the ring several times
+    (replicas) to spread the keys evenly.  A key belongs to the first node
+    found clockwise from the key's hash.
+
+    >>> ring = HashRing(['a', 'b', 'c'])
+    >>> keys = ['user{}@example.com'.format(i) for i in range(1000)]
+    >>> owners = dict((key, ring.get(key)) for key in keys)
+    >>> sorted(set(owners.values()))
+    ['a', 'b', 'c']
+
+    # when node 'b' is down, only its keys move
+    >>> moved = [key for key in keys if ring.get(key, lambda n: n != 'b') != owners[key]]
+    >>> set(owners[key] for key in moved)
+    set(['b'])
+    '''
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        '''
+        Create a ring of nodes.  Each node must be a unique string.
+        '''
+        self.nodes = list(nodes)
+        points = []
+        for node in self.nodes:
+            for replica in xrange(replicas):
+                points.append((stable_hash('{}#{}'.format(node, replica)),
+                               node))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, key, alive=None):
+        '''
+        Return the node that owns key.  If alive is specified, it is a
+        function that returns False for nodes that must be skipped, and
+        the next node on the ring is returned instead.  Return None if
+        the ring is empty or all nodes are skipped.
+        '''
+        if not self.hashes:
+            return None
+        start = bisect.bisect(self.hashes, stable_hash(key)) % len(self.hashes)
+        if alive is None:
+            return self.owners[start]
+        tried = set()
+        for idx in xrange(len(self.owners)):
+            node = self.owners[(start + idx) % len(self.owners)]
+            if node in tried:
+                continue
+            if alive(node):
+                return node
+            tried.add(node)
+            if len(tried) == len(self.nodes):
+                break
+        return None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
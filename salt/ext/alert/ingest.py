@@ -0,0 +1,315 @@
+'''
+A bounded queue between the alert server and the alert agents.
+
+Alerts arrive on the ReqServer workers faster than a slow relay or a
+throttled Jabber account can deliver them.  The ingest queue bounds the
+number of alerts waiting for delivery.  When the queue fills up, low
+severity alerts are shed first.  Protected (critical) alerts are never
+shed.
+
+Each ReqServer worker process has its own queue, so the size bounds the
+alerts waiting in each process, not in the whole server.  The counts
+in the statistics are kept in shared memory and cover all processes.
+'''
+import collections
+import itertools
+import math
+import multiprocessing
+import threading
+import time
+
+import salt.log
+
+from salt.ext.alert.hashring import stable_hash
+
+DEFAULT_SIZE       = 1000
+DEFAULT_POLICY     = 'drop'
+DEFAULT_PROTECT    = 'critical'
+DEFAULT_HIGH_WATER = 0.8
+DEFAULT_SAMPLE     = 0.1
+
+POLICIES = ('drop', 'sample')
+
+SHED_SLOTS    = 64      # categories counted in the shed statistics
+CATEGORY_SIZE = 64      # bytes of a category name in the statistics
+OTHER         = '(other)'
+
+# Known severities from least to most severe.  Unknown severities rank
+# below all of them and are the first to be shed.
+SEVERITIES = ('debug', 'info', 'notice', 'warning',
+              'error', 'critical', 'alert', 'emergency')
+SEVERITY_RANKS = dict((name, rank + 1) for rank, name in enumerate(SEVERITIES))
+
+log = salt.log.getLogger(__name__)
+
+def severity_rank(severity):
+    '''
+    Return the rank of a severity name.  Higher ranks are more severe.
+
+    >>> severity_rank('warning') < severity_rank('CRITICAL')
+    True
+    >>> severity_rank('bogus')
+    0
+    '''
+    if not severity:
+        return 0
+    return SEVERITY_RANKS.get(severity.lower(), 0)
+
+class IngestQueue(object):
+    '''
+    A bounded, thread-safe queue of alerts with severity-based load
+    shedding.  Alerts are delivered in the order they arrived.
+
+    Shedding starts when the queue is more than high_water full.  As the
+    queue fills from high_water to size, progressively more severe alerts
+    are shed, starting with the least severe.  When the queue is full, an
+    incoming alert evicts the oldest queued alert of a lower severity.
+    Alerts at or above the protected severity are always queued, even if
+    that exceeds the queue size.
+
+    >>> q = IngestQueue(size=4, high_water=0.5)
+    >>> for sev in ['info', 'info', 'warning', 'notice', 'critical', 'critical']:
+    ...     q.put({'category': 'disk', 'severity': sev})
+    True
+    True
+    True
+    False
+    True
+    True
+    >>> [q.get()['severity'] for i in range(len(q))]
+    ['info', 'warning', 'critical', 'critical']
+    >>> q.shed
+    {'disk': 2}
+
+    # the statistics count the alerts of all processes
+    >>> import os
+    >>> q.put({'category': 'load', 'severity': 'info'})
+    True
+    >>> pid = os.fork()
+    >>> if pid == 0:
+    ...     q.put({'category': 'load', 'severity': 'info'})
+    ...     os._exit(0)
+    >>> os.waitpid(pid, 0)[1]
+    0
+    >>> len(q), sorted(q.stats().items())
+    (1, [('length', 2), ('queued', 7), ('shed', {'disk': 2}), ('size', 4)])
+    '''
+    def __init__(self, size=DEFAULT_SIZE,
+                       policy=DEFAULT_POLICY,
+                       protect=DEFAULT_PROTECT,
+                       high_water=DEFAULT_HIGH_WATER,
+                       sample=DEFAULT_SAMPLE):
+        '''
+        Create an ingest queue.
+
+        size       = the number of queued alerts that triggers eviction.
+                     If size is None or less than or equal to zero, the
+                     queue is unbounded and nothing is ever shed.
+        policy     = 'drop' sheds every low severity alert while the
+                     queue is overloaded.  'sample' keeps a fraction of
+                     them.
+        protect    = the lowest severity that is never shed
+        high_water = the fraction of size at which shedding starts
+        sample     = the fraction of low severity alerts kept by the
+                     'sample' policy while the queue is overloaded
+        '''
+        if policy not in POLICIES:
+            raise ValueError('unknown ingest policy "{}": expected {}'.format(
+                                policy, ' or '.join(POLICIES)))
+        if size <= 0:
+            size = None
+        self.size = size
+        self.policy = policy
+        self.protect = severity_rank(protect) or SEVERITY_RANKS[DEFAULT_PROTECT]
+        self.high_water = min(max(high_water, 0.0), 1.0)
+        self.sample_every = max(int(round(1.0 / sample)), 1) if sample > 0 \
+                                                              else None
+        self.cond = threading.Condition()
+        self.queues = collections.defaultdict(collections.deque)
+        self.seq = itertools.count()
+        self.length = 0
+        self.overloaded = False
+        self.samples = collections.defaultdict(int)
+        # shared by the processes: the alerts queued now and ever, and
+        # the alerts shed per category, in SHED_SLOTS slots
+        self.counts_lock = multiprocessing.Lock()
+        self.total_length = multiprocessing.RawValue('l', 0)
+        self.total_queued = multiprocessing.RawValue('l', 0)
+        self.shed_names = multiprocessing.RawArray(
+                'c', SHED_SLOTS * CATEGORY_SIZE)
+        self.shed_counts = multiprocessing.RawArray('l', SHED_SLOTS)
+
+    def __len__(self):
+        return self.length
+
+    def put(self, alert):
+        '''
+        Queue an alert.  Return False if the alert was shed.
+        This method never blocks.
+        '''
+        category = alert.get('category', 'unknown')
+        rank = severity_rank(alert.get('severity'))
+        with self.cond:
+            if self.size and rank < self.protect:
+                if self._shedding(rank, category):
+                    self._count_shed(category)
+                    return False
+            if self.size and self.length >= self.size:
+                if not self._evict(rank):
+                    self._count_shed(category)
+                    return False
+            self.queues[rank].append((next(self.seq), alert))
+            self.length += 1
+            self.cond.notify()
+        with self.counts_lock:
+            self.total_length.value += 1
+            self.total_queued.value += 1
+        return True
+
+    def get(self, timeout=None):
+        '''
+        Remove and return the oldest queued alert.  Block until an alert
+        is available or, if timeout is not None, until timeout seconds
+        pass.  Return None on timeout.
+        '''
+        with self.cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self.length == 0:
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+            # there are only a handful of severities so scanning the
+            # heads of their queues is cheap
+            queue = min((q for q in self.queues.values() if q),
+                        key=lambda q: q[0][0])
+            seq, alert = queue.popleft()
+            self.length -= 1
+            if self.overloaded and self.length < self._high_water_len():
+                log.warning('ingest queue recovered: %s alert(s) queued',
+                            self.length)
+                self.overloaded = False
+        with self.counts_lock:
+            self.total_length.value -= 1
+        return alert
+
+    @property
+    def shed(self):
+        '''
+        The alerts shed by all processes, per category.
+        '''
+        shed = {}
+        with self.counts_lock:
+            for index in xrange(SHED_SLOTS):
+                count = self.shed_counts[index]
+                if count:
+                    name = self.shed_names[index * CATEGORY_SIZE:
+                                           (index + 1) * CATEGORY_SIZE]
+                    shed[name.rstrip('\0')] = count
+        return shed
+
+    def stats(self):
+        '''
+        Return the queue statistics of all processes: the alerts queued
+        now and ever, and those shed.  size is the bound of each
+        process's queue.
+        '''
+        with self.counts_lock:
+            length = self.total_length.value
+            queued = self.total_queued.value
+        return {'length': length,
+                'size': self.size,
+                'queued': queued,
+                'shed': self.shed}
+
+    def _high_water_len(self):
+        return self.size * self.high_water
+
+    def _shedding(self, rank, category):
+        '''
+        Return True if an alert of this rank should be shed because the
+        queue is overloaded.
+        '''
+        high_water = self._high_water_len()
+        if self.length < high_water:
+            return False
+        if not self.overloaded:
+            log.warning('ingest queue overloaded: %s alert(s) queued',
+                        self.length)
+            self.overloaded = True
+        fill = min((self.length - high_water + 1) / (self.size - high_water + 1),
+                   1.0)
+        # the least severe ranks are shed first
+        if rank >= int(math.ceil(self.protect * fill)):
+            return False
+        if self.policy == 'sample' and self.sample_every:
+            # keep the first of every sample_every shed candidates
+            self.samples[category] += 1
+            if (self.samples[category] - 1) % self.sample_every == 0:
+                return False
+        return True
+
+    def _evict(self, rank):
+        '''
+        Make room for an alert of the given rank by shedding the oldest
+        queued alert with the lowest rank.  Alerts at or above the
+        protected rank are never evicted, but are queued even if nothing
+        can be evicted.  Return True if the alert can be queued.
+        '''
+        limit = min(rank, self.protect)
+        for victim in sorted(self.queues):
+            if victim >= limit:
+                break
+            queue = self.queues[victim]
+            if queue:
+                seq, alert = queue.popleft()
+                self.length -= 1
+                with self.counts_lock:
+                    self.total_length.value -= 1
+                self._count_shed(alert.get('category', 'unknown'))
+                return True
+        return rank >= self.protect
+
+    def _count_shed(self, category):
+        '''
+        Count a shed alert in the shared slot of its category.  When all
+        slots are used, the alert is counted as OTHER in the last one.
+        '''
+        log.debug('shed %s alert', category)
+        name = str(category)[:CATEGORY_SIZE - 1]
+        padded = name.ljust(CATEGORY_SIZE, '\0')
+        start = stable_hash(name) % (SHED_SLOTS - 1)
+        with self.counts_lock:
+            for index in itertools.chain(xrange(start, SHED_SLOTS - 1),
+                                         xrange(start)):
+                offset = index * CATEGORY_SIZE
+                current = self.shed_names[offset:offset + CATEGORY_SIZE]
+                if current == padded or not self.shed_counts[index]:
+                    break
+            else:
+                index = SHED_SLOTS - 1
+                offset = index * CATEGORY_SIZE
+                padded = OTHER.ljust(CATEGORY_SIZE, '\0')
+            self.shed_names[offset:offset + CATEGORY_SIZE] = padded
+            self.shed_counts[index] += 1
+
+def load_queue(config):
+    '''
+    Create the ingest queue from the alert.ingest section of
+    /etc/salt/alert.
+    '''
+    qcfg = config.get('alert.ingest', {}) or {}
+    log.trace('alert ingest: %s', qcfg)
+    return IngestQueue(size=qcfg.get('size', DEFAULT_SIZE),
+                       policy=qcfg.get('policy', DEFAULT_POLICY),
+                       protect=qcfg.get('protect', DEFAULT_PROTECT),
+                       high_water=qcfg.get('high_water', DEFAULT_HIGH_WATER),
+                       sample=qcfg.get('sample', DEFAULT_SAMPLE))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
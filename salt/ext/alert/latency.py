@@ -0,0 +1,242 @@
+'''
+End-to-end latency tracking of alerts.
+
+Every alert gets a trace id when it is routed.  The latency of each stage
+of its delivery is sampled:
+
+    ingest        = the minion's alert time until the alert server
+                    received it (includes clock skew)
+    queue         = received until routed, i.e. the time in the ingest
+                    queue
+    send.<agent>  = routed until the agent sent it to a recipient
+    receipt.<agent> = sent until the recipient's client acknowledged it
+    total.<agent> = the minion's alert time until the recipient's client
+                    acknowledged it, or until it was sent if no receipt
+                    was requested
+
+Each stage keeps a window of recent samples, from which the percentiles
+are computed.  Every alert server worker process has its own tracker.
+With delivery workers (alert.workers), the routing process samples the
+ingest and queue latencies, and hands each alert's trace to the delivery
+workers, which sample the send, receipt and total latencies.
+'''
+import collections
+import itertools
+import math
+import os
+import threading
+import time
+
+import salt.log
+
+DEFAULT_SAMPLES = 1024
+MAX_TRACES = 10000
+PERCENTILES = (50, 90, 99)
+
+log = salt.log.getLogger(__name__)
+
+class Window(object):
+    '''
+    The most recent samples of a latency.
+
+    >>> w = Window(size=100)
+    >>> for i in range(1, 201):
+    ...     w.add(i / 10.0)
+    >>> sorted(w.percentiles().items())
+    [('count', 200), ('max', 20.0), ('p50', 15.0), ('p90', 19.0), ('p99', 19.9)]
+    '''
+    def __init__(self, size=DEFAULT_SAMPLES):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, sample):
+        self.samples.append(sample)
+        self.count += 1
+
+    def percentiles(self):
+        '''
+        Return the sample count and the percentiles of the window.
+        '''
+        samples = sorted(self.samples)
+        stats = {'count': self.count}
+        if not samples:
+            return stats
+        for pct in PERCENTILES:
+            # nearest rank
+            idx = max(int(math.ceil(len(samples) * pct / 100.0)) - 1, 0)
+            stats['p{}'.format(pct)] = samples[idx]
+        stats['max'] = samples[-1]
+        return stats
+
+class Tracker(object):
+    '''
+    Assign trace ids to alerts and sample their latencies.
+
+    >>> t = Tracker()
+    >>> alert = {'time': 100.0}
+    >>> t.start(alert, received=101.0, now=103.0)
+    >>> trace = alert['trace']
+    >>> t.sent(trace, 'jabber', now=104.0, total=False)
+    104.0
+    >>> t.receipt(trace, 'jabber', 104.0, now=106.5)
+    >>> stats = t.stats()
+    >>> sorted(stats)
+    ['ingest', 'queue', 'receipt.jabber', 'send.jabber', 'total.jabber']
+    >>> stats['queue']['p50'], stats['send.jabber']['p50']
+    (2.0, 1.0)
+    >>> stats['receipt.jabber']['p50'], stats['total.jabber']['max']
+    (2.5, 6.5)
+
+    # one total sample per delivery
+    >>> t.sent(trace, 'email', now=105.0)
+    105.0
+    >>> stats = t.stats()
+    >>> stats['total.jabber']['count'], stats['total.email']['max']
+    (1, 5.0)
+    '''
+    def __init__(self, samples=DEFAULT_SAMPLES, max_traces=MAX_TRACES):
+        self.size = samples
+        self.max_traces = max_traces
+        self.windows = {}
+        # trace id => (alert time, routed time), oldest first
+        self.traces = collections.OrderedDict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def start(self, alert, received=None, now=None):
+        '''
+        Assign a trace id to an alert that is being routed, and sample
+        its ingest and queue latencies.
+        '''
+        if now is None:
+            now = time.time()
+        trace = '{:x}-{:x}'.format(os.getpid(), next(self.ids))
+        alert['trace'] = trace
+        origin = alert.get('time')
+        if not isinstance(origin, (int, long, float)):
+            origin = received if received is not None else now
+        with self.lock:
+            if received is not None:
+                self.__add('ingest', received - origin)
+                self.__add('queue', now - received)
+            self.traces[trace] = (origin, now)
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+
+    def times(self, trace):
+        '''
+        Return the (alert time, routed time) of a trace, or None.
+        '''
+        with self.lock:
+            return self.traces.get(trace)
+
+    def adopt(self, trace, times):
+        '''
+        Track a trace started by another process's tracker, from its
+        times().  Used by the delivery workers.
+
+        >>> router, worker = Tracker(), Tracker()
+        >>> alert = {'time': 100.0}
+        >>> router.start(alert, now=102.0)
+        >>> worker.adopt(alert['trace'], router.times(alert['trace']))
+        >>> worker.sent(alert['trace'], 'email', now=105.0)
+        105.0
+        >>> worker.stats()['send.email']['max']
+        3.0
+        '''
+        with self.lock:
+            self.traces[trace] = tuple(times)
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+
+    def sent(self, trace, protocol, now=None, total=True):
+        '''
+        Sample the send latency of an alert to one recipient.  Sample
+        the total latency too, unless total is False because it is
+        sampled when the receipt arrives.  Return the time it was sent.
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            times = self.traces.get(trace)
+            if times is not None:
+                origin, routed = times
+                self.__add('send.' + protocol, now - routed)
+                if total:
+                    self.__add('total.' + protocol, now - origin)
+        return now
+
+    def receipt(self, trace, protocol, sent, now=None):
+        '''
+        Sample the receipt latency of an alert sent at time sent.
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            times = self.traces.get(trace)
+            if times is not None:
+                origin, routed = times
+                self.__add('receipt.' + protocol, now - sent)
+                self.__add('total.' + protocol, now - origin)
+
+    def stats(self):
+        '''
+        Return the percentiles of every stage's latency in seconds.
+        '''
+        with self.lock:
+            return dict((stage, window.percentiles())
+                        for stage, window in self.windows.iteritems())
+
+    def __add(self, stage, sample):
+        window = self.windows.get(stage)
+        if window is None:
+            window = self.windows[stage] = Window(self.size)
+        window.add(max(sample, 0.0))
+
+_default = Tracker()
+
+def start(alert, received=None):
+    '''
+    Assign a trace id to an alert on the shared tracker.
+    '''
+    _default.start(alert, received)
+
+def stats():
+    '''
+    Return the latency percentiles of the shared tracker.
+    '''
+    return _default.stats()
+
+def times(trace):
+    '''
+    Return the times of a trace on the shared tracker, or None.
+    '''
+    if trace is None:
+        return None
+    return _default.times(trace)
+
+def adopt(trace, times):
+    '''
+    Track a trace started by another process on the shared tracker.
+    '''
+    if trace is not None and times is not None:
+        _default.adopt(trace, times)
+
+def sent(trace, protocol, now=None, total=True):
+    '''
+    Sample the send latency of a traced alert on the shared tracker.
+    '''
+    if trace is None:
+        return now if now is not None else time.time()
+    return _default.sent(trace, protocol, now, total)
+
+def receipt(trace, protocol, sent, now=None):
+    '''
+    Sample the receipt latency of a traced alert on the shared tracker.
+    '''
+    if trace is not None:
+        _default.receipt(trace, protocol, sent, now)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,503 @@
+'''
+Maintenance windows.
+
+Planned maintenance causes floods of expected alerts.  A maintenance
+window suppresses the alerts that occur between its start and end,
+before they are routed to any agent.  A window may be limited to hosts
+and to categories, given as globs, e.g. hosts: [web*] and categories:
+[disk.*].  A window without hosts or categories covers all of them.
+
+Windows are configured in alert.maintenance, or added and removed while
+the alert server runs through its maintenance socket.  The socket takes
+one JSON command per line and answers each with a JSON line, e.g.
+
+    $ echo '{"cmd": "add", "name": "web-upgrade", "duration": "2h",
+             "hosts": ["web*"]}' | nc -U /tmp/.salt-unix/alert_maintenance.sock
+    {"ok": true, "window": {...}}
+
+The commands are add (name, start, end or duration, hosts, categories),
+remove (name) and list.  The windows added through the socket are saved
+in <cachedir>/alert/maintenance.json, which every alert server process
+reloads when it changes.
+
+The windows are kept in an interval index.  Their hosts are indexed like
+subscription filters, and the windows of each host pattern are split
+into time segments, each with the windows active during it.  Finding the
+windows of an alert takes a lookup of its host and a binary search per
+matching host pattern, however many windows there are.
+'''
+import bisect
+import fnmatch
+import json
+import os
+import re
+import threading
+import time
+
+import salt.log
+import salt.ext.alert.control
+
+from salt.ext.alert.router import ValueIndex
+
+SOCKET_NAME     = 'alert_maintenance.sock'
+STATE_FILE      = 'maintenance.json'
+RELOAD_INTERVAL = 1.0       # seconds between checks of the state file
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60,
+                  'w': 7 * 24 * 60 * 60}
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+log = salt.log.getLogger(__name__)
+
+def parse_time(value):
+    '''
+    Parse a time given as seconds since the epoch, or as a local date
+    and time, e.g. 2012-06-01 22:00.
+
+    >>> parse_time(1338588000)
+    1338588000.0
+    >>> parse_time('2012-06-01 22:00') == parse_time('2012-06-01 22:00:00')
+    True
+    '''
+    if hasattr(value, 'timetuple'):
+        # a date or datetime parsed by YAML
+        return time.mktime(value.timetuple())
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    for fmt in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(str(value).strip(), fmt))
+        except ValueError:
+            pass
+    raise ValueError('invalid time: {}'.format(value))
+
+def parse_duration(value):
+    '''
+    Parse a duration given in seconds or with a unit, e.g. 90s, 30m, 2h,
+    1d or 1w.
+
+    >>> parse_duration('2h'), parse_duration(90)
+    (7200.0, 90.0)
+    '''
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhdw])$', str(value).strip())
+    if match:
+        return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError('invalid duration: {}'.format(value))
+
+def _globs(value):
+    if not value:
+        return None
+    if isinstance(value, basestring):
+        value = [value]
+    return [glob if isinstance(glob, basestring) else str(glob)
+                for glob in value]
+
+class Window(object):
+    '''
+    A maintenance window: the hosts and categories whose alerts are
+    suppressed between start and end.
+
+    >>> window = Window('db', 100, 200, hosts='db*', categories=['disk.*'])
+    >>> window.covers('disk.full'), window.covers('load.high')
+    (True, False)
+    >>> window.to_dict()['hosts']
+    ['db*']
+    '''
+    def __init__(self, name, start, end, hosts=None, categories=None):
+        '''
+        name       = the unique name of the window
+        start, end = the window in seconds since the epoch
+        hosts      = host globs, or None for all hosts
+        categories = category globs, or None for all categories
+        '''
+        if not name:
+            raise ValueError('maintenance window without a name')
+        if end <= start:
+            raise ValueError('maintenance window "{}" ends before it '
+                             'starts'.format(name))
+        self.name = str(name)
+        self.start = start
+        self.end = end
+        self.hosts = _globs(hosts)
+        self.categories = _globs(categories)
+        self.category_match = None
+        if self.categories:
+            self.category_match = re.compile('|'.join(
+                    fnmatch.translate(glob) for glob in self.categories)).match
+
+    def __repr__(self):
+        return '<Window {}>'.format(self.name)
+
+    def covers(self, category):
+        '''
+        Return True if the window covers an alert category.
+        '''
+        if self.category_match is None:
+            return True
+        return category is not None and \
+                self.category_match(category) is not None
+
+    def to_dict(self):
+        return {'name': self.name,
+                'start': self.start,
+                'end': self.end,
+                'hosts': self.hosts,
+                'categories': self.categories}
+
+    @classmethod
+    def from_dict(cls, spec, now=None):
+        '''
+        Create a window from its config: name, start (default now), end
+        or duration, hosts and categories.
+        '''
+        if not isinstance(spec, dict):
+            raise ValueError('invalid maintenance window: {}'.format(spec))
+        if now is None:
+            now = time.time()
+        start = parse_time(spec['start']) if spec.get('start') else now
+        if spec.get('end'):
+            end = parse_time(spec['end'])
+        elif spec.get('duration'):
+            end = start + parse_duration(spec['duration'])
+        else:
+            raise ValueError('maintenance window "{}" needs an end or a '
+                             'duration'.format(spec.get('name')))
+        return cls(spec.get('name'), start, end, spec.get('hosts'),
+                   spec.get('categories'))
+
+class Intervals(object):
+    '''
+    The windows of one host pattern, split into time segments.
+
+    >>> a, b = Window('a', 10, 30), Window('b', 20, 40)
+    >>> intervals = Intervals([a, b])
+    >>> intervals.bounds
+    [10, 20, 30, 40]
+    >>> [intervals.at(t) for t in (5, 10, 25, 30, 40)]
+    [(), (<Window a>,), (<Window a>, <Window b>), (<Window b>,), ()]
+    '''
+    def __init__(self, windows):
+        self.bounds = sorted(set([window.start for window in windows] +
+                                 [window.end for window in windows]))
+        # segments[i] = the windows active from bounds[i] to bounds[i+1]
+        self.segments = []
+        starts = sorted(windows, key=lambda window: window.start)
+        ends = sorted(windows, key=lambda window: window.end)
+        active = set()
+        i = j = 0
+        for bound in self.bounds:
+            while i < len(starts) and starts[i].start <= bound:
+                active.add(starts[i])
+                i += 1
+            while j < len(ends) and ends[j].end <= bound:
+                active.discard(ends[j])
+                j += 1
+            self.segments.append(tuple(sorted(active,
+                                              key=lambda window: window.name)))
+
+    def at(self, when):
+        '''
+        Return the windows active at a time.
+        '''
+        i = bisect.bisect_right(self.bounds, when) - 1
+        if i < 0:
+            return ()
+        return self.segments[i]
+
+class WindowIndex(object):
+    '''
+    An interval index of maintenance windows by host and time.
+
+    >>> index = WindowIndex()
+    >>> index.add(Window('racks', 100, 200, hosts=['web*', 'db1']))
+    >>> index.add(Window('disks', 150, 300, categories=['disk.*']))
+    >>> index.match('web3', 'load.high', 120)
+    [<Window racks>]
+    >>> index.match('db1', 'disk.full', 160)
+    [<Window disks>, <Window racks>]
+    >>> index.match('db2', 'load.high', 160), index.match('web3', None, 250)
+    ([], [])
+
+    # adding a window of the same name replaces it
+    >>> index.add(Window('racks', 500, 600, hosts=['web*']))
+    >>> index.match('web3', 'load.high', 120)
+    []
+    >>> index.expire(400)
+    [<Window disks>]
+    >>> index.remove('racks'), len(index)
+    (True, 0)
+    '''
+    def __init__(self):
+        self.windows = {}
+        # the index is rebuilt when it is next used after a change
+        self.hosts = None
+        self.intervals = None
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __iter__(self):
+        return iter(sorted(self.windows.values(),
+                           key=lambda window: (window.start, window.name)))
+
+    def add(self, window):
+        self.windows[window.name] = window
+        self.hosts = None
+
+    def remove(self, name):
+        '''
+        Remove a window.  Return True if it existed.
+        '''
+        if self.windows.pop(name, None) is None:
+            return False
+        self.hosts = None
+        return True
+
+    def expire(self, now):
+        '''
+        Remove the windows that ended.  Return them.
+        '''
+        ended = [window for window in self if window.end <= now]
+        for window in ended:
+            self.remove(window.name)
+        return ended
+
+    def match(self, host, category, when):
+        '''
+        Return the windows that cover an alert of a host and category at
+        a time.
+        '''
+        if self.hosts is None:
+            self.__build()
+        intervals = [self.intervals[None]] if None in self.intervals else []
+        if host:
+            intervals.extend(self.intervals[pattern]
+                                for pattern in self.hosts.lookup(host))
+        found = []
+        for windows in intervals:
+            for window in windows.at(when):
+                if window.covers(category) and window not in found:
+                    found.append(window)
+        found.sort(key=lambda window: window.name)
+        return found
+
+    def __build(self):
+        # host pattern (None for all hosts) => its windows
+        patterns = {}
+        for window in self.windows.itervalues():
+            for pattern in window.hosts or [None]:
+                patterns.setdefault(pattern, []).append(window)
+        hosts = ValueIndex()
+        for pattern in patterns:
+            if pattern is not None:
+                hosts.add(pattern, pattern)
+        self.intervals = dict((pattern, Intervals(windows))
+                                for pattern, windows in patterns.iteritems())
+        self.hosts = hosts
+
+class Maintenance(object):
+    '''
+    The maintenance windows of an alert server process: those in the
+    config, and those added through the maintenance socket.
+
+    >>> m = Maintenance([Window('web', 100, 200, hosts=['web*'])])
+    >>> m.suppress({'host': 'web1', 'category': 'load.high', 'time': 150},
+    ...            now=150)
+    True
+    >>> m.suppress({'host': 'db1', 'category': 'load.high', 'time': 150},
+    ...            now=150)
+    False
+    >>> sorted(m.stats().items())
+    [('suppressed', {'web': 1}), ('windows', 1)]
+    '''
+    def __init__(self, windows=(), state=None, path=None):
+        '''
+        windows = the configured windows
+        state   = the file that saves the windows added at run time
+        path    = the path of the maintenance socket, or None
+        '''
+        self.configured = dict((window.name, window) for window in windows)
+        self.state = state
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = WindowIndex()
+        for window in windows:
+            self.index.add(window)
+        self.added = {}
+        self.mtime = None
+        self.checked = 0
+        # window name => alerts suppressed
+        self.suppressed = {}
+
+    def suppress(self, alert, now=None):
+        '''
+        Return True if an alert is suppressed by a maintenance window,
+        and count it for the windows that cover it.
+        '''
+        if now is None:
+            now = time.time()
+        when = alert.get('time')
+        if not isinstance(when, (int, long, float)):
+            when = now
+        with self.lock:
+            self.__refresh(now)
+            windows = self.index.match(alert.get('host'),
+                                       alert.get('category'), when)
+            for window in windows:
+                self.suppressed[window.name] = \
+                        self.suppressed.get(window.name, 0) + 1
+        if windows:
+            log.trace('suppressed by maintenance %s: %s',
+                      ', '.join(window.name for window in windows), alert)
+        return bool(windows)
+
+    def stats(self):
+        '''
+        Return the number of windows and the alerts suppressed by each.
+        '''
+        with self.lock:
+            return {'windows': len(self.index),
+                    'suppressed': dict(self.suppressed)}
+
+    def command(self, request, now=None):
+        '''
+        Run a command of the maintenance socket.  Return its reply.
+        '''
+        if now is None:
+            now = time.time()
+        try:
+            if not isinstance(request, dict):
+                raise ValueError('expected a JSON object')
+            cmd = request.get('cmd')
+            with self.lock:
+                self.checked = 0
+                self.__refresh(now)
+                if cmd == 'list':
+                    return {'ok': True, 'windows': [window.to_dict()
+                                                    for window in self.index]}
+                if cmd == 'add':
+                    window = Window.from_dict(request, now)
+                    if window.name in self.configured:
+                        raise ValueError('window "{}" is configured in '
+                                         'alert.maintenance'.format(window.name))
+                    self.added[window.name] = window
+                    self.__save()
+                    self.index.add(window)
+                    log.info('added maintenance window %s', window.name)
+                    return {'ok': True, 'window': window.to_dict()}
+                if cmd == 'remove':
+                    name = request.get('name')
+                    if name in self.configured:
+                        raise ValueError('window "{}" is configured in '
+                                         'alert.maintenance'.format(name))
+                    if self.added.pop(name, None) is None:
+                        raise ValueError('no window "{}"'.format(name))
+                    self.__save()
+                    self.index.remove(name)
+                    log.info('removed maintenance window %s', name)
+                    return {'ok': True}
+            raise ValueError('unknown command: {}'.format(cmd))
+        except (KeyError, ValueError, IOError, OSError), ex:
+            return {'ok': False, 'error': str(ex)}
+
+    def serve(self):
+        '''
+        Serve the maintenance socket on a thread, if it has one.  Runs in
+        the alert server's main process.
+        '''
+        if self.path:
+            salt.ext.alert.control.serve(self.path, self.command,
+                                         'maintenance')
+
+    def __refresh(self, now):
+        '''
+        Reload the windows added at run time if the state file changed,
+        and drop the windows that ended.  Must hold the lock.
+        '''
+        if now - self.checked < RELOAD_INTERVAL:
+            return
+        self.checked = now
+        if self.state:
+            try:
+                mtime = os.stat(self.state).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self.__load(now)
+        for window in self.index.expire(now):
+            self.added.pop(window.name, None)
+            self.configured.pop(window.name, None)
+            log.info('maintenance window %s ended: suppressed %s alert(s)',
+                     window.name, self.suppressed.pop(window.name, 0))
+
+    def __load(self, now):
+        added = {}
+        if self.mtime is not None:
+            try:
+                with open(self.state, 'rb') as fp:
+                    for spec in json.load(fp):
+                        window = Window.from_dict(spec, now)
+                        added[window.name] = window
+            except (IOError, OSError, KeyError, ValueError), ex:
+                log.warning('cannot load maintenance windows from %s',
+                            self.state, exc_info=ex)
+                return
+        for name in self.added:
+            if name not in added:
+                self.index.remove(name)
+                log.info('maintenance window %s removed: suppressed %s '
+                         'alert(s)', name, self.suppressed.pop(name, 0))
+        for window in added.itervalues():
+            self.index.add(window)
+        self.added = added
+        log.debug('loaded %s maintenance window(s) from %s',
+                  len(added), self.state)
+
+    def __save(self):
+        if not self.state:
+            return
+        windows = sorted((window.to_dict() for window in self.added.values()),
+                         key=lambda window: window['start'])
+        tmp = '{}.{}.tmp'.format(self.state, os.getpid())
+        dirname = os.path.dirname(self.state)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(tmp, 'wb') as fp:
+            json.dump(windows, fp, indent=1)
+        os.rename(tmp, self.state)
+        self.mtime = os.stat(self.state).st_mtime
+
+def load_maintenance(config):
+    '''
+    Create the maintenance windows configured in alert.maintenance, or
+    return None if alerts are never suppressed.
+    '''
+    spec = config.get('alert.maintenance')
+    if spec is None or spec is False:
+        return None
+    if not isinstance(spec, dict):
+        spec = {}
+    windows = []
+    for window in spec.get('windows') or []:
+        try:
+            windows.append(Window.from_dict(window))
+        except (KeyError, ValueError), ex:
+            log.error('ignore maintenance window %s: %s', window, ex)
+    state = None
+    if config.get('cachedir'):
+        state = os.path.join(config['cachedir'], 'alert', STATE_FILE)
+    path = spec.get('socket')
+    if path is None and config.get('sock_dir'):
+        path = os.path.join(config['sock_dir'], SOCKET_NAME)
+    log.trace('maintenance: %s window(s), socket %s', len(windows), path)
+    return Maintenance(windows, state, path or None)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
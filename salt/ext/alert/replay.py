@@ -0,0 +1,220 @@
+'''
+Replay recorded alerts through the alert routing and templates with all
+agents in dry-run, to project what a configuration will deliver.  The
+alerts go through the same suppression by the topology and maintenance
+windows, checked at the time each alert was raised, and the same
+enrichment as delivered alerts.  Escalations are not projected.
+
+The recorded alerts are JSON objects, one per line, as written by the
+alert.archive agent or printed by 'salt-alert history'.
+'''
+import collections
+import json
+import time
+
+import salt.log
+
+log = salt.log.getLogger(__name__)
+
+class Replay(object):
+    '''
+    Route alerts through a loaded Alerter without delivering them, and
+    count what would be delivered.
+
+    >>> import re
+    >>> import salt.ext.alert.agents.agent
+    >>> import salt.ext.alert.alerter
+    >>> class Chat(salt.ext.alert.agents.agent.Agent):
+    ...     def _render(self, subscribers, alert):
+    ...         return [(addr, alert['msg']) for addr in subscribers]
+    ...     def _send_interval(self, addr):
+    ...         return ('chat', 1.0)
+    >>> chat = Chat('chat')
+    >>> chat.add_subscriber(re.compile('disk.*'), 'ops')
+    >>> chat.add_subscriber(re.compile('.*/critical'), 'oncall')
+    >>> alerter = salt.ext.alert.alerter.Alerter()
+    >>> alerter.agents = {'chat': chat}
+    >>> replay = Replay(alerter)
+    >>> replay.replay([
+    ...     {'category': 'disk.full', 'severity': 'critical', 'msg': 'a', 'time': 0},
+    ...     {'category': 'disk.full', 'severity': 'warning', 'msg': 'b', 'time': 0},
+    ...     {'category': 'load.high', 'severity': 'warning', 'msg': 'c', 'time': 0}])
+    >>> report = replay.report()
+    >>> report['alerts'], report['routed'], report['messages']
+    (3, 2, 3)
+    >>> report['suppressed']
+    0
+    >>> sorted(report['fanout'].items())
+    [('chat:.*/critical', 1), ('chat:disk.*', 2)]
+    >>> sorted(report['recipients'].items())
+    [('chat:oncall', 1), ('chat:ops', 2)]
+
+    # the 3 messages queued at time 0 on a 1 msg/sec channel
+    >>> report['throttle']['chat:chat']['max_delay']
+    2.0
+
+    # alerts are suppressed as they were when they were raised
+    >>> import salt.ext.alert.maintenance as maintenance
+    >>> alerter.maintenance = maintenance.Maintenance([maintenance.Window(
+    ...         'db', 100, 200, hosts=['db1'])])
+    >>> replay = Replay(alerter)
+    >>> replay.replay([
+    ...     {'host': 'db1', 'category': 'disk.full', 'msg': 'a', 'time': 150},
+    ...     {'host': 'db1', 'category': 'disk.full', 'msg': 'b', 'time': 250}])
+    >>> report = replay.report()
+    >>> report['suppressed'], report['routed']
+    (1, 1)
+    '''
+    def __init__(self, alerter):
+        '''
+        Create a replay of alerts through a loaded Alerter.
+        '''
+        self.alerter = alerter
+        self.unverbs = dict((preferred, verb)
+                            for verb, preferred in alerter.verbs.iteritems())
+        self.alerts = 0
+        self.suppressed = 0
+        self.routed = 0
+        self.elapsed = 0.0
+        self.fanout = collections.defaultdict(int)
+        self.agent_msgs = collections.defaultdict(int)
+        self.agent_bytes = collections.defaultdict(int)
+        self.recipient_msgs = collections.defaultdict(int)
+        # channel => [time the channel is free, messages, total delay,
+        #             maximum delay]
+        self.channels = {}
+
+    def replay_file(self, fp):
+        '''
+        Replay the alerts recorded in a file, one JSON object per line.
+        '''
+        self.replay(self.__read(fp))
+
+    def replay(self, alerts):
+        '''
+        Replay an iterable of alert dicts.
+        '''
+        start = time.time()
+        agents = sorted(self.alerter.agents.iteritems())
+        for alert in alerts:
+            self.alerts += 1
+            raised = alert.get('time')
+            if not isinstance(raised, (int, long, float)):
+                raised = None
+            if not self.alerter.route(alert, now=raised, trace=False):
+                self.suppressed += 1
+                continue
+            routed = False
+            for protocol, agent in agents:
+                subscribers = set()
+                for rule, addrs in agent.match(alert).iteritems():
+                    self.fanout[protocol + ':' + rule.pattern] += len(addrs)
+                    subscribers.update(addrs)
+                if not subscribers:
+                    continue
+                routed = True
+                when = alert['epoch']
+                for recipient, msg in agent._render(sorted(subscribers), alert):
+                    self.agent_msgs[protocol] += 1
+                    self.agent_bytes[protocol] += len(msg)
+                    self.recipient_msgs[protocol + ':' + recipient] += 1
+                    channel, interval = agent._send_interval(recipient)
+                    if interval > 0:
+                        self.__throttle(protocol + ':' + str(channel),
+                                        interval, when)
+            if routed:
+                self.routed += 1
+        self.elapsed += time.time() - start
+
+    def report(self):
+        '''
+        Return a dict of the replay's statistics.
+        '''
+        throttle = {}
+        for channel, (free, msgs, total, worst) in self.channels.iteritems():
+            throttle[channel] = {'messages': msgs,
+                                 'mean_delay': total / msgs,
+                                 'max_delay': worst}
+        return {'alerts': self.alerts,
+                'suppressed': self.suppressed,
+                'routed': self.routed,
+                'messages': sum(self.agent_msgs.values()),
+                'elapsed': self.elapsed,
+                'alerts_per_sec': self.alerts / self.elapsed
+                                    if self.elapsed > 0 else 0,
+                'fanout': dict(self.fanout),
+                'agents': dict((protocol, {'messages': msgs,
+                                           'bytes': self.agent_bytes[protocol]})
+                               for protocol, msgs in self.agent_msgs.iteritems()),
+                'recipients': dict(self.recipient_msgs),
+                'throttle': throttle}
+
+    def __throttle(self, channel, interval, when):
+        '''
+        Project the delay of a message queued at time when to a channel
+        that sends a message every interval seconds.
+        '''
+        state = self.channels.get(channel)
+        if state is None:
+            state = self.channels[channel] = [when, 0, 0.0, 0.0]
+        send = max(state[0], when)
+        delay = send - when
+        state[0] = send + interval
+        state[1] += 1
+        state[2] += delay
+        state[3] = max(state[3], delay)
+
+    def __read(self, fp):
+        '''
+        Generate the recorded alerts in a file, undoing the templating
+        of archived alerts.
+        '''
+        for lineno, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                alert = json.loads(line)
+            except ValueError, ex:
+                log.warning('replay: line %s: %s', lineno, ex)
+                continue
+            if 'epoch' in alert:
+                alert['time'] = alert.pop('epoch')
+                verb = alert.get('verb')
+                if verb in self.unverbs:
+                    alert['verb'] = self.unverbs[verb]
+            yield alert
+
+def format_report(report):
+    '''
+    Format a replay report for humans.
+    '''
+    lines = ['{alerts} alert(s), {suppressed} suppressed, {routed} routed, '
+             '{messages} message(s) in {elapsed:.2f}s '
+             '({alerts_per_sec:.0f} alerts/s)'.format(**report)]
+    lines.append('')
+    lines.append('Fanout per subscription:')
+    for pattern, count in sorted(report['fanout'].iteritems()):
+        lines.append('  {:8} {}'.format(count, pattern))
+    lines.append('')
+    lines.append('Messages per agent:')
+    for protocol, stats in sorted(report['agents'].iteritems()):
+        lines.append('  {:8} {} ({} bytes)'.format(stats['messages'],
+                                                   protocol, stats['bytes']))
+    lines.append('')
+    lines.append('Messages per recipient:')
+    for recipient, count in sorted(report['recipients'].iteritems(),
+                                   key=lambda item: (-item[1], item[0])):
+        lines.append('  {:8} {}'.format(count, recipient))
+    if report['throttle']:
+        lines.append('')
+        lines.append('Projected throttle delay:')
+        for channel, stats in sorted(report['throttle'].iteritems()):
+            lines.append('  {}: {} message(s), mean {:.1f}s, max {:.1f}s'
+                         .format(channel, stats['messages'],
+                                 stats['mean_delay'], stats['max_delay']))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,230 @@
+'''
+Indexed matching of alerts against subscription rules.
+
+A rule is a regex matched against the alert's category/severity plus
+optional filters on alert fields, e.g. host globs or lists.  Filters are
+compiled into an index per field: a hash of exact values, a prefix trie
+of globs, and regexes only for globs that start with a wildcard.  The
+result of the category/severity regexes is cached per category/severity,
+so matching costs about the same for thousands of rules as for a few.
+'''
+import fnmatch
+import re
+
+import salt.log
+
+# The number of distinct category/severity results to cache
+MAX_CONDITIONS = 4096
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+log = salt.log.getLogger(__name__)
+
+def field_value(alert, field):
+    '''
+    Return the value of an alert field as a string, or None if the field
+    is missing.  Nested fields are named with dots, e.g. grains.role.
+
+    >>> field_value({'host': 'web1'}, 'host')
+    'web1'
+    >>> field_value({'grains': {'role': 'db'}}, 'grains.role')
+    'db'
+    >>> field_value({'grains': {}}, 'grains.role') is None
+    True
+    '''
+    value = alert.get(field)
+    if value is None and '.' in field:
+        value = alert
+        for key in field.split('.'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
+class ValueIndex(object):
+    '''
+    An index of the exact values and globs that rules accept for a field.
+
+    >>> index = ValueIndex()
+    >>> index.add('db1', 'a')
+    >>> index.add('web*', 'b')
+    >>> index.add('web1?', 'c')
+    >>> index.add('*.example.com', 'd')
+    >>> sorted(index.lookup('web12'))
+    ['b', 'c']
+    >>> sorted(index.lookup('db1.example.com'))
+    ['d']
+    >>> sorted(index.lookup('db1'))
+    ['a']
+    '''
+    def __init__(self):
+        self.exact = {}
+        # Globs are stored in the trie node of their literal prefix,
+        # under the key None.
+        self.trie = {}
+        self.fallback = []
+
+    def add(self, pattern, rule):
+        '''
+        Accept values that match pattern, an exact value or a glob,
+        for the rule.
+        '''
+        wildcard = GLOB_CHARS.search(pattern)
+        if wildcard is None:
+            self.exact.setdefault(pattern, set()).add(rule)
+            return
+        match = re.compile(fnmatch.translate(pattern)).match
+        prefix = pattern[:wildcard.start()]
+        if not prefix:
+            self.fallback.append((match, rule))
+            return
+        node = self.trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append((match, rule))
+
+    def lookup(self, value):
+        '''
+        Return the set of rules that accept value.
+        '''
+        rules = set(self.exact.get(value, ()))
+        node = self.trie
+        for char in value:
+            node = node.get(char)
+            if node is None:
+                break
+            for match, rule in node.get(None, ()):
+                if match(value):
+                    rules.add(rule)
+        for match, rule in self.fallback:
+            if match(value):
+                rules.add(rule)
+        return rules
+
+class Rule(object):
+    '''
+    A subscription rule and its subscribers.
+    '''
+    def __init__(self, regex, filters=None):
+        '''
+        regex   = a compiled regex matched against category/severity
+        filters = a dict of alert field names and the list of values or
+                  globs the field must match
+        '''
+        self.regex = regex
+        self.filters = dict(filters or {})
+        self.addrs = set()
+        self.pattern = ' '.join([regex.pattern] +
+                                ['{}={}'.format(field, ','.join(values))
+                                    for field, values in
+                                        sorted(self.filters.iteritems())])
+
+    def __repr__(self):
+        return self.pattern
+
+class Router(object):
+    '''
+    Match alerts against a set of rules.
+
+    >>> router = Router()
+    >>> router.add(re.compile('disk.*'), 'ops')
+    >>> router.add(re.compile('.*'), 'web-team', {'host': ['web*']})
+    >>> router.add(re.compile('.*/critical'), 'dc1-oncall',
+    ...            {'host': ['db1', 'db2'], 'datacenter': ['dc1']})
+    >>> def subscribers(alert):
+    ...     matched = router.match(alert)
+    ...     return sorted(addr for addrs in matched.values() for addr in addrs)
+    >>> subscribers({'category': 'disk.full', 'severity': 'critical',
+    ...              'host': 'web3'})
+    ['ops', 'web-team']
+    >>> subscribers({'category': 'load', 'severity': 'critical',
+    ...              'host': 'db2', 'datacenter': 'dc1'})
+    ['dc1-oncall']
+    >>> subscribers({'category': 'load', 'severity': 'critical',
+    ...              'host': 'db2', 'datacenter': 'dc2'})
+    []
+    '''
+    def __init__(self):
+        self.rules = {}
+        self.indexes = {}
+        self.conditions = {}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules.values())
+
+    def add(self, regex, addr, filters=None):
+        '''
+        Add a subscriber to the rule made of regex and filters.
+        '''
+        filters = dict((field, sorted(set(values)))
+                       for field, values in (filters or {}).iteritems())
+        key = (regex.pattern,
+               tuple((field, tuple(values))
+                     for field, values in sorted(filters.iteritems())))
+        rule = self.rules.get(key)
+        if rule is None:
+            rule = Rule(regex, filters)
+            self.rules[key] = rule
+            for field, values in filters.iteritems():
+                index = self.indexes.setdefault(field, ValueIndex())
+                for value in values:
+                    index.add(value, rule)
+            self.conditions.clear()
+        rule.addrs.add(addr)
+
+    def match(self, alert):
+        '''
+        Return a dict of the rules that match the alert and their
+        subscribers.
+        '''
+        condition = '/'.join([alert.get('category', 'unknown'),
+                              alert.get('severity', 'unknown')])
+        entry = self.conditions.get(condition)
+        if entry is None:
+            entry = self.__condition(condition)
+        plain, filtered = entry
+        matched = dict((rule, rule.addrs) for rule in plain)
+        if filtered:
+            # a rule matches if every one of its filtered fields does
+            counts = {}
+            for field, index in self.indexes.iteritems():
+                value = field_value(alert, field)
+                if value is None:
+                    continue
+                for rule in index.lookup(value):
+                    counts[rule] = counts.get(rule, 0) + 1
+            for rule, count in counts.iteritems():
+                if count == len(rule.filters) and rule in filtered:
+                    matched[rule] = rule.addrs
+        return matched
+
+    def __condition(self, condition):
+        '''
+        Match the rules' regexes against a category/severity and cache
+        the rules that match: those without filters, and the set of
+        those with filters.
+        '''
+        plain = []
+        filtered = set()
+        for rule in self.rules.itervalues():
+            if rule.regex.match(condition):
+                if rule.filters:
+                    filtered.add(rule)
+                else:
+                    plain.append(rule)
+        if len(self.conditions) >= MAX_CONDITIONS:
+            log.trace('router: condition cache full')
+            self.conditions.clear()
+        entry = self.conditions[condition] = (plain, filtered)
+        return entry
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,109 @@
+'''
+A timer thread shared by the alert agents.
+
+Callbacks run on the scheduler thread, so they must not block for long.
+'''
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import salt.log
+
+log = salt.log.getLogger(__name__)
+
+class Timer(object):
+    '''
+    A scheduled callback.  Cancelling a timer is O(1): the timer stays in
+    the scheduler's heap and is skipped when it comes due.
+    '''
+    __slots__ = ['when', 'callback', 'args', 'cancelled']
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler(object):
+    '''
+    Run callbacks at given times on a single background thread.
+
+    >>> import threading
+    >>> done = threading.Event()
+    >>> s = Scheduler()
+    >>> t = s.schedule(0.01, done.set)
+    >>> done.wait(5)
+    True
+    >>> cancelled = s.schedule(0, done.clear)
+    >>> cancelled.cancel()
+    '''
+    def __init__(self, name='alert-scheduler'):
+        self.name = name
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+        self.thread = None
+        self.pid = None
+
+    def schedule(self, delay, callback, *args):
+        '''
+        Call callback(*args) in delay seconds.  Return a Timer that can
+        be cancelled.
+        '''
+        timer = Timer(time.time() + max(delay, 0), callback, args)
+        with self.cond:
+            self._start()
+            heapq.heappush(self.heap, (timer.when, next(self.seq), timer))
+            if self.heap[0][2] is timer:
+                self.cond.notify()
+        return timer
+
+    def _start(self):
+        '''
+        Start the scheduler thread in this process if necessary.
+        '''
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name=self.name)
+        self.thread.daemon = True
+        self.pid = os.getpid()
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    when, seq, timer = self.heap[0]
+                    if timer.cancelled:
+                        heapq.heappop(self.heap)
+                        continue
+                    delay = when - time.time()
+                    if delay <= 0:
+                        heapq.heappop(self.heap)
+                        break
+                    self.cond.wait(delay)
+            try:
+                timer.callback(*timer.args)
+            except Exception, ex:
+                log.error('scheduled callback %s failed', timer.callback,
+                          exc_info=ex)
+
+_default = Scheduler()
+
+def schedule(delay, callback, *args):
+    '''
+    Call callback(*args) in delay seconds on the shared scheduler thread.
+    '''
+    return _default.schedule(delay, callback, *args)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -2,6 +2,7 @@
 This module contains all fo the routines needed to set up an alert server.
 '''
 # Import python modules
+import functools
 import logging
 # Import salt modules
 import salt.master
@@ -53,17 +54,22 @@ class AESFuncs(object):
     def __init__(self, opts, crypticle):
         self.opts = opts
         self.crypticle = crypticle
-        # Make a client
-        self.local = salt.client.LocalClient(self.opts['conf_file'])
         self.alerter = salt.ext.alert.alerter.Alerter()
-        self.alerter.load(opts)
+        # The client that looks up host metadata is created when it is
+        # first used, in the worker process that uses it
+        self.alerter.load(opts, client=functools.partial(
+                salt.client.LocalClient, self.opts['conf_file']))
+        self.alerter.start_workers()
+        # the statistics and maintenance sockets are local to the
+        # server, not part of the minion-facing interface
+        self.alerter.start_sockets()
 
     def _alert(self, load):
         '''
         Handle an alert sent from a minion.
         '''
         log.debug('_alert: %s', load)
-        self.alerter.deliver(load)
+        self.alerter.ingest(load)
 
     def run_func(self, func, load):
         '''
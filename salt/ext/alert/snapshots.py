@@ -0,0 +1,108 @@
+'''
+Statistics published by the alert server processes.
+
+The alert server receives and delivers alerts in several processes, and
+most statistics, like the latencies and the memory budget, are kept in
+the process that produces them.  Each process publishes a JSON snapshot
+of its statistics to shared memory every few seconds, from where the
+main process reports them.
+'''
+import errno
+import json
+import multiprocessing
+import os
+
+import salt.log
+import salt.ext.alert.scheduler
+
+STATS_INTERVAL = 5          # seconds between published statistics
+STATS_SIZE     = 64 * 1024  # bytes of shared memory per process
+
+log = salt.log.getLogger(__name__)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, ex:
+        return ex.errno != errno.ESRCH
+    return True
+
+class Snapshots(object):
+    '''
+    Slots of shared memory for the statistics of count processes.  Must
+    be created before the processes are forked.
+
+    >>> s = Snapshots(2)
+    >>> s.claim(), s.claim()
+    (0, 0)
+    >>> s.publish(0, {'pid': 1})
+    True
+    >>> s.read()
+    [{u'pid': 1}, {}]
+    '''
+    def __init__(self, count, size=STATS_SIZE):
+        self.size = size
+        self.arrays = [multiprocessing.Array('c', size)
+                        for i in xrange(count)]
+        # the pid of the process that claimed each slot
+        self.pids = multiprocessing.Array('i', count)
+
+    def claim(self):
+        '''
+        Return the slot of the calling process, claiming a free slot or
+        one whose process is gone.  Return None if every slot is taken.
+        '''
+        pid = os.getpid()
+        with self.pids.get_lock():
+            pids = self.pids[:]
+            if pid in pids:
+                return pids.index(pid)
+            for index, owner in enumerate(pids):
+                if not owner or not _alive(owner):
+                    self.pids[index] = pid
+                    with self.arrays[index].get_lock():
+                        self.arrays[index].value = ''
+                    return index
+        log.warning('no statistics slot left for process %s', pid)
+        return None
+
+    def publish(self, index, stats):
+        '''
+        Publish the statistics of slot index.  Return False if they do
+        not fit.
+        '''
+        data = json.dumps(stats)
+        if len(data) >= self.size:
+            log.warning('statistics of slot %s exceed %s bytes', index,
+                        self.size)
+            return False
+        array = self.arrays[index]
+        with array.get_lock():
+            array.value = data
+        return True
+
+    def start(self, index, collect, interval=STATS_INTERVAL):
+        '''
+        Publish the statistics returned by collect() to slot index now
+        and every interval seconds, on the scheduler of the calling
+        process.
+        '''
+        self.publish(index, collect())
+        salt.ext.alert.scheduler.schedule(interval, self.start, index,
+                                          collect, interval)
+
+    def read(self):
+        '''
+        Return the statistics last published to each slot, or an empty
+        dict for a slot without any.
+        '''
+        stats = []
+        for array in self.arrays:
+            with array.get_lock():
+                data = array.value
+            stats.append(json.loads(data) if data else {})
+        return stats
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,363 @@
+'''
+Suppression of alerts that depend on a failed host.
+
+When a switch or a hypervisor goes down, every host behind it raises its
+own alerts.  With alert.topology, the hosts' parents are configured, and
+while a parent has a raised alert that was not cleared, the alerts raised
+by its descendants are suppressed.  The clear of a suppressed alert, the
+alert of the same host and category, is suppressed too; the clears of
+alerts that were delivered are always delivered.  With fold,
+the number of suppressed alerts is added to the parent's clear
+notification instead, e.g. "switch1 is up (12 dependent alerts
+suppressed)".
+
+The ancestors and descendants of every host are computed when the config
+is loaded.  When a parent goes down or comes back up, the count of down
+ancestors of each of its descendants is updated, so checking an alert
+is a lookup of its host's count.
+
+The alert server receives alerts in several processes, and the alerts of
+a parent and its children may arrive in different ones.  The state is
+kept in shared memory that is created before the processes are forked.
+A parent is up again when the alert that took it down is cleared, or
+after hold seconds without a clear.
+'''
+import fnmatch
+import multiprocessing
+import re
+import time
+
+import salt.log
+
+from salt.ext.alert.hashring import stable_hash
+
+DEFAULT_HOLD = 3600
+DEFAULT_FOLD = False
+FOLDED_SLOTS = 16       # suppressed categories remembered per host
+
+log = salt.log.getLogger(__name__)
+
+def _category_key(category):
+    # never 0, which marks an empty slot
+    return (stable_hash(category or '') & 0x7fffffff) or 1
+
+def dependencies(parents):
+    '''
+    Return the ancestors of each host, nearest first, and the descendants
+    of each host, from a dict of host => parent or list of parents.
+    Cycles are broken.
+
+    >>> ancestors, descendants = dependencies({'web1': 'sw1', 'web2': 'sw1',
+    ...                                        'sw1': ['core1', 'core2']})
+    >>> ancestors['web1']
+    ['sw1', 'core1', 'core2']
+    >>> sorted(descendants['core1'])
+    ['sw1', 'web1', 'web2']
+    >>> dependencies({'a': 'b', 'b': 'a'})[0]
+    {'a': ['b'], 'b': ['a']}
+    '''
+    direct = {}
+    for host, hosts in parents.iteritems():
+        if isinstance(hosts, basestring):
+            hosts = [hosts]
+        direct[str(host)] = [str(parent) for parent in hosts or []]
+    ancestors = {}
+    descendants = {}
+    for host in direct:
+        found = []
+        seen = set([host])
+        level = direct[host]
+        while level:
+            following = []
+            for parent in level:
+                if parent in seen:
+                    if parent == host:
+                        log.warning('topology: %s depends on itself', host)
+                    continue
+                seen.add(parent)
+                found.append(parent)
+                following.extend(direct.get(parent, ()))
+            level = following
+        ancestors[host] = found
+        for parent in found:
+            descendants.setdefault(parent, []).append(host)
+    return ancestors, descendants
+
+class Topology(object):
+    '''
+    The dependencies between hosts and the state of the parents, shared
+    by the alert server processes.
+
+    >>> t = Topology({'web1': 'sw1', 'web2': 'sw1'}, fold=True)
+    >>> t.check({'host': 'web1', 'category': 'load.high'}, now=10)
+    False
+    >>> t.check({'host': 'sw1', 'category': 'host.down'}, now=20)
+    False
+    >>> t.check({'host': 'web1', 'category': 'load.high'}, now=30)
+    True
+    >>> t.check({'host': 'web2', 'category': 'disk.full'}, now=30)
+    True
+    >>> sorted(t.stats().items())
+    [('down', ['sw1']), ('hosts', 3), ('suppressed', 2)]
+
+    # the parent's clear reports the suppressed alerts
+    >>> clear = {'host': 'sw1', 'category': 'host.down', 'verb': 'cleared',
+    ...          'msg': 'sw1 is up'}
+    >>> t.check(clear, now=40)
+    False
+    >>> clear['msg'], clear['folded']
+    ('sw1 is up (2 dependent alerts suppressed)', 2)
+
+    # so are the clears of the suppressed alerts, but nothing else
+    >>> t.check({'host': 'web1', 'category': 'load.high',
+    ...          'verb': 'cleared'}, now=50)
+    True
+    >>> t.check({'host': 'web1', 'category': 'load.high'}, now=60)
+    False
+    >>> t.check({'host': 'web1', 'category': 'load.high',
+    ...          'verb': 'cleared'}, now=70)
+    False
+
+    # only the clear of a suppressed category is suppressed
+    >>> t.check({'host': 'web1', 'category': 'disk.full'}, now=80)
+    False
+    >>> t.check({'host': 'sw1', 'category': 'host.down'}, now=90)
+    False
+    >>> t.check({'host': 'web1', 'category': 'load.high'}, now=100)
+    True
+    >>> t.check({'host': 'web1', 'category': 'disk.full',
+    ...          'verb': 'cleared'}, now=110)
+    False
+    >>> t.check({'host': 'web1', 'category': 'load.high',
+    ...          'verb': 'cleared'}, now=120)
+    True
+
+    # a suppressed raise that is never cleared is forgotten when the
+    # same category is raised and delivered again
+    >>> t.check({'host': 'web2', 'category': 'net.loss'}, now=130)
+    True
+    >>> t.check({'host': 'sw1', 'category': 'host.down',
+    ...          'verb': 'cleared'}, now=140)
+    False
+    >>> t.check({'host': 'web2', 'category': 'net.loss'}, now=150)
+    False
+    >>> t.check({'host': 'web2', 'category': 'net.loss',
+    ...          'verb': 'cleared'}, now=160)
+    False
+    '''
+    def __init__(self, parents, categories=None, hold=DEFAULT_HOLD,
+                 fold=DEFAULT_FOLD):
+        '''
+        parents    = host => parent host, or list of parent hosts
+        categories = globs of the categories that take a parent down, or
+                     None for all
+        hold       = seconds a parent is down without a clear
+        fold       = add the number of suppressed alerts to the parent's
+                     clear
+        '''
+        ancestors, descendants = dependencies(parents)
+        hosts = sorted(set(ancestors) | set(descendants))
+        self.hosts = hosts
+        self.slots = dict((host, slot) for slot, host in enumerate(hosts))
+        self.ancestors = [tuple(self.slots[parent]
+                                    for parent in ancestors.get(host, ()))
+                            for host in hosts]
+        self.descendants = [tuple(self.slots[child]
+                                    for child in descendants.get(host, ()))
+                            for host in hosts]
+        self.category_match = None
+        if categories:
+            if isinstance(categories, basestring):
+                categories = [categories]
+            self.category_match = re.compile('|'.join(
+                    fnmatch.translate(glob) for glob in categories)).match
+        self.hold = hold
+        self.fold = fold
+        count = len(hosts)
+        self.lock = multiprocessing.Lock()
+        # per parent: when it went down (0 if up), and the category that
+        # took it down
+        self.down = multiprocessing.RawArray('d', count)
+        self.cause = multiprocessing.RawArray('i', count)
+        # per parent: the alerts suppressed while it is down
+        self.folded_by = multiprocessing.RawArray('i', count)
+        # per host: the number of its ancestors that are down
+        self.blocked = multiprocessing.RawArray('i', count)
+        # per host: the categories of its suppressed raised alerts that
+        # were not cleared, in FOLDED_SLOTS slots of (category key, time),
+        # and the number of slots in use
+        self.folded = multiprocessing.RawArray('i', count)
+        self.folded_keys = multiprocessing.RawArray('i', count * FOLDED_SLOTS)
+        self.folded_times = multiprocessing.RawArray('d',
+                                                     count * FOLDED_SLOTS)
+        self.suppressed = multiprocessing.RawValue('l', 0)
+
+    def check(self, alert, now=None):
+        '''
+        Track the parents an alert takes down or up.  Return True if the
+        alert is suppressed because an ancestor of its host is down, or
+        if it clears an alert that was suppressed.
+        '''
+        slot = self.slots.get(alert.get('host'))
+        if slot is None:
+            return False
+        if now is None:
+            now = time.time()
+        cleared = alert.get('verb') == 'cleared'
+        category = alert.get('category')
+        with self.lock:
+            if self.descendants[slot] and self.__covers(category):
+                if cleared:
+                    self.__clear(slot, category, alert)
+                elif not self.down[slot]:
+                    self.__down(slot, category, now)
+            key = _category_key(category)
+            if cleared:
+                if not self.__unfold(slot, key):
+                    return False
+            else:
+                parent = None
+                if self.blocked[slot] > 0:
+                    parent = self.__down_ancestor(slot, now)
+                if parent is None:
+                    # delivered: so is its clear
+                    self.__unfold(slot, key)
+                    return False
+                self.__fold(slot, key, now)
+                self.folded_by[parent] += 1
+            self.suppressed.value += 1
+        log.trace('suppressed by topology: %s', alert)
+        return True
+
+    def stats(self):
+        '''
+        Return the parents that are down and the suppressed alerts.
+        '''
+        with self.lock:
+            return {'hosts': len(self.hosts),
+                    'down': [self.hosts[slot]
+                                for slot in xrange(len(self.hosts))
+                                if self.down[slot]],
+                    'suppressed': self.suppressed.value}
+
+    def __covers(self, category):
+        if self.category_match is None:
+            return True
+        return category is not None and \
+                self.category_match(category) is not None
+
+    def __fold(self, slot, key, now):
+        '''
+        Remember that a host's alert of a category was suppressed.  When
+        all slots are used, the oldest is reused.  Must hold the lock.
+        '''
+        base = slot * FOLDED_SLOTS
+        free = oldest = None
+        for i in xrange(base, base + FOLDED_SLOTS):
+            if self.folded_keys[i] == key:
+                self.folded_times[i] = now
+                return
+            if not self.folded_keys[i]:
+                if free is None:
+                    free = i
+            elif oldest is None or \
+                    self.folded_times[i] < self.folded_times[oldest]:
+                oldest = i
+        if free is None:
+            log.debug('topology: forget a suppressed alert of %s',
+                      self.hosts[slot])
+            free = oldest
+        else:
+            self.folded[slot] += 1
+        self.folded_keys[free] = key
+        self.folded_times[free] = now
+
+    def __unfold(self, slot, key):
+        '''
+        Forget a suppressed alert of a host's category.  Return True if
+        there was one.  Must hold the lock.
+        '''
+        if self.folded[slot] <= 0:
+            return False
+        base = slot * FOLDED_SLOTS
+        for i in xrange(base, base + FOLDED_SLOTS):
+            if self.folded_keys[i] == key:
+                self.folded_keys[i] = 0
+                self.folded[slot] -= 1
+                return True
+        return False
+
+    def __down(self, slot, category, now):
+        '''
+        Take a parent down.  Must hold the lock.
+        '''
+        log.debug('topology: %s is down, suppress alerts of %s host(s)',
+                  self.hosts[slot], len(self.descendants[slot]))
+        self.down[slot] = now
+        self.cause[slot] = _category_key(category)
+        self.folded_by[slot] = 0
+        for child in self.descendants[slot]:
+            self.blocked[child] += 1
+
+    def __up(self, slot):
+        '''
+        Bring a parent up.  Return the number of alerts suppressed while
+        it was down.  Must hold the lock.
+        '''
+        self.down[slot] = 0
+        for child in self.descendants[slot]:
+            self.blocked[child] -= 1
+        folded = self.folded_by[slot]
+        self.folded_by[slot] = 0
+        log.debug('topology: %s is up, suppressed %s dependent alert(s)',
+                  self.hosts[slot], folded)
+        return folded
+
+    def __clear(self, slot, category, alert):
+        '''
+        Bring a parent up if alert clears the alert that took it down.
+        Must hold the lock.
+        '''
+        if not self.down[slot] or \
+                self.cause[slot] != _category_key(category):
+            return
+        folded = self.__up(slot)
+        if self.fold and folded:
+            alert['folded'] = folded
+            alert['msg'] = '{} ({} dependent alert{} suppressed)'.format(
+                    alert.get('msg', ''), folded, 's' if folded != 1 else '')
+
+    def __down_ancestor(self, slot, now):
+        '''
+        Return the nearest ancestor of a host that is down, bringing up
+        those that were down longer than hold.  Must hold the lock.
+        '''
+        for parent in self.ancestors[slot]:
+            since = self.down[parent]
+            if not since:
+                continue
+            if self.hold and now - since > self.hold:
+                log.info('topology: %s was not cleared in %s seconds',
+                         self.hosts[parent], self.hold)
+                self.__up(parent)
+                continue
+            return parent
+        return None
+
+def load_topology(config):
+    '''
+    Create the topology configured in alert.topology, or return None if
+    alerts are never suppressed for their parents.
+    '''
+    config = config.get('alert.topology')
+    if not config or not config.get('parents'):
+        return None
+    log.trace('topology: %s host(s) with parents', len(config['parents']))
+    return Topology(config['parents'],
+                    categories=config.get('categories'),
+                    hold=config.get('hold', DEFAULT_HOLD),
+                    fold=config.get('fold', DEFAULT_FOLD))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
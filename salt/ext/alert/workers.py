@@ -0,0 +1,146 @@
+'''
+Delivery worker processes.
+
+Rendering messages and serializing them for the transports is CPU bound,
+and one Python process only uses one core.  With alert.workers, alerts
+are delivered by several worker processes instead.  Each recipient is
+assigned to a worker by a stable hash of its address, so its messages
+stay in order and its throttling state lives in one process.
+
+The alert server routes each alert once to find the workers with
+recipients for it, and hands the alert to those workers only.  Each
+worker routes the alert again and delivers it to its own recipients.
+
+The send, receipt and total latencies of the alerts are sampled in the
+workers.  Every few seconds each worker publishes its statistics to
+shared memory, from where any alert server process reports them.
+'''
+import multiprocessing
+import os
+
+import salt.log
+import salt.ext.alert.budget
+import salt.ext.alert.engine
+import salt.ext.alert.latency
+
+from salt.ext.alert.hashring import stable_hash
+from salt.ext.alert.snapshots import Snapshots
+
+DEFAULT_PROCESSES  = 0
+DEFAULT_QUEUE_SIZE = 1000
+
+log = salt.log.getLogger(__name__)
+
+def shard(protocol, subscriber, count):
+    '''
+    Return the index of the worker that delivers to a subscriber.
+
+    >>> shard('email', ('Me <me@example.com>', 'me@example.com'), 4) == \\
+    ...     shard('email', ('Me <me@example.com>', 'me@example.com'), 4)
+    True
+    '''
+    return stable_hash('{}:{}'.format(protocol, subscriber)) % count
+
+class Workers(object):
+    '''
+    A pool of delivery worker processes for an Alerter.
+    '''
+    def __init__(self, alerter, processes, queue_size=DEFAULT_QUEUE_SIZE):
+        '''
+        alerter    = the loaded Alerter whose agents the workers run
+        processes  = the number of worker processes
+        queue_size = the number of alerts that may wait for a worker;
+                     when a worker's queue is full, delivery blocks
+        '''
+        self.alerter = alerter
+        self.count = processes
+        self.queues = [multiprocessing.Queue(queue_size)
+                        for i in xrange(processes)]
+        # the statistics each worker publishes
+        self.snapshots = Snapshots(processes)
+        self.processes = []
+
+    def start(self):
+        '''
+        Start the worker processes.  Must be called before the alert
+        server forks its request workers, so they share the queues.
+        '''
+        for index in xrange(self.count):
+            process = multiprocessing.Process(target=self._run, args=(index,),
+                                              name='alert-worker-{}'.format(index))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        log.debug('started %s delivery worker(s)', self.count)
+
+    def deliver(self, alert):
+        '''
+        Hand a prepared alert to the workers with recipients for it,
+        with the times of its latency trace.
+        '''
+        shards = set()
+        for protocol, agent in self.alerter.agents.iteritems():
+            for subscriber in agent.subscribers(alert):
+                shards.add(shard(protocol, subscriber, self.count))
+                if len(shards) == self.count:
+                    break
+        times = salt.ext.alert.latency.times(alert.get('trace'))
+        for index in shards:
+            self.queues[index].put((alert, times))
+
+    def stats(self):
+        '''
+        Return the statistics last published by each worker: its pid,
+        and the latency, engine and budget statistics of its process.
+        '''
+        return self.snapshots.read()
+
+    def _run(self, index):
+        '''
+        Deliver the alerts handed to worker index to its recipients,
+        forever.  This method runs in the worker process.
+        '''
+        log.debug('delivery worker %s: pid %s', index, os.getpid())
+        queue = self.queues[index]
+        agents = sorted(self.alerter.agents.iteritems())
+        self.snapshots.start(index, self._stats)
+        while True:
+            alert, times = queue.get()
+            salt.ext.alert.latency.adopt(alert.get('trace'), times)
+            for protocol, agent in agents:
+                try:
+                    subscribers = [subscriber
+                                    for subscriber in agent.subscribers(alert)
+                                    if shard(protocol, subscriber,
+                                             self.count) == index]
+                    if subscribers:
+                        agent._deliver_async(subscribers, alert)
+                except Exception, ex:
+                    log.error('delivery worker %s: %s failed to deliver: %s',
+                              index, protocol, alert, exc_info=ex)
+
+    def _stats(self):
+        '''
+        Return the statistics of a worker process.
+        '''
+        return {'pid': os.getpid(),
+                'latency': salt.ext.alert.latency.stats(),
+                'engine': salt.ext.alert.engine.stats(),
+                'budget': salt.ext.alert.budget.stats()}
+
+def load_workers(config, alerter):
+    '''
+    Create the delivery workers configured in alert.workers, or return
+    None to deliver in the alert server's own processes.
+    '''
+    config = config.get('alert.workers') or {}
+    processes = config.get('processes', DEFAULT_PROCESSES)
+    if processes <= 0:
+        return None
+    log.trace('delivery workers: processes=%s', processes)
+    return Workers(alerter, processes,
+                   config.get('queue_size', DEFAULT_QUEUE_SIZE))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()